@@ -4,7 +4,13 @@ from datetime import timedelta
 # Added 'g' to imports for White Label Logic
 from flask import Flask, render_template, request, session, send_from_directory, abort, redirect, url_for, session, g
 from werkzeug.exceptions import HTTPException
-from db import get_db
+from werkzeug.security import safe_join
+from db import get_db, close_request_db
+from services.settings_cache import get_settings, get_setting
+from services.tenant_cache import resolve_subdomain
+from services.telematics_poller import start_poller
+from services.email_queue import start_email_worker
+from utils.static_assets import is_asset_path, static_file_hash, fingerprint_url, apply_asset_cache_headers
 from flask_wtf.csrf import CSRFProtect
 
 # 1. Import all Blueprints
@@ -40,6 +46,10 @@ app.config['SESSION_COOKIE_SECURE'] = True
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 
+# --- DATABASE: ONE POOLED CONNECTION PER REQUEST ---
+# get_db() shares a single connection across the route, helpers and context processors.
+app.teardown_appcontext(close_request_db)
+
 # 3. REGISTER BLUEPRINTS
 app.register_blueprint(portal_bp)
 app.register_blueprint(public_bp)
@@ -57,6 +67,16 @@ app.register_blueprint(transactions_bp)
 app.register_blueprint(jobs_bp)
 app.register_blueprint(quote_bp)
 
+# =========================================================
+# BACKGROUND WORKERS
+# =========================================================
+# Started from the first request in each process rather than at import, so
+# the thread lives in the gunicorn worker and not the pre-fork master.
+@app.before_request
+def start_background_workers():
+    start_poller()
+    start_email_worker()
+
 # =========================================================
 # WHITE LABEL LOGIC (SUBDOMAIN INTERCEPTOR)
 # =========================================================
@@ -66,6 +86,12 @@ def load_tenant_context():
     Runs before every request. Checks if the user is visiting via a subdomain
     (e.g., drugangroup.businessbetter.co.uk). If so, it loads that company's ID.
     """
+    # 0. FAST PATH: static files, favicon and uploads never need the tenant
+    if is_asset_path(request.path):
+        g.is_asset = True
+        g.is_white_label = False
+        return
+
     host = request.host.lower()
     
     # CHANGE THIS to your live domain when deploying
@@ -77,34 +103,49 @@ def load_tenant_context():
         # Extract the subdomain (e.g. "drugangroup")
         subdomain = host.replace(f'.{base_domain}', '').split('.')[0]
         
-        # 2. Look up the company in the DB
-        conn = get_db()
-        if conn:
-            try:
-                cur = conn.cursor()
-                # Note: DB schema uses 'sub_domain' (with underscore)
-                cur.execute("SELECT id, name FROM companies WHERE LOWER(sub_domain) = %s", (subdomain,))
-                company = cur.fetchone()
-                
-                if company:
-                    # Found them! Store in global 'g' for this request
-                    g.tenant_id = company[0]
-                    g.tenant_name = company[1]
-                    g.is_white_label = True
-                else:
-                    # Subdomain exists in URL but not in DB -> 404
-                    g.is_white_label = False
-                    # Optional: abort(404) if you want to block invalid subdomains strictly
-            except Exception as e:
-                print(f"Subdomain Check Error: {e}")
-                g.is_white_label = False
-            finally:
-                conn.close()
+        # 2. Look up the company (cached in memory, see services/tenant_cache.py)
+        company = resolve_subdomain(subdomain)
+        
+        if company:
+            # Found them! Store in global 'g' for this request
+            g.tenant_id = company[0]
+            g.tenant_name = company[1]
+            g.is_white_label = True
         else:
+            # Subdomain exists in URL but not in DB (or lookup failed)
             g.is_white_label = False
+            # Optional: abort(404) if you want to block invalid subdomains strictly
     else:
         g.is_white_label = False
 
+# =========================================================
+# STATIC ASSET CACHING (FINGERPRINTED URLS)
+# =========================================================
+@app.url_defaults
+def fingerprint_static_urls(endpoint, values):
+    # url_for('static', filename='style.css') -> /static/style.css?v=<content hash>
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        digest = static_file_hash(app.static_folder, values['filename'])
+        if digest: values['v'] = digest
+
+@app.after_request
+def asset_cache_headers(response):
+    filename = (request.view_args or {}).get('filename')
+    if request.endpoint == 'static' and filename:
+        abs_path = safe_join(app.static_folder, filename)
+        response = apply_asset_cache_headers(response, abs_path, request.args.get('v'))
+    elif request.endpoint == 'serve_uploads' and filename:
+        # Tenant uploads sit behind a login check, so only the browser may cache them
+        abs_path = safe_join(os.path.join(app.static_folder, 'uploads'), filename)
+        response = apply_asset_cache_headers(response, abs_path, request.args.get('v'), public=False)
+    else:
+        return response
+
+    if response.status_code == 200:
+        # Answer If-None-Match against the content ETag set above
+        response.make_conditional(request)
+    return response
+
 # =========================================================
 # GLOBAL ERROR CAPTURE
 # =========================================================
@@ -129,6 +170,9 @@ def handle_exception(e):
     # 3. Log to DB
     conn = get_db()
     if conn:
+        # Discard whatever the failed route left half-written on the shared connection
+        try: conn.rollback()
+        except Exception: pass
         cur = conn.cursor()
         try:
             cur.execute("""
@@ -163,6 +207,7 @@ def debug_files():
 @app.context_processor
 def inject_global_alert():
     alert_msg = None
+    if g.get('is_asset'): return dict(global_system_alert=alert_msg)
     try:
         conn = get_db()
         if conn:
@@ -179,13 +224,10 @@ def inject_global_alert():
 @app.context_processor
 def inject_currency():
     default_sym = '£'
-    if 'company_id' not in session: return dict(currency_symbol=default_sym)
+    if g.get('is_asset') or 'company_id' not in session: return dict(currency_symbol=default_sym)
     try:
         if 'currency_symbol' in session: return dict(currency_symbol=session['currency_symbol'])
-        conn = get_db(); cur = conn.cursor()
-        cur.execute("SELECT value FROM settings WHERE company_id = %s AND key = 'currency_symbol'", (session['company_id'],))
-        row = cur.fetchone(); conn.close()
-        symbol = row[0] if row else default_sym
+        symbol = get_setting(session['company_id'], 'currency_symbol', default_sym)
         session['currency_symbol'] = symbol
         return dict(currency_symbol=symbol)
     except: return dict(currency_symbol=default_sym)
@@ -196,43 +238,38 @@ def inject_branding():
     default_color = '#c5a059' # Gold
     default_logo = '/static/images/logo.png' # Business Better Logo
     
+    if g.get('is_asset'):
+        return dict(brand_color=default_color, logo=default_logo)
+
     # 1. IF LOGGED IN (Use Session Data)
     if 'company_id' in session:
         # If session data is missing, try to fetch it
         if not session.get('brand_color') or not session.get('logo'):
             try:
-                conn = get_db()
-                cur = conn.cursor()
-                cur.execute("SELECT key, value FROM settings WHERE company_id = %s AND key IN ('brand_color', 'logo')", (session['company_id'],))
-                settings = dict(cur.fetchall())
-                conn.close()
+                settings = get_settings(session['company_id'])
                 session['brand_color'] = settings.get('brand_color', default_color)
                 session['logo'] = settings.get('logo', default_logo)
             except: pass
             
         return dict(brand_color=session.get('brand_color', default_color), 
-                    logo=session.get('logo', default_logo))
+                    logo=fingerprint_url(session.get('logo', default_logo), app.static_folder))
 
     # 2. IF NOT LOGGED IN BUT ON SUBDOMAIN (Use Interceptor Data)
     if hasattr(g, 'is_white_label') and g.is_white_label:
         try:
-            conn = get_db()
-            cur = conn.cursor()
-            cur.execute("SELECT key, value FROM settings WHERE company_id = %s AND key IN ('brand_color', 'logo')", (g.tenant_id,))
-            settings = dict(cur.fetchall())
-            conn.close()
+            settings = get_settings(g.tenant_id)
             
             # Return the Company's Branding
             return dict(
                 brand_color=settings.get('brand_color', default_color),
-                logo=settings.get('logo', default_logo),
+                logo=fingerprint_url(settings.get('logo', default_logo), app.static_folder),
                 company_name=g.tenant_name # Pass name for "Login to [Company]" text
             )
         except:
             pass
 
     # 3. FALLBACK (Main Marketing Site)
-    return dict(brand_color=default_color, logo=default_logo)
+    return dict(brand_color=default_color, logo=fingerprint_url(default_logo, app.static_folder))
     
 @app.route('/uploads/<path:filename>')
 def serve_uploads(filename):
@@ -0,0 +1,196 @@
+# --- benchmarks/finance_dashboard.py ---
+# Finance dashboard queries: before / after the single-round-trip rewrite
+# (user-006) and the per-month rollups that replaced it (user-007).
+#
+# Seeds a scratch schema ('bench_finance', dropped and rebuilt every run) with
+# a tenant holding 50k invoices plus four noisy neighbours, then times what
+# each version of finance_dashboard() sends to Postgres (the unchanged audit
+# log query is left out). Point it at a throwaway database:
+#
+#   BENCH_DATABASE_URL=postgresql://user@localhost/scratch python benchmarks/finance_dashboard.py
+import os
+import sys
+import time
+import random
+import statistics
+from datetime import date, timedelta
+
+import psycopg2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from services import finance_rollups
+
+DSN = os.environ.get("BENCH_DATABASE_URL")
+INVOICES = int(os.environ.get("BENCH_INVOICES", 50000))
+RUNS = int(os.environ.get("BENCH_RUNS", 20))
+TENANT = 1
+
+class CountingCursor:
+    def __init__(self, cur):
+        self.cur, self.queries = cur, 0
+
+    def execute(self, sql, params=None):
+        self.queries += 1
+        return self.cur.execute(sql, params)
+
+    def __getattr__(self, name):
+        return getattr(self.cur, name)
+
+# =========================================================
+# SEED
+# =========================================================
+def seed(conn):
+    cur = conn.cursor()
+    cur.execute("DROP SCHEMA IF EXISTS bench_finance CASCADE; CREATE SCHEMA bench_finance; SET search_path TO bench_finance")
+    cur.execute("""
+        CREATE TABLE clients (id SERIAL PRIMARY KEY, company_id INTEGER, name VARCHAR(150));
+        CREATE TABLE invoices (id SERIAL PRIMARY KEY, company_id INTEGER, client_id INTEGER, job_id INTEGER, ref VARCHAR(50),
+                               status VARCHAR(20), total DECIMAL(10,2), date DATE, date_created TIMESTAMP);
+        CREATE TABLE maintenance_logs (id SERIAL PRIMARY KEY, company_id INTEGER, cost DECIMAL(10,2), date DATE);
+        CREATE TABLE job_expenses (id SERIAL PRIMARY KEY, company_id INTEGER, job_id INTEGER, description TEXT, cost DECIMAL(10,2), date DATE);
+        CREATE TABLE overhead_categories (id SERIAL PRIMARY KEY, company_id INTEGER, name VARCHAR(100));
+        CREATE TABLE overhead_items (id SERIAL PRIMARY KEY, category_id INTEGER, name VARCHAR(100), amount DECIMAL(10,2), date_incurred DATE);
+    """)
+    rnd = random.Random(42)
+    today = date.today()
+    day = lambda: today - timedelta(days=rnd.randint(0, 3 * 365))
+    statuses = ['Paid'] * 6 + ['Unpaid', 'Sent', 'Overdue', 'Void']
+
+    for company, invoices in [(TENANT, INVOICES)] + [(c, INVOICES // 2) for c in range(2, 6)]:
+        cur.execute("INSERT INTO clients (company_id, name) SELECT %s, 'Client ' || g FROM generate_series(1, 500) g", (company,))
+        rows = []
+        for i in range(invoices):
+            d = day()
+            rows.append(cur.mogrify("(%s,%s,%s,%s,%s,%s,%s,%s)", (company, rnd.randint(1, 500), rnd.randint(1, 5000), f"INV-{i}",
+                                                                 rnd.choice(statuses), rnd.randint(50, 5000), d, d)).decode())
+        for start in range(0, len(rows), 5000):
+            cur.execute("INSERT INTO invoices (company_id, client_id, job_id, ref, status, total, date, date_created) VALUES "
+                        + ",".join(rows[start:start + 5000]))
+        cur.execute("INSERT INTO maintenance_logs (company_id, cost, date) SELECT %s, (random() * 400)::numeric(10,2), CURRENT_DATE - (random() * 1095)::int FROM generate_series(1, %s)", (company, invoices // 10))
+        cur.execute("INSERT INTO job_expenses (company_id, job_id, description, cost, date) SELECT %s, g, 'Materials', (random() * 300)::numeric(10,2), CURRENT_DATE - (random() * 1095)::int FROM generate_series(1, %s) g", (company, invoices // 5))
+        cur.execute("INSERT INTO overhead_categories (company_id, name) VALUES (%s, 'Premises') RETURNING id", (company,))
+        cat = cur.fetchone()[0]
+        cur.execute("INSERT INTO overhead_items (category_id, name, amount, date_incurred) SELECT %s, 'Item ' || g, 100, CURRENT_DATE FROM generate_series(1, 20) g", (cat,))
+    cur.execute("ANALYZE")
+    conn.commit()
+
+def add_date_indexes(conn):
+    # What /admin/setup-indexes-db adds for the dashboard
+    cur = conn.cursor()
+    cur.execute("CREATE INDEX idx_invoices_company_date ON invoices (company_id, date)")
+    cur.execute("CREATE INDEX idx_maintenance_logs_company_date ON maintenance_logs (company_id, date)")
+    cur.execute("ANALYZE")
+    conn.commit()
+
+# =========================================================
+# THE THREE VERSIONS
+# =========================================================
+RECENT_FEED = """
+    (SELECT date_created as date, 'Income' as type, 'Sales' as category,
+            ref || ' - ' || COALESCE((SELECT name FROM clients WHERE id = invoices.client_id), 'Unknown Client') as description,
+            COALESCE(total, 0) as amount, job_id
+     FROM invoices WHERE company_id = %(comp_id)s AND status = 'Paid')
+    UNION ALL
+    (SELECT date, 'Expense', 'Job Cost', COALESCE(description, 'Uncategorized Expense'), COALESCE(cost, 0), job_id
+     FROM job_expenses WHERE company_id = %(comp_id)s)
+    UNION ALL
+    (SELECT date_incurred, 'Expense', 'Overhead', COALESCE(name, 'General Overhead'), COALESCE(amount, 0), NULL
+     FROM overhead_items WHERE category_id IN (SELECT id FROM overhead_categories WHERE company_id = %(comp_id)s))
+    ORDER BY date DESC LIMIT 15
+"""
+
+def before(cur, comp_id):
+    # Original: 3 totals, the feed, then 2 EXTRACT(MONTH/YEAR) queries per chart month
+    cur.execute("SELECT COALESCE(SUM(total), 0) FROM invoices WHERE company_id = %s AND status != 'Void'", (comp_id,)); cur.fetchone()
+    cur.execute("SELECT COALESCE(SUM(cost), 0) FROM maintenance_logs WHERE company_id = %s", (comp_id,)); cur.fetchone()
+    cur.execute("SELECT COALESCE(SUM(amount), 0) FROM overhead_items JOIN overhead_categories c ON overhead_items.category_id = c.id WHERE c.company_id = %s", (comp_id,)); cur.fetchone()
+    cur.execute(RECENT_FEED, {'comp_id': comp_id}); cur.fetchall()
+    today = date.today()
+    for i in range(5, -1, -1):
+        d = today - timedelta(days=i * 30)
+        cur.execute("SELECT COALESCE(SUM(total), 0) FROM invoices WHERE company_id=%s AND EXTRACT(MONTH FROM date)=%s AND EXTRACT(YEAR FROM date)=%s", (comp_id, d.month, d.year)); cur.fetchone()
+        cur.execute("SELECT COALESCE(SUM(cost), 0) FROM maintenance_logs WHERE company_id=%s AND EXTRACT(MONTH FROM date)=%s AND EXTRACT(YEAR FROM date)=%s", (comp_id, d.month, d.year)); cur.fetchone()
+
+def single_statement(cur, comp_id):
+    # user-006: totals + date_trunc() chart + feed in one statement
+    cur.execute("""
+        WITH months AS (
+            SELECT generate_series(date_trunc('month', CURRENT_DATE) - INTERVAL '5 months', date_trunc('month', CURRENT_DATE), INTERVAL '1 month')::date AS month
+        ),
+        monthly_income AS (
+            SELECT date_trunc('month', date)::date AS month, SUM(total) AS amount FROM invoices
+            WHERE company_id = %(comp_id)s AND date >= date_trunc('month', CURRENT_DATE) - INTERVAL '5 months' GROUP BY 1
+        ),
+        monthly_fleet AS (
+            SELECT date_trunc('month', date)::date AS month, SUM(cost) AS amount FROM maintenance_logs
+            WHERE company_id = %(comp_id)s AND date >= date_trunc('month', CURRENT_DATE) - INTERVAL '5 months' GROUP BY 1
+        ),
+        stats AS (
+            SELECT
+                (SELECT COALESCE(SUM(total), 0) FROM invoices WHERE company_id = %(comp_id)s AND status != 'Void') AS total_income,
+                (SELECT COALESCE(SUM(cost), 0) FROM maintenance_logs WHERE company_id = %(comp_id)s) AS fleet_cost,
+                (SELECT COALESCE(SUM(amount), 0) FROM overhead_items JOIN overhead_categories c ON overhead_items.category_id = c.id WHERE c.company_id = %(comp_id)s) AS monthly_overhead,
+                (SELECT json_agg(json_build_object('label', to_char(m.month, 'FMMonth'), 'income', COALESCE(mi.amount, 0), 'fleet', COALESCE(mf.amount, 0)) ORDER BY m.month)
+                 FROM months m LEFT JOIN monthly_income mi ON mi.month = m.month LEFT JOIN monthly_fleet mf ON mf.month = m.month) AS chart
+        ),
+        recent AS (""" + RECENT_FEED + """)
+        SELECT s.*, r.* FROM stats s LEFT JOIN recent r ON TRUE ORDER BY r.date DESC NULLS LAST
+    """, {'comp_id': comp_id})
+    cur.fetchall()
+
+def rollups(cur, comp_id):
+    # user-007 (current): per-month rollup rows + the feed
+    finance_rollups.get_rollups(cur, comp_id)
+    cur.execute(RECENT_FEED, {'comp_id': comp_id}); cur.fetchall()
+
+def feed_only(cur, comp_id):
+    # Shared by every version - the floor for "2 queries" above
+    cur.execute(RECENT_FEED, {'comp_id': comp_id}); cur.fetchall()
+
+def measure(conn, fns):
+    """
+    Times each version RUNS times, interleaved (one run of every version per
+    round) so a noisy neighbour on the box skews them all alike.
+    Returns [(queries per call, median ms, max ms)] in 'fns' order.
+    """
+    cur = CountingCursor(conn.cursor())
+    for fn in fns:
+        fn(cur, TENANT); conn.rollback()   # Warm the cache
+    timings = [[] for _ in fns]
+    queries = [0] * len(fns)
+    for _ in range(RUNS):
+        for i, fn in enumerate(fns):
+            cur.queries = 0
+            started = time.perf_counter()
+            fn(cur, TENANT)
+            timings[i].append((time.perf_counter() - started) * 1000)
+            queries[i] = cur.queries
+            conn.rollback()
+    return [(q, statistics.median(t), max(t)) for q, t in zip(queries, timings)]
+
+def main():
+    if not DSN:
+        sys.exit("Set BENCH_DATABASE_URL to a scratch database")
+    conn = psycopg2.connect(DSN, options="-c search_path=bench_finance")
+    print(f"Seeding: tenant {TENANT} with {INVOICES} invoices (+4 tenants with {INVOICES // 2}), {RUNS} runs per version...")
+    seed(conn)
+
+    results = [("before (no date index)", measure(conn, [before])[0])]
+    add_date_indexes(conn)
+
+    cur = conn.cursor()
+    finance_rollups.ensure_rollup_tables(cur)
+    finance_rollups.rebuild_rollups(cur, TENANT)
+    conn.commit()
+    finance_rollups._schema_ready = True   # The one-off to_regclass check isn't per page
+
+    names = ["before (with date index)", "user-006 single statement", "user-007 rollups (current)", "  of which: recent feed"]
+    results += zip(names, measure(conn, [before, single_statement, rollups, feed_only]))
+
+    print(f"\n{'version':<28}{'queries':>8}{'median ms':>12}{'max ms':>10}")
+    for name, (queries, median, worst) in results:
+        print(f"{name:<28}{queries:>8}{median:>12.1f}{worst:>10.1f}")
+    conn.close()
+
+if __name__ == '__main__':
+    main()
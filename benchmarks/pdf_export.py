@@ -0,0 +1,90 @@
+# --- benchmarks/pdf_export.py ---
+# Bulk invoice PDF export (user-015): docs/s through stream_pdf_zip().
+#
+# Builds BENCH_DOCS invoice contexts shaped like build_invoice_pdfs() output
+# (BENCH_LINES line items each, bundled logo) and streams them into a ZIP,
+# once cold for each pool size in BENCH_WORKERS and once more with the PDF
+# cache warm. No database needed; the PDF cache lives in a temp directory
+# that is removed afterwards:
+#
+#   python benchmarks/pdf_export.py
+#   BENCH_DOCS=500 BENCH_WORKERS=1,2,4,8 python benchmarks/pdf_export.py
+import io
+import os
+import sys
+import time
+import shutil
+import zipfile
+import tempfile
+from decimal import Decimal
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DOCS = int(os.environ.get("BENCH_DOCS", 200))
+LINES = int(os.environ.get("BENCH_LINES", 30))
+WORKERS = [int(w) for w in os.environ.get("BENCH_WORKERS", "1,2,4").split(",")]
+TEMPLATE = 'finance/pdf_invoice_template.html'
+
+def invoice_docs(run):
+    # 'run' goes into every ref, so each cold run misses the cache
+    docs = []
+    for i in range(DOCS):
+        items = [{'desc': f"Labour / materials line {k}", 'qty': 1 + k % 4, 'price': Decimal('42.50'),
+                  'total': Decimal('42.50') * (1 + k % 4)} for k in range(LINES)]
+        total = float(sum(item['total'] for item in items))
+        context = {
+            'invoice': {'ref': f"INV-{run}-{i}", 'date': '01/09/2026', 'due': '01/10/2026',
+                        'client_name': f"Client {i % 50}", 'client_address': '1 High Street\nLeeds\nLS1 1AA',
+                        'client_email': 'accounts@example.com', 'subtotal': total / 1.2, 'tax': total - total / 1.2,
+                        'total': total, 'tax_rate_display': 20, 'status': 'Unpaid', 'currency_symbol': '£',
+                        'job_title': 'Kitchen refit', 'job_description': 'Site: 1 High Street, LS1 1AA\nStrip out and refit'},
+            'company': {'name': 'Bench Builders Ltd', 'address': '2 Yard Lane', 'email': 'office@example.com',
+                        'phone': '0113 000 0000', 'reg': '01234567'},
+            'items': items,
+            'settings': {},
+            'smart_terms': 'Payment due within 30 days.',
+            'config': {'logo': f"file://{os.path.join(ROOT, 'static', 'images', 'logo.png')}"},
+            'is_quote': False
+        }
+        docs.append((i, context, f"Invoice_INV-{i % 150}.pdf"))   # Some duplicate names, as in a real export
+    return docs
+
+def export(docs):
+    """Streams one ZIP; returns (entries in the archive, seconds)."""
+    from services.pdf_export import stream_pdf_zip
+    started = time.perf_counter()
+    data = b''.join(stream_pdf_zip(docs, TEMPLATE, os.path.join(ROOT, 'static'), ROOT))
+    elapsed = time.perf_counter() - started
+    return len(zipfile.ZipFile(io.BytesIO(data)).namelist()), elapsed
+
+def main():
+    scratch = tempfile.mkdtemp(prefix='bench_pdf_')
+    # Read by the pool processes when they import services.pdf_cache, so set before the first pool
+    os.environ['PDF_CACHE_DIR'] = scratch
+    from services import pdf_jobs, pdf_cache
+    pdf_cache.PDF_CACHE_DIR = scratch
+
+    print(f"{DOCS} invoices x {LINES} lines, {os.cpu_count()} CPU(s)...")
+    results = []
+    try:
+        for workers in WORKERS:
+            if pdf_jobs._pool is not None:
+                pdf_jobs._pool.shutdown()
+                pdf_jobs._pool = None
+            pdf_jobs.PDF_WORKERS = workers
+            export(invoice_docs(f"warm{workers}")[:workers])   # Start the pool and load fpdf in its processes
+            docs = invoice_docs(f"cold{workers}")
+            results.append((f"cold, {workers} worker(s)", *export(docs)))
+        results.append((f"warm cache, {WORKERS[-1]} worker(s)", *export(docs)))
+    finally:
+        if pdf_jobs._pool is not None:
+            pdf_jobs._pool.shutdown()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    print(f"\n{'run':<26}{'entries':>8}{'seconds':>9}{'docs/s':>9}")
+    for name, entries, elapsed in results:
+        print(f"{name:<26}{entries:>8}{elapsed:>9.2f}{DOCS / elapsed:>9.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,22 @@
 import psycopg2
+from psycopg2 import pool, extensions
 import os
+import threading
+import time
+from collections import deque
+from flask import g, has_app_context
 
 # Database Configuration
 DB_URL = os.environ.get("DATABASE_URL")
 
+# --- CONNECTION POOL SIZING ---
+# Each gunicorn worker gets its own pool. Keep MAX low enough that
+# (workers x MAX) stays under the Postgres connection limit on Render.
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", 10))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 10))       # Seconds to wait for a free slot
+DB_POOL_CHECK_AFTER = float(os.environ.get("DB_POOL_CHECK_AFTER", 30)) # Ping connections idle longer than this
+
 # --- THIS WAS MISSING ---
 # We define the upload folder here so other files can import it
 if os.path.exists('/opt/render/project/src'):
@@ -13,21 +26,272 @@ else:
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 
-def get_db():
+# =========================================================
+# CONNECTION POOL
+# =========================================================
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_pool_slots = None
+_last_used = {}
+# Connections dropped without close(): queued by the finaliser, released by the next checkout
+_orphaned = deque()
+
+# Updated from every request thread: only touch under _stats_lock
+_stats_lock = threading.Lock()
+_pool_stats = {
+    'checkouts': 0,
+    'in_use': 0,
+    'peak_in_use': 0,
+    'total_wait_ms': 0.0,
+    'max_wait_ms': 0.0,
+    'timeouts': 0,
+    'discarded': 0
+}
+
+def _connect_kwargs():
+    if DB_URL:
+        # --- LIVE (Render) ---
+        return {'dsn': DB_URL, 'sslmode': 'require'}
+    # --- LOCAL (Laptop) ---
+    return {
+        'dbname': "businessbetter",
+        'user': "postgres",
+        'password': "admin123",
+        'host': "localhost",
+        'port': "5432"
+    }
+
+def _get_pool():
+    """
+    Builds the pool lazily, and rebuilds it after a fork so gunicorn
+    workers never share sockets with the master process.
+    """
+    global _pool, _pool_pid, _pool_slots
+    pid = os.getpid()
+    if _pool is not None and _pool_pid == pid:
+        return _pool
+
+    with _pool_lock:
+        if _pool is None or _pool_pid != pid:
+            _pool = pool.ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, **_connect_kwargs())
+            _pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+            _pool_pid = pid
+            _last_used.clear()
+            _orphaned.clear()
+    return _pool
+
+def _is_healthy(raw_conn):
+    if raw_conn.closed:
+        return False
+    # Only ping connections that have been sitting idle (saves a round trip on busy workers)
+    if time.monotonic() - _last_used.get(id(raw_conn), 0) < DB_POOL_CHECK_AFTER:
+        return True
+    try:
+        cur = raw_conn.cursor()
+        cur.execute("SELECT 1")
+        cur.close()
+        raw_conn.rollback()
+        return True
+    except Exception:
+        return False
+
+class PooledConnection:
+    """
+    Thin wrapper around a psycopg2 connection.
+    Behaves exactly like the real connection, except close() hands it
+    back to the pool instead of tearing down the socket.
+    """
+
+    def __init__(self, raw_conn, db_pool):
+        object.__setattr__(self, '_conn', raw_conn)
+        object.__setattr__(self, '_pool', db_pool)
+        object.__setattr__(self, '_released', False)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+    def close(self):
+        if self._released:
+            return
+        object.__setattr__(self, '_released', True)
+        _release(self._conn, self._pool)
+
+    def __del__(self):
+        # Safety net for routes that return early without calling close().
+        # GC can run this in any thread at any point - including inside
+        # _release()/_checkout() while _stats_lock or the pool's own lock is
+        # held - so take no locks here: just queue it for the next checkout.
+        if not self._released:
+            object.__setattr__(self, '_released', True)
+            _orphaned.append((self._conn, self._pool))
+
+def _release_orphans():
+    while _orphaned:
+        try:
+            raw_conn, db_pool = _orphaned.popleft()
+        except IndexError:
+            return
+        _release(raw_conn, db_pool)
+
+def _release(raw_conn, db_pool):
+    discard = raw_conn.closed
+    if not discard:
+        try:
+            # Never hand the next caller a half-finished transaction
+            if raw_conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                raw_conn.rollback()
+            if raw_conn.autocommit:
+                raw_conn.autocommit = False
+        except Exception:
+            discard = True
+
     try:
-        if DB_URL:
-            # --- LIVE (Render) ---
-            conn = psycopg2.connect(DB_URL, sslmode='require')
+        if discard:
+            with _stats_lock:
+                _pool_stats['discarded'] += 1
+            _last_used.pop(id(raw_conn), None)
+        else:
+            _last_used[id(raw_conn)] = time.monotonic()
+        # Only return it if the pool it came from is still the live one
+        if db_pool is _pool:
+            db_pool.putconn(raw_conn, close=discard)
         else:
-            # --- LOCAL (Laptop) ---
-            conn = psycopg2.connect(
-                dbname="businessbetter",
-                user="postgres",
-                password="admin123",
-                host="localhost",
-                port="5432"
-            )
-        return conn
+            raw_conn.close()
+    except Exception as e:
+        print(f"⚠️ DB Pool Release Error: {e}")
+    finally:
+        with _stats_lock:
+            _pool_stats['in_use'] -= 1
+        if db_pool is _pool:
+            _pool_slots.release()
+
+def _checkout():
+    db_pool = _get_pool()
+    _release_orphans()   # Before waiting: a leaked connection may hold the slot we need
+
+    start = time.monotonic()
+    if not _pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        with _stats_lock:
+            _pool_stats['timeouts'] += 1
+        raise pool.PoolError(f"Timed out after {DB_POOL_TIMEOUT}s waiting for a database connection")
+    waited_ms = (time.monotonic() - start) * 1000
+
+    with _stats_lock:
+        _pool_stats['checkouts'] += 1
+        _pool_stats['total_wait_ms'] += waited_ms
+        _pool_stats['max_wait_ms'] = max(_pool_stats['max_wait_ms'], waited_ms)
+        _pool_stats['in_use'] += 1
+        _pool_stats['peak_in_use'] = max(_pool_stats['peak_in_use'], _pool_stats['in_use'])
+        in_use = _pool_stats['in_use']
+    if waited_ms > 500:
+        print(f"⚠️ DB Pool: waited {waited_ms:.0f}ms for a connection ({in_use}/{DB_POOL_MAX} in use)")
+
+    try:
+        raw_conn = db_pool.getconn()
+        if not _is_healthy(raw_conn):
+            # Stale socket (DB restart, idle timeout) -> swap for a fresh one
+            with _stats_lock:
+                _pool_stats['discarded'] += 1
+            _last_used.pop(id(raw_conn), None)
+            db_pool.putconn(raw_conn, close=True)
+            raw_conn = db_pool.getconn()
+    except Exception:
+        with _stats_lock:
+            _pool_stats['in_use'] -= 1
+        _pool_slots.release()
+        raise
+
+    return PooledConnection(raw_conn, db_pool)
+
+def get_pool_stats():
+    """
+    Snapshot of pool health for the SuperAdmin dashboard / logs.
+    """
+    with _stats_lock:
+        stats = dict(_pool_stats)
+    checkouts = stats['checkouts']
+    return {
+        'pid': os.getpid(),
+        'min_size': DB_POOL_MIN,
+        'max_size': DB_POOL_MAX,
+        'in_use': stats['in_use'],
+        'peak_in_use': stats['peak_in_use'],
+        'utilisation_pct': round(stats['in_use'] / DB_POOL_MAX * 100, 1) if DB_POOL_MAX else 0,
+        'checkouts': checkouts,
+        'avg_wait_ms': round(stats['total_wait_ms'] / checkouts, 2) if checkouts else 0,
+        'max_wait_ms': round(stats['max_wait_ms'], 2),
+        'timeouts': stats['timeouts'],
+        'discarded': stats['discarded']
+    }
+
+# =========================================================
+# REQUEST-SCOPED CONNECTION
+# =========================================================
+class RequestConnection:
+    """
+    Handed out by get_db() while a Flask request/app context is active.
+    Every helper in the request (route body, get_site_config, context
+    processors, check_limit, send_company_email...) shares one pooled
+    connection. close() is a no-op; close_request_db() releases it on teardown.
+    """
+
+    def __init__(self, pooled_conn):
+        object.__setattr__(self, '_conn', pooled_conn)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+    def close(self):
+        # A helper that hit an SQL error leaves the transaction aborted.
+        # Clear it so the next helper in this request can still query.
+        try:
+            if self._conn.get_transaction_status() == extensions.TRANSACTION_STATUS_INERROR:
+                self._conn.rollback()
+        except Exception:
+            pass
+
+def _get_request_db():
+    conn = g.get('_db_conn')
+    if conn is None or conn.closed:
+        conn = _checkout()
+        g._db_conn = conn
+    elif conn.get_transaction_status() == extensions.TRANSACTION_STATUS_INERROR:
+        conn.rollback()
+    return RequestConnection(conn)
+
+def close_request_db(exception=None):
+    """
+    Teardown hook (registered in app.py). Rolls back anything left
+    uncommitted and returns the request's connection to the pool.
+    """
+    conn = g.pop('_db_conn', None)
+    if conn is not None:
+        conn.close()
+
+def get_db():
+    try:
+        if has_app_context():
+            return _get_request_db()
+        return _checkout()
+    except Exception as e:
+        print(f"❌ DB Connection Error: {e}")
+        return None
+
+def get_pooled_db():
+    """
+    A pool connection of its own, even inside a request. For writes that must
+    commit independently of the request's transaction (job rows, status
+    updates). The caller must close() it.
+    """
+    try:
+        return _checkout()
     except Exception as e:
         print(f"❌ DB Connection Error: {e}")
         return None
@@ -41,27 +305,16 @@ def get_site_config(comp_id):
 
     if not comp_id:
         return default_config
-    
-    conn = get_db()
-    if not conn:
-        return default_config
-        
-    try:
-        cur = conn.cursor()
-        cur.execute("SELECT key, value FROM settings WHERE company_id = %s", (comp_id,))
-        rows = cur.fetchall()
-        settings_dict = {row[0]: row[1] for row in rows}
-        
-        # This keeps the "logo" fix we added earlier
-        return {
-            "color": settings_dict.get('brand_color', '#27AE60'),
-            "logo": settings_dict.get('logo', '/static/images/logo.png') 
-        }
-    except Exception as e:
-        print(f"Config Error: {e}")
-        return default_config
-    finally:
-        if conn: conn.close()
+
+    # Settings come from the per-tenant cache (imported here to avoid a circular import)
+    from services.settings_cache import get_settings
+    settings_dict = get_settings(comp_id)
+
+    # This keeps the "logo" fix we added earlier
+    return {
+        "color": settings_dict.get('brand_color', '#27AE60'),
+        "logo": settings_dict.get('logo', '/static/images/logo.png') 
+    }
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
\ No newline at end of file
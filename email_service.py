@@ -3,66 +3,103 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
 import os
-from db import get_db
+from services.settings_cache import get_settings
 
-def send_company_email(company_id, to_email, subject, body, pdf_path=None):
-    """
-    Fetches the specific SMTP credentials for the company and sends an email.
-    """
-    print(f"📧 Attempting to send email for Company ID: {company_id}...")
+# --- SMTP HELPERS ---
+# Shared by send_company_email() (direct sends, e.g. the settings page's
+# "test connection") and the outbound queue in services/email_queue.py.
+SMTP_TIMEOUT = float(os.environ.get("EMAIL_SMTP_TIMEOUT", 20))
+# Refuse to log in over a plain connection. Set to 0 for a local SMTP stub.
+SMTP_REQUIRE_TLS = os.environ.get("EMAIL_REQUIRE_TLS", "1") == "1"
 
-    # 1. Fetch Company Settings from DB
-    conn = get_db()
-    cur = conn.cursor()
-    # We fetch ALL settings for this company to be safe
-    cur.execute("SELECT key, value FROM settings WHERE company_id = %s", (company_id,))
-    rows = cur.fetchall()
-    conn.close()
-    
-    settings = {row[0]: row[1] for row in rows}
-    
-    # 2. Extract SMTP Details (THE FIX IS HERE)
+def smtp_config(settings):
+    """(host, port, user, password) from a tenant's settings, or None if incomplete."""
     # Your DB saves it as 'smtp_host', so we must ask for 'smtp_host'
-    smtp_server = settings.get('smtp_host')  # <--- CHANGED FROM 'smtp_server'
-    smtp_port = settings.get('smtp_port')
-    smtp_user = settings.get('smtp_email')
-    smtp_pass = settings.get('smtp_password')
-
-    # Debug print to prove what we found
-    print(f"DEBUG FETCH: Host={smtp_server}, User={smtp_user}, Port={smtp_port}")
+    host = settings.get('smtp_host')
+    port = settings.get('smtp_port')
+    user = settings.get('smtp_email')
+    password = settings.get('smtp_password')
+    if not all([host, port, user, password]):
+        return None
+    try: port = int(port)
+    except (TypeError, ValueError): return None
+    return host, port, user, password
 
-    if not all([smtp_server, smtp_port, smtp_user, smtp_pass]):
-        print("❌ Error: Missing SMTP settings for this company.")
-        return False, "Missing Email Settings. Please configure them in Finance > Settings."
+def open_smtp(host, port, user, password):
+    """Connected, encrypted and logged-in SMTP session."""
+    if port == 465:
+        server = smtplib.SMTP_SSL(host, port, timeout=SMTP_TIMEOUT)
+    else:
+        server = smtplib.SMTP(host, port, timeout=SMTP_TIMEOUT)
+        try:
+            server.ehlo()
+            if server.has_extn('starttls'):
+                server.starttls()  # Secure the connection
+                server.ehlo()
+            elif SMTP_REQUIRE_TLS:
+                raise smtplib.SMTPNotSupportedError(f"{host} does not offer STARTTLS")
+        except Exception:
+            server.close()
+            raise
+    try:
+        if server.has_extn('auth'):
+            server.login(user, password)
+    except Exception:
+        server.close()
+        raise
+    return server
 
-    # 3. Construct Email
+def build_message(from_email, to_email, subject, body, body_type='html', attachments=None):
+    """MIME message; attachments is [(filename, bytes)] (PDFs)."""
     msg = MIMEMultipart()
-    msg['From'] = smtp_user
+    msg['From'] = from_email
     msg['To'] = to_email
     msg['Subject'] = subject
-    msg.attach(MIMEText(body, 'html'))
+    msg.attach(MIMEText(body, body_type))
+
+    for filename, content in attachments or []:
+        part = MIMEApplication(bytes(content), Name=filename)
+        part['Content-Disposition'] = f'attachment; filename="{filename}"'
+        msg.attach(part)
+    return msg
 
-    # 4. Attach PDF (Keep your logic!)
+def send_company_email(company_id, to_email, subject, body, pdf_path=None):
+    """
+    Fetches the specific SMTP credentials for the company and sends an email
+    right now, on a fresh connection. Only for sends the user is waiting on
+    (the connection test) and ones that must never be stored in the outbox
+    (new staff login passwords) - everything else goes through
+    services.email_queue.enqueue_email().
+    """
+    print(f"📧 Attempting to send email for Company ID: {company_id}...")
+
+    # 1. Fetch Company Settings (Cached per tenant)
+    config = smtp_config(get_settings(company_id))
+    if not config:
+        print("❌ Error: Missing SMTP settings for this company.")
+        return False, "Missing Email Settings. Please configure them in Finance > Settings."
+    smtp_server, smtp_port, smtp_user, smtp_pass = config
+
+    # 2. Attach PDF (Keep your logic!)
+    attachments = []
     if pdf_path and os.path.exists(pdf_path):
         try:
             with open(pdf_path, "rb") as f:
-                attach = MIMEApplication(f.read(), _subtype="pdf")
-                attach.add_header('Content-Disposition', 'attachment', filename=os.path.basename(pdf_path))
-                msg.attach(attach)
+                attachments.append((os.path.basename(pdf_path), f.read()))
         except Exception as e:
             print(f"⚠️ Could not attach PDF: {e}")
 
-    # 5. Connect and Send
+    msg = build_message(smtp_user, to_email, subject, body, 'html', attachments)
+
+    # 3. Connect and Send
     try:
         print(f"DEBUG: Connecting to {smtp_server}:{smtp_port}...")
-        server = smtplib.SMTP(smtp_server, int(smtp_port))
-        server.starttls()  # Secure the connection
-        server.login(smtp_user, smtp_pass)
+        server = open_smtp(smtp_server, smtp_port, smtp_user, smtp_pass)
         server.send_message(msg)
         server.quit()
         print("✅ Email sent successfully!")
         return True, "Email sent successfully!"
     except Exception as e:
         # repr(e) forces the technical error details to show, preventing empty {}
-        print(f"❌ SMTP Error Raw: {repr(e)}") 
-        return False, f"Email Failed: {repr(e)}"
\ No newline at end of file
+        print(f"❌ SMTP Error Raw: {repr(e)}")
+        return False, f"Email Failed: {repr(e)}"
@@ -11,8 +11,18 @@ import io
 from datetime import datetime, date, timedelta
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from flask import Blueprint, render_template, request, redirect, url_for, session, flash, send_from_directory, current_app
-from db import get_db, get_site_config
+from flask import Blueprint, render_template, request, redirect, url_for, session, flash, send_from_directory, current_app, jsonify
+from db import get_db, get_site_config, get_pool_stats
+from services.settings_cache import get_settings, get_setting, invalidate_settings
+from services.tenant_cache import invalidate_tenant
+from services.finance_rollups import refresh_rollups, invalidate_rollups, ensure_rollup_tables
+from services.telematics_poller import get_poller_metrics, ensure_position_tables
+from services.pdf_jobs import ensure_pdf_job_table
+from services.statement_mailer import ensure_statement_tables
+from services.bulk_import import ensure_import_tables
+from services.email_queue import get_email_queue_metrics, ensure_email_tables
+from services.material_search import invalidate_material_meta
+from services.price_book import invalidate_price_book
 from werkzeug.security import generate_password_hash
 
 admin_bp = Blueprint('admin', __name__)
@@ -54,13 +64,12 @@ def get_real_company_usage(company_id, cur):
 
     # Check Physical Files
     try:
-        cur.execute("SELECT value FROM settings WHERE company_id = %s AND key = 'logo_url'", (company_id,))
-        row = cur.fetchone()
-        if row and row[0]:
-            file_path = row[0].replace('/static/', 'static/')
+        logo_url = get_setting(company_id, 'logo_url')
+        if logo_url:
+            file_path = logo_url.replace('/static/', 'static/')
             if os.path.exists(file_path): total_bytes += os.path.getsize(file_path)
     except:
-        cur.connection.rollback()
+        pass
 
     try:
         cur.execute("SELECT defect_image_url FROM vehicles WHERE company_id = %s", (company_id,))
@@ -346,7 +355,11 @@ def delete_tenant(company_id):
         # STEP 4: Delete the Company
         cur.execute("DELETE FROM companies WHERE id = %s", (company_id,))
         
+        invalidate_rollups(cur, company_id)
         conn.commit()
+        invalidate_settings(company_id)
+        invalidate_price_book(company_id)
+        invalidate_tenant()
         log_audit("DELETE COMPANY", f"Company ID {company_id}", "Deleted via Super Admin Dashboard")
         flash("✅ Company and all associated data deleted permanently.")
         
@@ -532,7 +545,7 @@ def company_details(company_id):
         except Exception: conn.rollback(); stats[t] = 0
 
     try:
-        cur.execute("SELECT key, value FROM settings WHERE company_id = %s", (company_id,)); settings = {row[0]: row[1] for row in cur.fetchall()}
+        settings = get_settings(company_id)
         cur.execute("SELECT SUM(amount) FROM transactions WHERE company_id = %s AND type='Income'", (company_id,)); stats['total_revenue'] = cur.fetchone()[0] or 0.0
     except Exception: conn.rollback(); settings = {}; stats['total_revenue'] = 0.0
     
@@ -586,7 +599,9 @@ def cleanup_super_admin_data():
             try: cur.execute(f"DELETE FROM {t} WHERE company_id = %s", (target_id,))
             except: conn.rollback()
 
+        invalidate_rollups(cur, target_id)
         conn.commit()
+        invalidate_price_book(target_id)
         
         log_details = " | ".join(deleted_summary) if deleted_summary else "No data found."
         log_audit("WIPE DATA", f"Company ID {target_id}", log_details)
@@ -605,6 +620,7 @@ def wipe_fleet_data():
         cur.execute("DELETE FROM maintenance_logs WHERE company_id = %s", (target_id,))
         cur.execute("DELETE FROM vehicle_crews WHERE company_id = %s", (target_id,))
         cur.execute("DELETE FROM vehicles WHERE company_id = %s", (target_id,))
+        refresh_rollups(cur, target_id, 'fleet')
         conn.commit(); flash("✅ Fleet Data Wiped")
     except Exception as e: conn.rollback(); flash(f"❌ Error: {e}")
     finally: conn.close()
@@ -631,6 +647,74 @@ def setup_logs_db():
     finally: conn.close()
     return redirect(url_for('admin.super_admin_dashboard'))
 
+# --- SETUP: PERFORMANCE INDEXES ---
+@admin_bp.route('/admin/setup-indexes-db')
+def setup_indexes_db():
+    if session.get('role') != 'SuperAdmin': return "Access Denied"
+    conn = get_db(); cur = conn.cursor()
+    try:
+        # Subdomain interceptor (app.load_tenant_context) looks up LOWER(sub_domain)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_companies_sub_domain_lower ON companies (LOWER(sub_domain));")
+        # Finance dashboard monthly chart (date range per tenant)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_invoices_company_date ON invoices (company_id, date);")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_maintenance_logs_company_date ON maintenance_logs (company_id, date);")
+        # Material search + calculator price lookups (services/material_search.py)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_materials_company_name_lower ON materials (company_id, LOWER(name));")
+        # pg_trgm is optional (search falls back to LIKE) and managed roles often can't create
+        # extensions - don't let that roll back the rest of the migration
+        cur.execute("SAVEPOINT setup_trgm")
+        try:
+            cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+            cur.execute("CREATE INDEX IF NOT EXISTS idx_materials_name_trgm ON materials USING gin (LOWER(name) gin_trgm_ops);")
+            cur.execute("RELEASE SAVEPOINT setup_trgm")
+        except Exception as e:
+            cur.execute("ROLLBACK TO SAVEPOINT setup_trgm")
+            print(f"⚠️ pg_trgm unavailable, material search will use LIKE: {e}")
+            flash("⚠️ pg_trgm could not be enabled - material search will use plain LIKE matching")
+        # Price list import merges on (company_id, sku) (services/material_import.py)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_materials_company_sku ON materials (company_id, sku);")
+        # Outbound email queue + delivery status on invoices / quotes (services/email_queue.py)
+        ensure_email_tables(cur)
+        # Per-tenant finance dashboard rollups (services/finance_rollups.py)
+        ensure_rollup_tables(cur)
+        # Telematics position store + poll claim row (services/telematics_poller.py)
+        ensure_position_tables(cur)
+        # Background PDF render jobs (services/pdf_jobs.py)
+        ensure_pdf_job_table(cur)
+        # Overdue statement runs (services/statement_mailer.py)
+        ensure_statement_tables(cur)
+        # Background bulk import jobs (services/bulk_import.py)
+        ensure_import_tables(cur)
+        conn.commit(); invalidate_material_meta(); flash("✅ Indexes Created Successfully")
+    except Exception as e: conn.rollback(); flash(f"❌ Error: {e}")
+    finally: conn.close()
+    return redirect(url_for('admin.super_admin_dashboard'))
+
+# --- DIAGNOSTICS: DB CONNECTION POOL ---
+@admin_bp.route('/admin/db-pool')
+def db_pool_status():
+    if session.get('role') != 'SuperAdmin': return "Access Denied", 403
+    # Stats are per gunicorn worker (see 'pid')
+    return jsonify(get_pool_stats())
+
+@admin_bp.route('/admin/telematics-metrics')
+def telematics_metrics():
+    if session.get('role') != 'SuperAdmin': return "Access Denied", 403
+    # Poll interval, position lag and provider error rate (see services/telematics_poller.py)
+    conn = get_db(); cur = conn.cursor()
+    metrics = get_poller_metrics(cur)
+    conn.close()
+    return jsonify(metrics)
+
+@admin_bp.route('/admin/email-queue-metrics')
+def email_queue_metrics():
+    if session.get('role') != 'SuperAdmin': return "Access Denied", 403
+    # Outbox depth, retry / failure counts and SMTP session reuse (see services/email_queue.py)
+    conn = get_db(); cur = conn.cursor()
+    metrics = get_email_queue_metrics(cur)
+    conn.close()
+    return jsonify(metrics)
+
 @admin_bp.route('/admin/audit-logs')
 def view_audit_logs():
     page = request.args.get('page', 1, type=int)
@@ -745,6 +829,9 @@ def global_nuclear_reset():
         # Clear Service Desk
         cur.execute("DELETE FROM service_requests")
 
+        # Every tenant's invoice rollups are now wrong
+        invalidate_rollups(cur)
+
         conn.commit()
         flash("🌍 GLOBAL RESET SUCCESSFUL: All Jobs, Quotes, and Invoices have been wiped system-wide.", "success")
         
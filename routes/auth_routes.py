@@ -2,6 +2,8 @@ from flask import Blueprint, render_template, request, session, redirect, url_fo
 import stripe
 import os
 from db import get_db
+from services.settings_cache import invalidate_settings
+from services.tenant_cache import invalidate_tenant
 from werkzeug.security import check_password_hash, generate_password_hash
 from email_service import send_company_email
 
@@ -394,6 +396,9 @@ def create_pending_account(data):
         cur.executemany("INSERT INTO settings (company_id, key, value) VALUES (%s, %s, %s)", settings)
 
         conn.commit()
+        invalidate_settings(company_id)
+        # The subdomain may have been cached as "unknown" before signup
+        invalidate_tenant(data['sub_domain'] or '')
         return company_id
 
     except Exception as e:
@@ -1,5 +1,8 @@
-from flask import Blueprint, render_template, session, redirect, url_for, request, flash, jsonify
+from flask import Blueprint, render_template, session, redirect, url_for, request, flash, jsonify, Response
 from db import get_db, get_site_config
+from services.settings_cache import get_settings
+from services.telematics_poller import read_positions
+from services.live_updates import event_stream, SSE_HEADERS
 from datetime import date, datetime
 
 try:
@@ -8,11 +11,6 @@ except ImportError:
     # Fallback if service missing
     def check_limit(comp_id, limit_type): return True, ""
 
-try:
-    from telematics_engine import get_tracker_data
-except ImportError:
-    get_tracker_data = None
-
 client_bp = Blueprint('client', __name__)
 
 # =========================================================
@@ -360,13 +358,22 @@ def track_job(job_ref):
     tracker_url = row[7]
     comp_id = row[8]
 
-    cur.execute("SELECT key, value FROM settings WHERE company_id = %s", (comp_id,))
-    settings = {r[0]: r[1] for r in cur.fetchall()}
+    settings = get_settings(comp_id)
 
     telematics = None
-    if tracker_url and get_tracker_data:
+    if tracker_url:
         api_key = settings.get('samsara_api_key')
-        telematics = get_tracker_data(tracker_url, api_key=api_key)
+        telematics = read_positions(cur, comp_id, [tracker_url], api_key=api_key).get(tracker_url)
 
     conn.close()
-    return render_template('public/track_job.html', job=job_data, engineer=engineer_data, telematics=telematics, settings=settings)
\ No newline at end of file
+    return render_template('public/track_job.html', job=job_data, engineer=engineer_data, telematics=telematics, settings=settings)
+
+@client_bp.route('/track/<job_ref>/live')
+def track_job_live(job_ref):
+    # Server-sent events for this one job: status + van position (see services/live_updates.py)
+    conn = get_db(); cur = conn.cursor()
+    cur.execute("SELECT 1 FROM jobs WHERE ref = %s", (job_ref,))
+    found = cur.fetchone()
+    conn.close()
+    if not found: return "Job not found", 404
+    return Response(event_stream(('job', job_ref)), mimetype='text/event-stream', headers=SSE_HEADERS)
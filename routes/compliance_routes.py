@@ -1,8 +1,8 @@
-from flask import Blueprint, request, jsonify, session
+from flask import Blueprint, request, jsonify, session, current_app, url_for
 from db import get_db
 import json
 from datetime import date
-from services.pdf_generator import generate_pdf 
+from services.pdf_jobs import submit_pdf
 
 compliance_bp = Blueprint('compliance', __name__)
 
@@ -87,8 +87,6 @@ def save_gas_cert():
             'signature_url': data.get('signature_img'), 
             'today': date.today().strftime('%d/%m/%Y')
         }
-        # Note: This calls your PDF service
-        generate_pdf('office/certs/uk/cp12.html', pdf_context, filename)
         
         # 4. THE "ISSUED" LOGIC (Updates Property Table)
         # Gas safety is valid for 1 year
@@ -97,8 +95,15 @@ def save_gas_cert():
             cur.execute("UPDATE properties SET gas_expiry = %s WHERE id = %s AND company_id = %s", (next_due, prop_id, comp_id))
             
         conn.commit(); conn.close()
+
+        # Rendered in the background PDF pool once the save is committed (see services/pdf_jobs.py)
+        job_id = submit_pdf(comp_id, 'cp12', 'office/certs/uk/cp12.html', pdf_context, filename,
+                            current_app.static_folder, current_app.root_path)
         
-        return jsonify({'success': True, 'redirect_url': '/office-hub'})
+        return jsonify({
+            'success': True, 'redirect_url': '/office-hub',
+            'pdf_job_id': job_id, 'pdf_status_url': url_for('pdf.pdf_job_status', job_id=job_id)
+        })
 
     except Exception as e:
         print(f"Gas Save Error: {e}")
@@ -1,4 +1,4 @@
-from flask import Blueprint, render_template, request, session, redirect, url_for, flash, get_flashed_messages, send_file, Response, make_response, current_app, jsonify
+from flask import Blueprint, render_template, request, session, redirect, url_for, flash, get_flashed_messages, send_file, Response, make_response, current_app, jsonify, stream_with_context
 from services.enforcement import check_limit
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash
@@ -6,22 +6,24 @@ import secrets
 import string
 import os
 import csv
+import math
 import shutil
 from services.tax_engine import TaxEngine
-from io import TextIOWrapper
+from io import TextIOWrapper, StringIO
 from datetime import datetime, date, timedelta
 from db import get_db, get_site_config, allowed_file, UPLOAD_FOLDER
-from email_service import send_company_email
-from email.mime.application import MIMEApplication
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from services.pdf_generator import generate_pdf
+from services.settings_cache import get_settings, get_setting, invalidate_settings
+from services.finance_rollups import get_rollups, refresh_rollups, source_total, month_of
+from services.fleet_costs import get_fleet
+from services.email_queue import enqueue_email
+from services.material_import import import_materials_csv
+from services.material_search import search_materials, resolve_materials
+from services.price_book import invalidate_price_book
+from services.bulk_import import (IMPORT_TYPES, IMPORT_BACKGROUND_BYTES, spool_upload, import_file,
+                                  start_import_job, get_import_job)
+from services.pdf_generator import render_pdf_bytes
 from flask import send_file
-try:
-    from telematics_engine import get_tracker_data
-except ImportError:
-    get_tracker_data = None
+from services.telematics_poller import read_positions
 
 finance_bp = Blueprint('finance', __name__)
 
@@ -35,11 +37,7 @@ COUNTRY_FORMATS = {
 # --- HELPER: GET COMPANY DATE FORMAT ---
 def get_date_fmt_str(company_id):
     try:
-        conn = get_db(); cur = conn.cursor()
-        cur.execute("SELECT value FROM settings WHERE company_id = %s AND key = 'company_country'", (company_id,))
-        row = cur.fetchone()
-        conn.close()
-        country = row[0] if row else 'Default'
+        country = get_setting(company_id, 'company_country', 'Default')
         return COUNTRY_FORMATS.get(country, COUNTRY_FORMATS['Default'])
     except:
         return COUNTRY_FORMATS['Default']
@@ -74,8 +72,7 @@ def finance_invoices():
     date_fmt = get_date_fmt_str(company_id)
 
     # 1. Get Currency
-    cur.execute("SELECT value FROM settings WHERE key='currency_symbol' AND company_id=%s", (company_id,))
-    res = cur.fetchone(); currency = res[0] if res else '£'
+    currency = get_setting(company_id, 'currency_symbol', '£')
 
     # 2. Fetch Invoices
     cur.execute("""
@@ -196,86 +193,19 @@ def finance_fleet():
     # --- GET REQUEST (DISPLAY DATA) ---
     
     # Fetch API Key for Telematics
-    cur.execute("SELECT value FROM settings WHERE company_id = %s AND key = 'samsara_api_key'", (comp_id,))
-    row = cur.fetchone()
-    company_api_key = row[0] if row else None
+    company_api_key = get_setting(comp_id, 'samsara_api_key')
 
-    # Fetch Vehicles
-    cur.execute("""
-        SELECT v.id, v.reg_plate, v.make_model, v.daily_cost, v.status, 
-               v.assigned_driver_id, s.name as driver_name, 
-               v.tracker_url, 
-               v.mot_expiry, v.tax_expiry, v.ins_expiry, v.service_expiry
-        FROM vehicles v
-        LEFT JOIN staff s ON v.assigned_driver_id = s.id
-        WHERE v.company_id = %s
-        ORDER BY v.reg_plate
-    """, (comp_id,))
-    
-    vehicles_raw = cur.fetchall()
-    vehicles = []
+    # Fetch Vehicles + Driver + Crew + Gang Cost (one query)
+    vehicles = get_fleet(cur, comp_id)
     
     # Fetch All Staff (For Dropdowns)
     cur.execute("SELECT id, name FROM staff WHERE company_id = %s ORDER BY name", (comp_id,))
     all_staff = [{'id': r[0], 'name': r[1]} for r in cur.fetchall()]
     
-    for r in vehicles_raw:
-        v_id = r[0]
-        daily_cost = r[3] or 0.0
-        tracker_url = r[7]
-
-        # 1. Calculate Crew Costs (Using correct plural table: vehicle_crews)
-        cur.execute("""
-            SELECT s.name, s.pay_rate, s.pay_model 
-            FROM vehicle_crews vc
-            JOIN staff s ON vc.staff_id = s.id
-            WHERE vc.vehicle_id = %s
-        """, (v_id,))
-        crew = cur.fetchall()
-        
-        total_wages = 0
-        crew_list = []
-        for c in crew:
-            name, rate, model = c
-            if model == 'Hour': total_wages += (float(rate or 0) * 8)
-            elif model == 'Day': total_wages += float(rate or 0)
-            elif model == 'Year': total_wages += (float(rate or 0) / 260)
-            crew_list.append({'name': name})
-            
-        # Add Driver Cost
-        if r[5]: # If assigned_driver_id exists
-            cur.execute("SELECT pay_rate, pay_model FROM staff WHERE id = %s", (r[5],))
-            d_row = cur.fetchone()
-            if d_row:
-                d_rate, d_model = d_row
-                if d_model == 'Hour': total_wages += (float(d_rate or 0) * 8)
-                elif d_model == 'Day': total_wages += float(d_rate or 0)
-                elif d_model == 'Year': total_wages += (float(d_rate or 0) / 260)
-
-        total_daily_run = float(daily_cost) + float(total_wages)
-
-        # Telematics Logic
-        telematics_data = None
-        if tracker_url and get_tracker_data:
-            telematics_data = get_tracker_data(tracker_url, api_key=company_api_key)
-
-        vehicles.append({
-            'id': v_id,
-            'reg_plate': r[1],      # Corrected key
-            'make_model': r[2],
-            'daily_cost': daily_cost,
-            'status': r[4],
-            'assigned_driver_id': r[5],
-            'driver_name': r[6],
-            'tracker_url': tracker_url,
-            'mot_expiry': r[8], 
-            'tax_expiry': r[9], 
-            'ins_expiry': r[10], 
-            'service_expiry': r[11], # Added Service Date
-            'crew': crew_list,
-            'total_gang_cost': total_daily_run,
-            'telematics': telematics_data
-        })
+    # Telematics Logic (positions kept fresh by the background poller)
+    positions = read_positions(cur, comp_id, [v['tracker_url'] for v in vehicles], api_key=company_api_key)
+    for v in vehicles:
+        v['telematics'] = positions.get(v['tracker_url'])
 
     conn.close()
     
@@ -381,6 +311,7 @@ def delete_supplier(id):
         cur.execute("UPDATE materials SET supplier_id = NULL WHERE supplier_id = %s", (id,))
         cur.execute("DELETE FROM suppliers WHERE id = %s", (id,))
         conn.commit()
+        invalidate_price_book(session.get('company_id'))
         flash("✅ Supplier deleted.")
     except Exception as e:
         conn.rollback()
@@ -392,131 +323,207 @@ def delete_supplier(id):
 
 @finance_bp.route('/finance/materials/import', methods=['POST'])
 def import_materials():
-    if 'file' in request.files:
-        file = request.files['file']
-        supplier_id = request.form.get('supplier_id')
-        
-        if file and file.filename.endswith('.csv'):
-            conn = get_db(); cur = conn.cursor()
-            try:
-                csv_file = TextIOWrapper(file, encoding='utf-8')
-                csv_reader = csv.reader(csv_file)
-                next(csv_reader, None) # Skip Header
-                
-                count = 0
-                for row in csv_reader:
-                    if len(row) >= 2: 
-                        sku = row[0]
-                        name = row[1]
-                        cat = row[2] if len(row) > 2 else 'General'
-                        unit = row[3] if len(row) > 3 else 'Each'
-                        cost = row[4] if len(row) > 4 else 0.00
-                        
-                        cur.execute("""
-                            INSERT INTO materials (company_id, sku, name, category, unit, cost_price, supplier_id) 
-                            VALUES (%s, %s, %s, %s, %s, %s, %s)
-                        """, (session.get('company_id'), sku, name, cat, unit, cost, supplier_id))
-                        count += 1
-                
-                conn.commit()
-                flash(f"✅ Imported {count} items successfully.")
-            except Exception as e:
-                conn.rollback()
-                flash(f"❌ Import Error: {e}")
-            finally:
-                conn.close()
-                
-    return redirect(url_for('finance.finance_materials'))
+    if session.get('role') not in ['Admin', 'SuperAdmin']: return redirect(url_for('auth.login'))
+    wants_json = request.accept_mimetypes.best == 'application/json'
+
+    file = request.files.get('file')
+    if not file or not file.filename.lower().endswith('.csv'):
+        if wants_json: return jsonify({'error': 'Upload a .csv file'}), 400
+        flash("❌ Please upload a .csv file.")
+        return redirect(url_for('finance.finance_materials'))
+
+    try: supplier_id = int(request.form.get('supplier_id') or 0) or None
+    except ValueError: supplier_id = None
+
+    comp_id = session.get('company_id')
+    conn = get_db(); cur = conn.cursor()
+    try:
+        # utf-8-sig: Excel puts a BOM in front of the header
+        report = import_materials_csv(cur, comp_id, supplier_id, TextIOWrapper(file.stream, encoding='utf-8-sig', newline=''))
+        conn.commit()
+        invalidate_price_book(comp_id)
+    except Exception as e:
+        conn.rollback()
+        if wants_json: return jsonify({'error': f"Import Error: {e}"}), 500
+        flash(f"❌ Import Error: {e}")
+        return redirect(url_for('finance.finance_materials'))
+    finally:
+        conn.close()
+
+    if wants_json: return jsonify(report)
+    flash(f"✅ Imported {report['inserted']} new and updated {report['updated']} existing items"
+          + (f" - {report['rejected']} rows skipped." if report['rejected'] else "."))
+    if not report['errors']:
+        return redirect(url_for('finance.finance_materials'))
+    config = get_site_config(comp_id)
+    return render_template('finance/material_import_report.html', report=report,
+                           brand_color=config['color'], logo_url=config['logo'])
 
 @finance_bp.route('/finance/materials/delete/<int:id>')
 def delete_material(id):
     conn = get_db(); cur = conn.cursor(); cur.execute("DELETE FROM materials WHERE id=%s", (id,)); conn.commit(); conn.close()
+    invalidate_price_book(session.get('company_id'))
     return redirect(url_for('finance.finance_materials'))
 
 @finance_bp.route('/api/materials/search')
 def search_materials_api():
     if 'user_id' not in session: return jsonify([])
     
-    query = request.args.get('q', '').lower()
-    if not query: return jsonify([])
+    query = request.args.get('q', '')
+    if not query.strip(): return jsonify([])
 
-    comp_id = session.get('company_id')
     conn = get_db()
     cur = conn.cursor()
-    
     try:
-        try:
-            cur.execute("SELECT 1 FROM materials WHERE company_id=%s LIMIT 1", (comp_id,))
-            cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name='materials'")
-            columns = [row[0] for row in cur.fetchall()]
-            price_col = 'cost_price' if 'cost_price' in columns else 'price'
-        except:
-            price_col = 'cost_price' 
-            conn.rollback()
+        return jsonify(search_materials(cur, session.get('company_id'), query))
+    except Exception as e:
+        print(f"❌ Material Search Error: {e}")
+        conn.rollback()
+        return jsonify([])
+    finally:
+        conn.close()
 
-        sql = f"""
-            SELECT m.name, s.name, COALESCE(m.{price_col}, 0), m.sku 
-            FROM materials m 
-            LEFT JOIN suppliers s ON m.supplier_id = s.id 
-            WHERE m.company_id = %s AND LOWER(m.name) LIKE %s 
-            ORDER BY m.name ASC 
-            LIMIT 10
-        """
-        cur.execute(sql, (comp_id, f"%{query}%"))
-        
-        results = []
-        for r in cur.fetchall():
-            results.append({
-                'name': r[0], 
-                'supplier': r[1] or 'Generic', 
-                'cost': float(r[2]), 
-                'sku': r[3]
-            })
-            
-        return jsonify(results)
+@finance_bp.route('/api/materials/lookup', methods=['POST'])
+def lookup_materials_api():
+    # Batch resolve a shopping list: {"names": ["Fence Post", ...]} -> {name: match or null}
+    if 'user_id' not in session: return jsonify({'error': 'Unauthorized'}), 401
 
+    data = request.get_json(silent=True) or {}
+    names = [str(n).strip() for n in (data.get('names') or []) if str(n).strip()][:500]
+    if not names: return jsonify({})
+
+    conn = get_db()
+    cur = conn.cursor()
+    try:
+        found = resolve_materials(cur, session.get('company_id'), names, fuzzy=data.get('fuzzy', True) is not False)
+        return jsonify({name: found.get(name) for name in names})
     except Exception as e:
+        print(f"❌ Material Lookup Error: {e}")
         conn.rollback()
-        return jsonify([])
+        return jsonify({'error': 'Lookup failed'}), 500
     finally:
         conn.close()
 
+# --- JOB PROFITABILITY (ONE SET-BASED QUERY) ---
+# Revenue, expenses and labour are aggregated per job in CTEs and LEFT JOINed
+# back onto the job list, instead of 3 queries per job.
+ANALYSIS_PER_PAGE = 50
+ANALYSIS_SORTS = {
+    'date': 'start_date DESC NULLS LAST, id DESC',
+    'margin': 'margin DESC, id DESC',
+    'margin_asc': 'margin ASC, id DESC',
+    'profit': 'profit DESC, id DESC',
+    'revenue': 'revenue DESC, id DESC',
+}
+
+def job_profitability_sql(sort='date', paged=True):
+    order_by = ANALYSIS_SORTS.get(sort, ANALYSIS_SORTS['date'])
+    return f"""
+        WITH job_list AS (
+            SELECT j.id, j.ref, c.name AS client, j.status, j.start_date
+            FROM jobs j
+            JOIN clients c ON j.client_id = c.id
+            WHERE j.company_id = %(comp_id)s AND j.status IN ('Completed', 'In Progress')
+        ),
+        rev AS (
+            SELECT i.job_id, SUM(i.total) AS amount
+            FROM invoices i JOIN job_list jl ON jl.id = i.job_id
+            WHERE i.status != 'Void'
+            GROUP BY i.job_id
+        ),
+        exp AS (
+            SELECT e.job_id, SUM(e.cost) AS amount
+            FROM job_expenses e JOIN job_list jl ON jl.id = e.job_id
+            GROUP BY e.job_id
+        ),
+        lab AS (
+            SELECT t.job_id, SUM(t.total_hours * s.pay_rate) AS amount
+            FROM staff_timesheets t
+            JOIN staff s ON t.staff_id = s.id
+            JOIN job_list jl ON jl.id = t.job_id
+            GROUP BY t.job_id
+        ),
+        analysis AS (
+            SELECT jl.id, jl.ref, jl.client, jl.status, jl.start_date,
+                   COALESCE(rev.amount, 0) AS revenue,
+                   COALESCE(exp.amount, 0) AS expenses,
+                   COALESCE(lab.amount, 0) AS labour
+            FROM job_list jl
+            LEFT JOIN rev ON rev.job_id = jl.id
+            LEFT JOIN exp ON exp.job_id = jl.id
+            LEFT JOIN lab ON lab.job_id = jl.id
+        ),
+        scored AS (
+            SELECT *, expenses + labour AS cost, revenue - expenses - labour AS profit,
+                   CASE WHEN revenue > 0 THEN (revenue - expenses - labour) / revenue * 100 ELSE 0 END AS margin
+            FROM analysis
+        )
+        SELECT id, ref, client, status, revenue, expenses, labour, cost, profit, margin,
+               COUNT(*) OVER () AS total_jobs, SUM(revenue) OVER () AS total_rev, SUM(cost) OVER () AS total_cost
+        FROM scored
+        ORDER BY {order_by}
+        {"LIMIT %(limit)s OFFSET %(offset)s" if paged else ""}
+    """
+
 @finance_bp.route('/finance/analysis')
 def finance_analysis():
     if session.get('role') not in ['Admin', 'SuperAdmin']: return redirect(url_for('auth.login'))
     comp_id = session.get('company_id'); config = get_site_config(comp_id)
-    conn = get_db(); cur = conn.cursor()
-
-    cur.execute("""
-        SELECT j.id, j.ref, c.name, j.status FROM jobs j
-        JOIN clients c ON j.client_id = c.id
-        WHERE j.company_id = %s AND j.status IN ('Completed', 'In Progress')
-        ORDER BY j.start_date DESC
-    """, (comp_id,))
-    jobs_raw = cur.fetchall()
+    sort = request.args.get('sort', 'date')
+    if sort not in ANALYSIS_SORTS: sort = 'date'
+    page = max(request.args.get('page', 1, type=int), 1)
 
-    analyzed, total_rev, total_cost = [], 0, 0
+    conn = get_db(); cur = conn.cursor()
+    cur.execute(job_profitability_sql(sort), {
+        'comp_id': comp_id, 'limit': ANALYSIS_PER_PAGE, 'offset': (page - 1) * ANALYSIS_PER_PAGE
+    })
+    rows = cur.fetchall()
+    conn.close()
 
-    for job in jobs_raw:
-        job_id, ref, client, status = job
-        cur.execute("SELECT COALESCE(SUM(total), 0) FROM invoices WHERE job_id=%s AND status!='Void'", (job_id,))
-        revenue = float(cur.fetchone()[0])
+    if not rows and page > 1:
+        return redirect(url_for('finance.finance_analysis', sort=sort))
 
-        cur.execute("SELECT COALESCE(SUM(cost), 0) FROM job_expenses WHERE job_id=%s", (job_id,))
-        expenses = float(cur.fetchone()[0])
-        
-        cur.execute("SELECT COALESCE(SUM(t.total_hours * s.pay_rate), 0) FROM staff_timesheets t JOIN staff s ON t.staff_id=s.id WHERE t.job_id=%s", (job_id,))
-        labor = float(cur.fetchone()[0]) if cur.rowcount > 0 else 0.0
+    analyzed = [{"ref": r[1], "client": r[2], "status": r[3], "rev": float(r[4]), "cost": float(r[7]),
+                 "profit": float(r[8]), "margin": float(r[9])} for r in rows]
 
-        actual_cost = expenses + labor; profit = revenue - actual_cost
-        margin = (profit / revenue * 100) if revenue > 0 else 0.0
-        total_rev += revenue; total_cost += actual_cost
-        analyzed.append({"ref": ref, "client": client, "status": status, "rev": revenue, "cost": actual_cost, "profit": profit, "margin": margin})
-    
-    conn.close()
+    # Window totals cover every job, not just this page
+    total_jobs = rows[0][10] if rows else 0
+    total_rev = float(rows[0][11] or 0) if rows else 0.0
+    total_cost = float(rows[0][12] or 0) if rows else 0.0
     total_profit = total_rev - total_cost
     avg_margin = (total_profit / total_rev * 100) if total_rev > 0 else 0
-    return render_template('finance/finance_analysis.html', jobs=analyzed, total_rev=total_rev, total_cost=total_cost, total_profit=total_profit, avg_margin=avg_margin, brand_color=config['color'], logo_url=config['logo'])
+    total_pages = max(math.ceil(total_jobs / ANALYSIS_PER_PAGE), 1)
+
+    return render_template('finance/finance_analysis.html', jobs=analyzed, total_rev=total_rev, total_cost=total_cost, total_profit=total_profit, avg_margin=avg_margin,
+                           page=page, total_pages=total_pages, sort=sort, total_jobs=total_jobs,
+                           brand_color=config['color'], logo_url=config['logo'])
+
+@finance_bp.route('/finance/analysis/export')
+def export_finance_analysis():
+    if session.get('role') not in ['Admin', 'SuperAdmin']: return redirect(url_for('auth.login'))
+    comp_id = session.get('company_id')
+    sort = request.args.get('sort', 'date')
+
+    def generate():
+        conn = get_db()
+        # Server-side cursor: rows are pulled from Postgres in batches, never all in memory
+        cur = conn.cursor(name='job_profitability_export')
+        cur.itersize = 2000
+        try:
+            cur.execute(job_profitability_sql(sort, paged=False), {'comp_id': comp_id})
+            buf = StringIO(); writer = csv.writer(buf)
+            writer.writerow(['Job Ref', 'Client', 'Status', 'Revenue', 'Expenses', 'Labour', 'Total Cost', 'Profit', 'Margin %'])
+            for i, r in enumerate(cur, 1):
+                writer.writerow([r[1], r[2], r[3], f"{r[4]:.2f}", f"{r[5]:.2f}", f"{r[6]:.2f}", f"{r[7]:.2f}", f"{r[8]:.2f}", f"{r[9]:.1f}"])
+                if i % 500 == 0:
+                    yield buf.getvalue(); buf.seek(0); buf.truncate(0)
+            yield buf.getvalue()
+        finally:
+            cur.close(); conn.close()
+
+    filename = f"job_profitability_{date.today().isoformat()}.csv"
+    return Response(stream_with_context(generate()), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
     
 @finance_bp.route('/finance/settings')
 def settings_redirect(): return redirect(url_for('finance.settings_general'))
@@ -573,15 +580,17 @@ def settings_general():
                     session['logo'] = web_path
 
             conn.commit()
+            session.pop('currency_symbol', None)
             flash("✅ Settings Saved & Sidebar Updated")
             
         except Exception as e:
             conn.rollback()
             flash(f"Error saving settings: {e}")
+        finally:
+            invalidate_settings(comp_id)
 
-    cur.execute("SELECT key, value FROM settings WHERE company_id = %s", (comp_id,))
-    settings = {row[0]: row[1] for row in cur.fetchall()}
     conn.close()
+    settings = get_settings(comp_id)
 
     return render_template('finance/settings_general.html', settings=settings, active_tab='general')
 
@@ -622,11 +631,11 @@ def settings_banking():
                  """, (comp_id, f"/static/uploads/logos/{fn}"))
         
         conn.commit()
+        invalidate_settings(comp_id)
         flash("Saved")
         
-    cur.execute("SELECT key, value FROM settings WHERE company_id = %s", (comp_id,))
-    settings = {row[0]: row[1] for row in cur.fetchall()}
     conn.close()
+    settings = get_settings(comp_id)
     
     return render_template('finance/settings_banking.html', settings=settings, active_tab='banking', brand_color=config['color'], logo_url=config['logo'])
 
@@ -640,8 +649,9 @@ def settings_overheads():
         elif act == 'add_item': cur.execute("INSERT INTO overhead_items (category_id, name, amount) VALUES (%s, %s, %s)", (request.form.get('category_id'), request.form.get('item_name'), request.form.get('item_cost')))
         elif act == 'delete_item': cur.execute("DELETE FROM overhead_items WHERE id = %s", (request.form.get('item_id'),))
         elif act == 'delete_category': cur.execute("DELETE FROM overhead_categories WHERE id = %s AND company_id = %s", (request.form.get('category_id'), comp_id))
+        if act in ('add_item', 'delete_item', 'delete_category'): refresh_rollups(cur, comp_id, 'overheads')
         conn.commit()
-    cur.execute("SELECT key, value FROM settings WHERE company_id = %s", (comp_id,)); settings = {row[0]: row[1] for row in cur.fetchall()}
+    settings = get_settings(comp_id)
     cur.execute("SELECT id, name FROM overhead_categories WHERE company_id = %s ORDER BY id ASC", (comp_id,)); cats = cur.fetchall()
     class CO:
         def __init__(self, i, n, it, t): self.id=i; self.name=n; self.items=it; self.total=t
@@ -668,6 +678,7 @@ def setup_invoice_templates():
         """, (session.get('company_id'),))
         
         conn.commit()
+        invalidate_settings(session.get('company_id'))
         return "✅ Database Updated: Template support added. You can now use the settings page."
     except Exception as e:
         conn.rollback()
@@ -700,8 +711,7 @@ def email_invoice(invoice_id):
     client_email = inv[6]
     invoice_ref = inv[1]
 
-    cur.execute("SELECT key, value FROM settings WHERE company_id = %s", (company_id,))
-    settings = {row[0]: row[1] for row in cur.fetchall()}
+    settings = get_settings(company_id)
     
     if 'smtp_host' not in settings:
         conn.close(); flash("⚠️ SMTP Settings missing.", "warning")
@@ -736,32 +746,20 @@ def email_invoice(invoice_id):
     filename = f"Invoice_{invoice_ref}.pdf"
     
     try:
-        pdf_path = generate_pdf('finance/pdf_invoice_template.html', context, filename)
-        
-        msg = MIMEMultipart()
-        msg['From'] = settings.get('smtp_email')
-        msg['To'] = client_email
-        msg['Subject'] = f"Invoice {invoice_ref} from {session.get('company_name')}"
+        # Rendered in memory: an emailed copy doesn't need to live in uploads/documents
+        pdf_bytes = render_pdf_bytes('finance/pdf_invoice_template.html', context)
         
+        subject = f"Invoice {invoice_ref} from {session.get('company_name')}"
         body = f"Dear {inv[5]},\n\nPlease find attached invoice {invoice_ref}.\n\nTotal Due: {settings.get('currency_symbol','£')}{total_val:.2f}\n\nKind regards,\n{session.get('company_name')}"
-        msg.attach(MIMEText(body, 'plain'))
-        
-        with open(pdf_path, "rb") as f:
-            part = MIMEApplication(f.read(), Name=filename)
-            part['Content-Disposition'] = f'attachment; filename="{filename}"'
-            msg.attach(part)
-
-        server = smtplib.SMTP(settings['smtp_host'], int(settings.get('smtp_port', 587)))
-        server.starttls()
-        server.login(settings['smtp_email'], settings['smtp_password'])
-        server.send_message(msg)
-        server.quit()
-        
-        cur.execute("UPDATE invoices SET status = 'Sent' WHERE id = %s", (invoice_id,))
+
+        # Sent by the outbound queue, which marks the invoice 'Sent' once delivered
+        enqueue_email(cur, company_id, client_email, subject, body, body_type='plain',
+                      attachments=[(filename, pdf_bytes)], ref=('invoice', invoice_id))
         conn.commit()
-        flash(f"✅ Invoice emailed to {client_email}!", "success")
+        flash(f"📤 Invoice queued for sending to {client_email}.", "success")
 
     except Exception as e:
+        conn.rollback()
         flash(f"❌ Email Error: {e}", "error")
     
     conn.close()
@@ -772,7 +770,9 @@ def mark_invoice_sent(invoice_id):
     if session.get('role') not in ['Admin', 'SuperAdmin', 'Finance', 'Office']: return redirect(url_for('auth.login'))
     
     conn = get_db(); cur = conn.cursor()
-    cur.execute("UPDATE invoices SET status = 'Sent' WHERE id = %s", (invoice_id,))
+    cur.execute("UPDATE invoices SET status = 'Sent' WHERE id = %s RETURNING date", (invoice_id,))
+    row = cur.fetchone()
+    if row: refresh_rollups(cur, session.get('company_id'), 'invoices', month_of(row[0]))
     conn.commit(); conn.close()
     
     flash("✅ Invoice manually marked as Sent.", "success")
@@ -786,7 +786,9 @@ def delete_invoice(invoice_id):
     conn = get_db(); cur = conn.cursor()
     try:
         cur.execute("DELETE FROM invoice_items WHERE invoice_id = %s", (invoice_id,))
-        cur.execute("DELETE FROM invoices WHERE id = %s", (invoice_id,))
+        cur.execute("DELETE FROM invoices WHERE id = %s RETURNING date", (invoice_id,))
+        row = cur.fetchone()
+        if row: refresh_rollups(cur, session.get('company_id'), 'invoices', month_of(row[0]))
         conn.commit()
         flash("✅ Invoice deleted successfully.", "success")
     except Exception as e:
@@ -807,28 +809,22 @@ def finance_dashboard():
     conn = get_db()
     cur = conn.cursor()
     
-    cur.execute("SELECT value FROM settings WHERE key='currency_symbol' AND company_id=%s", (comp_id,))
-    res = cur.fetchone()
-    currency = res[0] if res else '£'
+    currency = get_setting(comp_id, 'currency_symbol', '£')
 
-    cur.execute("""
-        SELECT COALESCE(SUM(total), 0) 
-        FROM invoices 
-        WHERE company_id = %s AND status != 'Void'
-    """, (comp_id,))
-    total_income = float(cur.fetchone()[0])
+    # 1. TOTALS + CHART (from the per-month rollups, see services/finance_rollups.py)
+    rollups = get_rollups(cur, comp_id)
+    totals = rollups['totals']
 
-    cur.execute("SELECT COALESCE(SUM(cost), 0) FROM maintenance_logs WHERE company_id = %s", (comp_id,))
-    fleet_cost = float(cur.fetchone()[0])
-    
-    cur.execute("SELECT COALESCE(SUM(amount), 0) FROM overhead_items JOIN overhead_categories c ON overhead_items.category_id = c.id WHERE c.company_id = %s", (comp_id,))
-    monthly_overhead = float(cur.fetchone()[0])
+    total_income = source_total(totals['invoices'], exclude=('Void',))
+    fleet_cost = source_total(totals['fleet'])
+    monthly_overhead = source_total(totals['overheads'])
     
     total_expense = fleet_cost + monthly_overhead
     total_balance = total_income - total_expense
     break_even = (monthly_overhead * 12) / 365 if monthly_overhead > 0 else 0
 
-    query = """
+    # 2. RECENT FEED (tuple shape: date, type, category, description, amount, job_id)
+    cur.execute("""
         (
             SELECT 
                 date_created as date, 
@@ -838,7 +834,7 @@ def finance_dashboard():
                 COALESCE(total, 0) as amount, 
                 job_id
             FROM invoices 
-            WHERE company_id = %s AND status = 'Paid'
+            WHERE company_id = %(comp_id)s AND status = 'Paid'
         )
         UNION ALL
         (
@@ -850,7 +846,7 @@ def finance_dashboard():
                 COALESCE(cost, 0) as amount, 
                 job_id
             FROM job_expenses 
-            WHERE company_id = %s
+            WHERE company_id = %(comp_id)s
         )
         UNION ALL
         (
@@ -862,35 +858,29 @@ def finance_dashboard():
                 COALESCE(amount, 0) as amount,
                 NULL as job_id
             FROM overhead_items 
-            WHERE category_id IN (SELECT id FROM overhead_categories WHERE company_id = %s)
+            WHERE category_id IN (SELECT id FROM overhead_categories WHERE company_id = %(comp_id)s)
         )
         ORDER BY date DESC 
         LIMIT 15
-    """
-    cur.execute(query, (comp_id, comp_id, comp_id))
+    """, {'comp_id': comp_id})
     transactions = cur.fetchall()
 
+    # 3. CHART: last 6 calendar months (income = all invoices dated that month)
     chart_labels = []
     chart_income = []
     chart_expense = []
-    
-    today = date.today()
-    for i in range(5, -1, -1):
-        d = today - timedelta(days=i*30)
-        month_str = d.strftime("%B")
-        chart_labels.append(month_str)
-        
-        cur.execute("""
-            SELECT COALESCE(SUM(total), 0) FROM invoices 
-            WHERE company_id=%s AND EXTRACT(MONTH FROM date)=%s AND EXTRACT(YEAR FROM date)=%s
-        """, (comp_id, d.month, d.year))
-        chart_income.append(float(cur.fetchone()[0]))
-        
-        cur.execute("""
-            SELECT COALESCE(SUM(cost), 0) FROM maintenance_logs 
-            WHERE company_id=%s AND EXTRACT(MONTH FROM date)=%s AND EXTRACT(YEAR FROM date)=%s
-        """, (comp_id, d.month, d.year))
-        chart_expense.append(float(cur.fetchone()[0]) + monthly_overhead)
+
+    month = month_of(date.today())
+    months = []
+    for _ in range(6):
+        months.insert(0, month)
+        month = month_of(month - timedelta(days=1))
+
+    for m in months:
+        bucket = rollups['monthly'].get(m, {})
+        chart_labels.append(m.strftime("%B"))
+        chart_income.append(source_total(bucket.get('invoices', {})))
+        chart_expense.append(source_total(bucket.get('fleet', {})) + monthly_overhead)
 
     cur.execute("""
         SELECT created_at, admin_email, action, details 
@@ -935,12 +925,12 @@ def settings_integrations():
                 ON CONFLICT (company_id, key) DO UPDATE SET value = EXCLUDED.value
             """, (comp_id, k, val))
         conn.commit()
+        invalidate_settings(comp_id)
         flash("✅ Integration Keys Saved")
 
     # Load Settings
-    cur.execute("SELECT key, value FROM settings WHERE company_id = %s", (comp_id,))
-    settings = {row[0]: row[1] for row in cur.fetchall()}
     conn.close()
+    settings = get_settings(comp_id)
 
     return render_template('finance/settings_integrations.html', settings=settings, active_tab='integrations')
     
@@ -953,9 +943,8 @@ def finance_payroll():
     comp_id = session.get('company_id')
     
     # 1. Fetch Config
+    settings = get_settings(comp_id)
     conn = get_db(); cur = conn.cursor()
-    cur.execute("SELECT key, value FROM settings WHERE company_id = %s", (comp_id,))
-    settings = {row[0]: row[1] for row in cur.fetchall()}
     
     country = settings.get('country_code', 'UK') 
     currency = settings.get('currency_symbol', '£')
@@ -1042,68 +1031,53 @@ def settings_import():
     if session.get('role') not in ['Admin', 'SuperAdmin']: return redirect(url_for('auth.login'))
     comp_id = session.get('company_id')
     
+    report, job_id = None, None
     if request.method == 'POST':
         import_type = request.form.get('type')
+        dry_run = request.form.get('dry_run') == '1'
         file = request.files.get('file')
         
-        if file and file.filename.endswith('.csv'):
-            try:
-                stream = TextIOWrapper(file.stream, encoding='utf-8')
-                csv_reader = csv.reader(stream)
-                header = next(csv_reader) # Skip Header
-                
-                conn = get_db(); cur = conn.cursor()
-                count = 0
-                
-                for row in csv_reader:
-                    if not row: continue
-                    
-                    if import_type == 'clients':
-                        # Expects: Name, Email, Phone, Address
-                        if len(row) >= 4:
-                            cur.execute("""
-                                INSERT INTO clients (company_id, name, email, phone, site_address, billing_address, status)
-                                VALUES (%s, %s, %s, %s, %s, %s, 'Active')
-                            """, (comp_id, row[0], row[1], row[2], row[3], row[3]))
-                            count += 1
-
-                    elif import_type == 'staff':
-                        # Expects: Name, Email, Position, Rate
-                        if len(row) >= 4:
-                            rate = float(row[3]) if row[3] else 0.0
-                            cur.execute("""
-                                INSERT INTO staff (company_id, name, email, position, pay_rate, pay_model)
-                                VALUES (%s, %s, %s, %s, %s, 'Hour')
-                            """, (comp_id, row[0], row[1], row[2], rate))
-                            count += 1
-
-                    elif import_type == 'vehicles':
-                        # Expects: Reg, Model, Daily Cost
-                        if len(row) >= 3:
-                            cost = float(row[2]) if row[2] else 0.0
-                            cur.execute("""
-                                INSERT INTO vehicles (company_id, reg_plate, make_model, daily_cost, status)
-                                VALUES (%s, %s, %s, %s, 'Active')
-                            """, (comp_id, row[0], row[1], cost))
-                            count += 1
-                
-                conn.commit()
-                conn.close()
-                flash(f"✅ Successfully imported {count} records.", "success")
-                
-            except Exception as e:
-                flash(f"❌ Import Error: {e}", "error")
+        if import_type not in IMPORT_TYPES:
+            flash("❌ Unknown import type.", "error")
+        elif file and file.filename.lower().endswith('.csv'):
+            path, size = spool_upload(file)
+            conn = get_db(); cur = conn.cursor()
+            if size > IMPORT_BACKGROUND_BYTES:
+                # Big migration: run it off the request, the page polls for progress
+                try:
+                    job_id = start_import_job(cur, comp_id, import_type, path, dry_run=dry_run)
+                    flash(f"⏳ {'Validating' if dry_run else 'Importing'} {import_type} in the background...", "info")
+                except Exception as e:
+                    conn.rollback(); os.unlink(path)
+                    flash(f"❌ Import Error: {e}", "error")
+            else:
+                try:
+                    report = import_file(cur, comp_id, import_type, path, dry_run=dry_run)
+                    if dry_run:
+                        flash("🔎 Validation complete - nothing was saved.", "info")
+                    else:
+                        flash(f"✅ Imported {report['inserted']} new and updated {report['updated']} existing {import_type}.", "success")
+                except Exception as e:
+                    flash(f"❌ Import Error: {e} - nothing was saved.", "error")
+                finally:
+                    os.unlink(path)
         else:
             flash("❌ Invalid file. Please upload a CSV.", "error")
 
     # Load Settings Context (for Layout)
+    settings = get_settings(comp_id)
+
+    return render_template('finance/settings_import.html', settings=settings, active_tab='import', report=report, job_id=job_id)
+    
+@finance_bp.route('/finance/settings/import/jobs/<job_id>')
+def import_job_status(job_id):
+    if session.get('role') not in ['Admin', 'SuperAdmin']: return jsonify({'error': 'Unauthorized'}), 403
     conn = get_db(); cur = conn.cursor()
-    cur.execute("SELECT key, value FROM settings WHERE company_id = %s", (comp_id,))
-    settings = {row[0]: row[1] for row in cur.fetchall()}
+    job = get_import_job(cur, job_id, session.get('company_id'))
     conn.close()
+    if not job: return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
 
-    return render_template('finance/settings_import.html', settings=settings, active_tab='import')
-    
 @finance_bp.route('/finance/bookkeeping', methods=['GET', 'POST'])
 def finance_bookkeeping():
     if session.get('role') not in ['Admin', 'SuperAdmin', 'Finance']:
@@ -1152,6 +1126,7 @@ def finance_bookkeeping():
                     INSERT INTO job_expenses (company_id, job_id, description, cost, date, receipt_path)
                     VALUES (%s, %s, %s, %s, CURRENT_DATE, %s)
                 """, (comp_id, job_id, desc, cost, db_path))
+                refresh_rollups(cur, comp_id, 'job_expenses', month_of(date.today()))
                 flash("✅ Assigned to Job Expense.")
 
             elif action == 'assign_overhead':
@@ -1168,6 +1143,7 @@ def finance_bookkeeping():
                     INSERT INTO overhead_items (category_id, name, amount, date_incurred, receipt_path)
                     VALUES (%s, %s, %s, CURRENT_DATE, %s)
                 """, (cat_id, desc, cost, db_path))
+                refresh_rollups(cur, comp_id, 'overheads')
                 flash("✅ Assigned to Overheads.")
 
             conn.commit()
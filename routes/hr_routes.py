@@ -4,6 +4,7 @@ from flask import Blueprint, render_template, session, redirect, url_for, reques
 from werkzeug.utils import secure_filename
 from werkzeug.security import generate_password_hash
 from db import get_db, get_site_config
+from services.settings_cache import get_setting
 from services.enforcement import check_limit
 import secrets
 import string
@@ -58,9 +59,7 @@ def staff_profile(staff_id):
     cur = conn.cursor()
     
     # Get Currency
-    cur.execute("SELECT value FROM settings WHERE company_id = %s AND key = 'currency_symbol'", (session.get('company_id'),))
-    res = cur.fetchone()
-    currency = res[0] if res else '£'
+    currency = get_setting(session.get('company_id'), 'currency_symbol', '£')
     
     # Get Staff Details
     cur.execute("SELECT * FROM staff WHERE id = %s", (staff_id,))
@@ -176,6 +175,7 @@ def save_staff():
     nok_addr = request.form.get('nok_address')
 
     conn = get_db(); cur = conn.cursor()
+    new_login = None
 
     try:
         # --- HANDLE FILES (License & Photo) ---
@@ -240,12 +240,15 @@ def save_staff():
                 if not cur.fetchone():
                     pw = ''.join(secrets.choice(string.ascii_letters + string.digits) for i in range(12))
                     cur.execute("INSERT INTO users (username, email, password_hash, role, company_id) VALUES (%s, %s, %s, %s, %s)", (email, email, generate_password_hash(pw), access, comp_id))
-                    try: send_company_email(comp_id, email, "Your Login Details", f"<p>Username: {email}</p><p>Password: {pw}</p>")
-                    except: pass
+                    # Sent directly after the commit, never queued: the outbox keeps bodies for days
+                    new_login = (email, pw)
             
             flash("✅ New employee added.")
 
         conn.commit()
+        if new_login:
+            try: send_company_email(comp_id, new_login[0], "Your Login Details", f"<p>Username: {new_login[0]}</p><p>Password: {new_login[1]}</p>")
+            except Exception as e: print(f"❌ Login Email Error: {e}")
     except Exception as e:
         conn.rollback()
         flash(f"Error: {e}")
@@ -1,5 +1,6 @@
 from flask import Blueprint, render_template, session, redirect, url_for, flash, request
 from db import get_db
+from services.finance_rollups import refresh_rollups, month_of
 from datetime import date
 
 jobs_bp = Blueprint('jobs', __name__)
@@ -187,6 +188,7 @@ def add_manual_cost(job_ref):
             INSERT INTO job_expenses (company_id, job_id, description, cost, date, receipt_path)
             VALUES (%s, %s, %s, %s, CURRENT_DATE, 'Manual Entry')
         """, (session.get('company_id'), job_id, desc, cost))
+        refresh_rollups(cur, session.get('company_id'), 'job_expenses', month_of(date.today()))
         
         conn.commit()
         flash(f"✅ Added cost: £{cost}", "success")
@@ -212,6 +214,7 @@ def delete_job_item(item_id, item_type):
              flash("⚠️ Cannot delete Invoices from here. Go to Finance > Invoices.", "warning")
         elif 'Expense' in item_type or 'Receipt' in item_type or 'Manual' in item_type:
             cur.execute("DELETE FROM job_expenses WHERE id = %s", (item_id,))
+            refresh_rollups(cur, session.get('company_id'), 'job_expenses')
             flash("🗑️ Expense/Receipt Deleted", "success")
         elif 'Photo' in item_type or 'Evidence' in item_type:
             cur.execute("DELETE FROM job_evidence WHERE id = %s", (item_id,))
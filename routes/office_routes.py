@@ -1,5 +1,9 @@
-from flask import Blueprint, render_template, session, redirect, url_for, flash, request, jsonify, send_file
+from flask import Blueprint, render_template, session, redirect, url_for, flash, request, jsonify, send_file, Response
 from db import get_db, get_site_config
+from services.settings_cache import get_setting
+from services.finance_rollups import refresh_rollups
+from services.fleet_costs import get_fleet
+from services.live_updates import event_stream, SSE_HEADERS, load_fleet
 from datetime import datetime, date, timedelta
 from services.enforcement import check_limit
 import json
@@ -37,9 +41,7 @@ def office_dashboard():
     conn = get_db(); cur = conn.cursor()
 
     # --- GET SETTINGS ---
-    cur.execute("SELECT value FROM settings WHERE company_id = %s AND key = 'date_format'", (comp_id,))
-    row = cur.fetchone()
-    user_date_fmt = row[0] if row and row[0] else '%d/%m/%Y'
+    user_date_fmt = get_setting(comp_id, 'date_format', '%d/%m/%Y')
 
     # --- HELPER: Date Formatter ---
     def process_date(date_val, fmt):
@@ -259,13 +261,18 @@ def live_ops():
             'van': r[9], 'status': status
         })
 
-    cur.execute("SELECT id, reg_plate, make_model, assigned_driver_id, tracker_url FROM vehicles WHERE company_id = %s", (comp_id,))
-    fleet = []
-    for v in cur.fetchall():
-        fleet.append({'id': v[0], 'reg': v[1], 'model': v[2], 'driver_id': v[3], 'tracker_url': v[4]})
+    # Vans with a known position (same payload the live stream pushes)
+    fleet = list(load_fleet(cur, comp_id).values())
 
     conn.close()
     return render_template('office/live_ops.html', staff=staff_status, all_staff=staff_status, fleet=fleet, brand_color=config['color'], logo_url=config['logo'])
+
+@office_bp.route('/office/live-ops/stream')
+def live_ops_stream():
+    # Server-sent events: van position deltas for this company (see services/live_updates.py)
+    if not check_office_access(): return "Unauthorized", 403
+    comp_id = session.get('company_id')
+    return Response(event_stream(('fleet', comp_id)), mimetype='text/event-stream', headers=SSE_HEADERS)
                            
 @office_bp.route('/office/quote/save', methods=['POST'])
 def save_quote():
@@ -554,6 +561,7 @@ def office_fleet():
                     INSERT INTO maintenance_logs (company_id, vehicle_id, date, type, description, cost, receipt_path)
                     VALUES (%s, %s, %s, %s, %s, %s, %s)
                 """, (comp_id, veh_id, l_date, l_type, desc, cost, file_path))
+                refresh_rollups(cur, comp_id, 'fleet')
                 flash("✅ Log entry added.")
 
             conn.commit()
@@ -562,55 +570,32 @@ def office_fleet():
             flash(f"Error: {e}", "error")
 
     # --- FETCH DATA ---
-    cur.execute("""
-        SELECT v.id, v.reg_plate, v.make_model, v.status, 
-               v.assigned_driver_id, s.name, 
-               v.mot_expiry, v.tax_expiry, v.ins_expiry, v.service_expiry
-        FROM vehicles v
-        LEFT JOIN staff s ON v.assigned_driver_id = s.id
-        WHERE v.company_id = %s
-        ORDER BY v.reg_plate
-    """, (comp_id,))
-    
-    vehicles_raw = cur.fetchall()
-    vehicles = []
+    # 1. Vehicles + Driver + Crew (one query)
+    vehicles = get_fleet(cur, comp_id)
     
     # Fetch All Staff for Dropdowns
     cur.execute("SELECT id, name FROM staff WHERE company_id = %s ORDER BY name", (comp_id,))
     all_staff = [{'id': r[0], 'name': r[1]} for r in cur.fetchall()]
 
-    for r in vehicles_raw:
-        v_id = r[0]
-        
-        # 1. Fetch Crew
-        cur.execute("""
-            SELECT s.name FROM vehicle_crews vc
-            JOIN staff s ON vc.staff_id = s.id
-            WHERE vc.vehicle_id = %s
-        """, (v_id,))
-        crew = [{'name': row[0]} for row in cur.fetchall()]
+    # 2. History (Last 5 Logs per Vehicle) - Required for Office View
+    cur.execute("""
+        SELECT vehicle_id, date, type, description, cost, receipt_path
+        FROM (
+            SELECT m.*, ROW_NUMBER() OVER (PARTITION BY m.vehicle_id ORDER BY m.date DESC) AS rn
+            FROM maintenance_logs m
+            JOIN vehicles v ON m.vehicle_id = v.id
+            WHERE v.company_id = %s
+        ) recent
+        WHERE rn <= 5
+        ORDER BY vehicle_id, date DESC
+    """, (comp_id,))
+    history = {}
+    for h in cur.fetchall():
+        history.setdefault(h[0], []).append({'date': h[1], 'type': h[2], 'desc': h[3], 'cost': h[4], 'receipt': h[5]})
 
-        # 2. Fetch History (Logs) - Required for Office View
-        cur.execute("""
-            SELECT date, type, description, cost, receipt_path 
-            FROM maintenance_logs 
-            WHERE vehicle_id = %s 
-            ORDER BY date DESC LIMIT 5
-        """, (v_id,))
-        history = [{'date': h[0], 'type': h[1], 'desc': h[2], 'cost': h[3], 'receipt': h[4]} for h in cur.fetchall()]
-
-        vehicles.append({
-            'id': v_id,
-            'reg_number': r[1],  # Using reg_number here because your fleet_management.html might still use it (check below)
-            'reg_plate': r[1],   # sending both to be safe
-            'make_model': r[2],
-            'status': r[3],
-            'assigned_driver_id': r[4],
-            'driver_name': r[5],
-            'mot_expiry': r[6], 'tax_expiry': r[7], 'ins_expiry': r[8], 'service_expiry': r[9],
-            'crew': crew,
-            'history': history
-        })
+    for v in vehicles:
+        v['reg_number'] = v['reg_plate']  # fleet_management.html still uses reg_number in places
+        v['history'] = history.get(v['id'], [])
 
     conn.close()
     
@@ -1,6 +1,13 @@
-from flask import Blueprint, render_template, session, redirect, url_for, request, send_file, flash, current_app
+from flask import Blueprint, render_template, session, redirect, url_for, request, send_file, flash, current_app, jsonify, Response
 from db import get_db, get_site_config
+from services.settings_cache import get_settings
 from services.pdf_generator import generate_pdf
+from services.pdf_jobs import submit_pdf, get_pdf_job
+from services.pdf_cache import get_or_render_pdf, send_cached_pdf
+from services.pdf_export import stream_pdf_zip, PDF_EXPORT_MAX_DOCS
+from services.statement_mailer import (get_overdue_by_client, get_active_run, start_statement_run,
+                                       get_statement_run, STATEMENT_MAX_INVOICES)
+from email_service import smtp_config
 from datetime import datetime
 import os
 import json
@@ -45,59 +52,56 @@ def get_smart_terms(settings):
     days = settings.get('payment_days', '14')
     return f"Payment is due within {days} days of the invoice date."
 
-@pdf_bp.route('/finance/invoice/<int:invoice_id>/download')
-def download_invoice_pdf(invoice_id):
-    if session.get('role') not in ['Admin', 'SuperAdmin', 'Finance', 'Office']:
-        return redirect(url_for('auth.login'))
-        
-    conn = get_db(); cur = conn.cursor()
-    comp_id = session.get('company_id')
-
-    # 1. Fetch Invoice + Linked Data
-    cur.execute("""
+def build_invoice_pdfs(cur, comp_id, invoice_ids=None, start=None, end=None, status=None):
+    """
+    [(invoice_id, context, filename)] for a set of invoices - by id, or by
+    date range / status for bulk export. Three queries however many invoices
+    (invoice + site address, all line items, company name).
+    """
+    filters = ""
+    params = {'comp_id': comp_id}
+    if invoice_ids is not None:
+        filters += " AND i.id = ANY(%(ids)s)"
+        params['ids'] = list(invoice_ids)
+    if start:
+        filters += " AND i.date >= %(start)s"
+        params['start'] = start
+    if end:
+        filters += " AND i.date <= %(end)s"
+        params['end'] = end
+    if status:
+        filters += " AND i.status = %(status)s"
+        params['status'] = status
+
+    # 1. Fetch Invoices + Linked Data (site = Job's property, else the Quote's)
+    cur.execute(f"""
         SELECT i.id, i.reference, i.date_created, i.due_date, 
                c.name, c.billing_address, c.email, i.total, i.status,
                COALESCE(q.job_title, j.description, 'Invoice') as job_title,
                COALESCE(q.job_description, j.description, '') as job_desc,
-               j.property_id, q.property_id
+               p.address_line1, p.postcode
         FROM invoices i 
         JOIN clients c ON i.client_id = c.id
         LEFT JOIN jobs j ON i.job_id = j.id
         LEFT JOIN quotes q ON i.quote_id = q.id
-        WHERE i.id = %s AND i.company_id = %s
-    """, (invoice_id, comp_id))
-    inv = cur.fetchone()
-    
-    if not inv: conn.close(); return "Invoice not found", 404
-
-    # 2. Resolve Addresses
-    # BILLING: Always use the client's billing address
-    billing_addr = inv[5]
-    
-    # SITE: Check Job then Quote for property_id
-    site_address_str = ""
-    active_prop_id = inv[11] or inv[12]
-    
-    if active_prop_id:
-        cur.execute("SELECT address_line1, postcode FROM properties WHERE id = %s", (active_prop_id,))
-        prop = cur.fetchone()
-        if prop:
-            site_address_str = f"Site: {prop[0]}, {prop[1]}"
-
-    # 3. Inject Site Address into Description
-    # This keeps 'Bill To' correct but shows the Site clearly in the body
-    job_desc = inv[10]
-    if site_address_str:
-        job_desc = f"{site_address_str}\n{job_desc}"
-
-    # 4. Fetch Items & Settings
-    cur.execute("SELECT description, quantity, unit_price, total FROM invoice_items WHERE invoice_id = %s", (invoice_id,))
-    items = [{'desc': r[0], 'qty': r[1], 'price': r[2], 'total': r[3]} for r in cur.fetchall()]
-
-    cur.execute("SELECT key, value FROM settings WHERE company_id = %s", (comp_id,))
-    settings = {row[0]: row[1] for row in cur.fetchall()}
+        LEFT JOIN properties p ON p.id = COALESCE(j.property_id, q.property_id)
+        WHERE i.company_id = %(comp_id)s {filters}
+        ORDER BY i.date, i.id
+    """, params)
+    invoices = cur.fetchall()
+    if not invoices: return []
+
+    # 2. Fetch Items (all invoices at once)
+    cur.execute("""
+        SELECT invoice_id, description, quantity, unit_price, total
+        FROM invoice_items WHERE invoice_id = ANY(%s) ORDER BY invoice_id
+    """, ([inv[0] for inv in invoices],))
+    items_by_invoice = {}
+    for r in cur.fetchall():
+        items_by_invoice.setdefault(r[0], []).append({'desc': r[1], 'qty': r[2], 'price': r[3], 'total': r[4]})
+
+    settings = get_settings(comp_id)
     comp_name = get_company_name(cur, comp_id)
-    conn.close()
 
     # --- THE BULLETPROOF LOGO FIX ---
     config = get_site_config(comp_id)
@@ -115,60 +119,84 @@ def download_invoice_pdf(invoice_id):
             config['logo'] = f"file://{abs_path}"
     # --------------------------------
 
-    total_val = float(inv[7] or 0)
     user_rate = get_tax_rate(settings)
     divisor = 1 + (user_rate / 100)
-    subtotal_val = total_val / divisor
-    tax_val = total_val - subtotal_val
     country = settings.get('country_code', 'UK')
-    ref_display = inv[1] if inv[1] else "DRAFT"
-
-    context = {
-        'invoice': {
-            'ref': ref_display, 
-            'date': format_date_local(inv[2], country),
-            'due': format_date_local(inv[3], country),
-            'client_name': inv[4], 
-            'client_address': billing_addr, 
-            'client_email': inv[6],
-            'subtotal': subtotal_val,
-            'tax': tax_val,
-            'total': total_val,
-            'tax_rate_display': user_rate,
-            'status': inv[8],
-            'currency_symbol': settings.get('currency_symbol', '£'),
-            'job_title': inv[9],
-            'job_description': job_desc 
-        },
-        'company': {
-            'name': comp_name,
-            'address': settings.get('company_address', ''),
-            'email': settings.get('company_email', ''),
-            'phone': settings.get('company_phone', ''),
-            'reg': settings.get('company_reg_number', '')
-        },
-        'items': items,
-        'settings': settings,
-        'smart_terms': get_smart_terms(settings),
-        'config': config, # This now has the correct file:// path
-        'is_quote': False 
+    company = {
+        'name': comp_name,
+        'address': settings.get('company_address', ''),
+        'email': settings.get('company_email', ''),
+        'phone': settings.get('company_phone', ''),
+        'reg': settings.get('company_reg_number', '')
     }
-    
-    filename = f"Invoice_{ref_display}.pdf"
-    try:
-        pdf_path = generate_pdf('finance/pdf_invoice_template.html', context, filename)
-        return send_file(pdf_path, as_attachment=False, download_name=filename)
-    except Exception as e:
-        return f"PDF Error: {e}", 500
 
-@pdf_bp.route('/office/quote/<int:quote_id>/download')
-def download_quote_pdf(quote_id):
+    built = []
+    for inv in invoices:
+        # 3. Inject Site Address into Description
+        # This keeps 'Bill To' correct but shows the Site clearly in the body
+        job_desc = inv[10]
+        if inv[11] or inv[12]:
+            job_desc = f"Site: {inv[11]}, {inv[12]}\n{job_desc}"
+
+        total_val = float(inv[7] or 0)
+        subtotal_val = total_val / divisor
+        ref_display = inv[1] if inv[1] else "DRAFT"
+
+        context = {
+            'invoice': {
+                'ref': ref_display, 
+                'date': format_date_local(inv[2], country),
+                'due': format_date_local(inv[3], country),
+                'client_name': inv[4], 
+                'client_address': inv[5], # BILLING: Always the client's billing address
+                'client_email': inv[6],
+                'subtotal': subtotal_val,
+                'tax': total_val - subtotal_val,
+                'total': total_val,
+                'tax_rate_display': user_rate,
+                'status': inv[8],
+                'currency_symbol': settings.get('currency_symbol', '£'),
+                'job_title': inv[9],
+                'job_description': job_desc 
+            },
+            'company': company,
+            'items': items_by_invoice.get(inv[0], []),
+            'settings': settings,
+            'smart_terms': get_smart_terms(settings),
+            'config': config, # This now has the correct file:// path
+            'is_quote': False 
+        }
+        built.append((inv[0], context, f"Invoice_{ref_display}.pdf"))
+    return built
+
+def build_invoice_pdf(cur, comp_id, invoice_id):
+    """
+    (context, filename) for an invoice PDF, or None if not found.
+    Shared by the direct download and the background job.
+    """
+    built = build_invoice_pdfs(cur, comp_id, invoice_ids=[invoice_id])
+    return built[0][1:] if built else None
+
+@pdf_bp.route('/finance/invoice/<int:invoice_id>/download')
+def download_invoice_pdf(invoice_id):
     if session.get('role') not in ['Admin', 'SuperAdmin', 'Finance', 'Office']:
         return redirect(url_for('auth.login'))
         
     conn = get_db(); cur = conn.cursor()
-    comp_id = session.get('company_id')
+    built = build_invoice_pdf(cur, session.get('company_id'), invoice_id)
+    conn.close()
+    if not built: return "Invoice not found", 404
+
+    context, filename = built
+    try:
+        pdf_path, key = get_or_render_pdf('finance/pdf_invoice_template.html', context,
+                                          current_app.static_folder, current_app.root_path)
+        return send_cached_pdf(pdf_path, filename, key)
+    except Exception as e:
+        return f"PDF Error: {e}", 500
 
+def build_quote_pdf(cur, comp_id, quote_id):
+    """(context, filename) for a quote PDF, or None if not found."""
     cur.execute("""
         SELECT q.id, q.reference, q.date, q.expiry_date, 
                c.name, c.billing_address, c.email, q.total, q.status,
@@ -179,7 +207,7 @@ def download_quote_pdf(quote_id):
     """, (quote_id, comp_id))
     quote = cur.fetchone()
     
-    if not quote: conn.close(); return "Quote not found", 404
+    if not quote: return None
 
     # Resolve Addresses
     billing_addr = quote[5]
@@ -199,10 +227,8 @@ def download_quote_pdf(quote_id):
     cur.execute("SELECT description, quantity, unit_price, total FROM quote_items WHERE quote_id = %s", (quote_id,))
     items = [{'desc': r[0], 'qty': r[1], 'price': r[2], 'total': r[3]} for r in cur.fetchall()]
 
-    cur.execute("SELECT key, value FROM settings WHERE company_id = %s", (comp_id,))
-    settings = {row[0]: row[1] for row in cur.fetchall()}
+    settings = get_settings(comp_id)
     comp_name = get_company_name(cur, comp_id)
-    conn.close()
 
     # --- THE BULLETPROOF LOGO FIX ---
     config = get_site_config(comp_id)
@@ -258,14 +284,172 @@ def download_quote_pdf(quote_id):
         'is_quote': True 
     }
     
-    filename = f"Quote_{quote[1]}.pdf"
-    
+    return context, f"Quote_{quote[1]}.pdf"
+
+@pdf_bp.route('/office/quote/<int:quote_id>/download')
+def download_quote_pdf(quote_id):
+    if session.get('role') not in ['Admin', 'SuperAdmin', 'Finance', 'Office']:
+        return redirect(url_for('auth.login'))
+        
+    conn = get_db(); cur = conn.cursor()
+    built = build_quote_pdf(cur, session.get('company_id'), quote_id)
+    conn.close()
+    if not built: return "Quote not found", 404
+
+    context, filename = built
     try:
-        pdf_path = generate_pdf('finance/pdf_invoice_template.html', context, filename)
-        return send_file(pdf_path, as_attachment=False, download_name=filename)
+        pdf_path, key = get_or_render_pdf('finance/pdf_invoice_template.html', context,
+                                          current_app.static_folder, current_app.root_path)
+        return send_cached_pdf(pdf_path, filename, key)
     except Exception as e:
         return f"PDF Error: {e}", 500
+
+@pdf_bp.route('/finance/invoices/export-pdfs')
+def export_invoice_pdfs():
+    # Month-end bulk download: ?start=YYYY-MM-DD&end=YYYY-MM-DD&status=Sent
+    if session.get('role') not in ['Admin', 'SuperAdmin', 'Finance', 'Office']:
+        return redirect(url_for('auth.login'))
+
+    start = request.args.get('start') or None
+    end = request.args.get('end') or None
+    status = request.args.get('status') or None
+
+    conn = get_db(); cur = conn.cursor()
+    docs = build_invoice_pdfs(cur, session.get('company_id'), start=start, end=end, status=status)
+    conn.close()
+
+    if not docs:
+        flash("No invoices match that filter.", "warning")
+        return redirect(url_for('finance.finance_invoices'))
+    if len(docs) > PDF_EXPORT_MAX_DOCS:
+        flash(f"⚠️ {len(docs)} invoices match - narrow the date range (max {PDF_EXPORT_MAX_DOCS} per export).", "warning")
+        return redirect(url_for('finance.finance_invoices'))
+
+    zip_name = f"Invoices_{start or 'all'}_to_{end or 'today'}.zip"
+    # No stream_with_context: the DB work is done, the connection goes back to the pool now
+    return Response(
+        stream_pdf_zip(docs, 'finance/pdf_invoice_template.html', current_app.static_folder, current_app.root_path),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename="{zip_name}"', 'X-Accel-Buffering': 'no'}
+    )
+
+# =========================================================
+# OVERDUE STATEMENTS (see services/statement_mailer.py)
+# =========================================================
+@pdf_bp.route('/finance/invoices/send-statements', methods=['POST'])
+def send_overdue_statements():
+    if session.get('role') not in ['Admin', 'SuperAdmin', 'Finance', 'Office']:
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    comp_id = session.get('company_id')
+    if not smtp_config(get_settings(comp_id)):
+        return jsonify({'error': 'SMTP settings missing. Configure them in Finance > Settings.'}), 400
+
+    conn = get_db(); cur = conn.cursor()
+    try:
+        active = get_active_run(cur, comp_id)
+        if active:
+            return jsonify({'error': 'A statement run is already in progress.', 'run_id': active,
+                            'status_url': url_for('pdf.statement_run_status', run_id=active)}), 409
+
+        overdue = get_overdue_by_client(cur, comp_id)
+        clients = {cid: c for cid, c in overdue.items() if c['email']}
+        invoice_ids = [inv_id for c in clients.values() for inv_id in c['invoice_ids']]
+        if not invoice_ids:
+            return jsonify({'status': 'empty', 'message': 'No overdue invoices for clients with an email address.'})
+        if len(invoice_ids) > STATEMENT_MAX_INVOICES:
+            return jsonify({'error': f"{len(invoice_ids)} overdue invoices - over the limit of {STATEMENT_MAX_INVOICES} per run."}), 400
+
+        docs = build_invoice_pdfs(cur, comp_id, invoice_ids=invoice_ids)
+        run_id = start_statement_run(cur, comp_id, session.get('company_name') or get_company_name(cur, comp_id),
+                                     clients, docs, current_app.static_folder, current_app.root_path,
+                                     skipped=len(overdue) - len(clients), user_id=session.get('user_id'))
+    except Exception as e:
+        conn.rollback()
+        return jsonify({'error': f"Statement Error: {e}"}), 500
+    finally:
+        conn.close()
+
+    return jsonify({
+        'run_id': run_id,
+        'status': 'rendering',
+        'clients': len(clients),
+        'invoices': len(docs),
+        'status_url': url_for('pdf.statement_run_status', run_id=run_id)
+    }), 202
+
+@pdf_bp.route('/finance/statements/<int:run_id>')
+def statement_run_status(run_id):
+    if session.get('role') not in ['Admin', 'SuperAdmin', 'Finance', 'Office']:
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    conn = get_db(); cur = conn.cursor()
+    run = get_statement_run(cur, run_id, session.get('company_id'))
+    conn.close()
+    if not run: return jsonify({'error': 'Run not found'}), 404
+    return jsonify(run)
+
+# =========================================================
+# BACKGROUND PDF JOBS (see services/pdf_jobs.py)
+# =========================================================
+PDF_JOB_BUILDERS = {
+    'invoice': build_invoice_pdf,
+    'quote': build_quote_pdf
+}
+
+@pdf_bp.route('/pdf/jobs/<kind>/<int:doc_id>', methods=['POST'])
+def start_pdf_job(kind, doc_id):
+    if session.get('role') not in ['Admin', 'SuperAdmin', 'Finance', 'Office']:
+        return jsonify({'error': 'Unauthorized'}), 403
+    if kind not in PDF_JOB_BUILDERS: return jsonify({'error': 'Unknown document type'}), 404
+
+    comp_id = session.get('company_id')
+    conn = get_db(); cur = conn.cursor()
+    built = PDF_JOB_BUILDERS[kind](cur, comp_id, doc_id)
+    if not built:
+        conn.close(); return jsonify({'error': f"{kind.title()} not found"}), 404
+
+    context, filename = built
+    try:
+        job_id = submit_pdf(comp_id, kind, 'finance/pdf_invoice_template.html', context, filename,
+                            current_app.static_folder, current_app.root_path, cache=True)
+    except Exception as e:
+        conn.rollback(); conn.close()
+        return jsonify({'error': f"PDF Error: {e}"}), 500
+    conn.close()
+
+    return jsonify({
+        'job_id': job_id,
+        'status': 'queued',
+        'status_url': url_for('pdf.pdf_job_status', job_id=job_id)
+    }), 202
+
+@pdf_bp.route('/pdf/jobs/<job_id>')
+def pdf_job_status(job_id):
+    if 'user_id' not in session: return jsonify({'error': 'Unauthorized'}), 403
+
+    conn = get_db(); cur = conn.cursor()
+    job = get_pdf_job(cur, job_id, session.get('company_id'))
+    conn.close()
+    if not job: return jsonify({'error': 'Job not found'}), 404
+
+    result = {'job_id': job['id'], 'status': job['status'], 'error': job['error']}
+    if job['status'] == 'done':
+        result['download_url'] = url_for('pdf.download_pdf_job', job_id=job_id)
+    return jsonify(result)
+
+@pdf_bp.route('/pdf/jobs/<job_id>/download')
+def download_pdf_job(job_id):
+    if 'user_id' not in session: return redirect(url_for('auth.login'))
+
+    conn = get_db(); cur = conn.cursor()
+    job = get_pdf_job(cur, job_id, session.get('company_id'))
+    conn.close()
+    if not job or job['status'] != 'done' or not job['file_path'] or not os.path.exists(job['file_path']):
+        return "PDF not ready", 404
+    return send_file(job['file_path'], as_attachment=False, download_name=job['file_name'])
         
+
 @pdf_bp.route('/office/job/<int:job_id>/material-list')
 def download_material_list(job_id):
     if not check_access(): return redirect(url_for('auth.login'))
@@ -1,5 +1,6 @@
 from flask import Blueprint, render_template, session, redirect, url_for, flash, request
 from db import get_db, get_site_config
+from services.settings_cache import get_settings
 from werkzeug.security import check_password_hash, generate_password_hash
 from services.enforcement import check_limit
 from werkzeug.utils import secure_filename
@@ -288,8 +289,7 @@ def portal_view_quote(quote_id):
     conn = get_db(); cur = conn.cursor()
 
     # 1. FETCH COMPANY SETTINGS (The "Brain" of the Quote)
-    cur.execute("SELECT key, value FROM settings WHERE company_id = %s", (comp_id,))
-    settings = {row[0]: row[1] for row in cur.fetchall()}
+    settings = get_settings(comp_id)
     
     config = {
         'name': settings.get('company_name', 'Our Company'),
@@ -1,13 +1,15 @@
 from flask import Blueprint, render_template, session, redirect, url_for, flash, request, jsonify, current_app
 from db import get_db
+from services.settings_cache import get_settings, get_setting
+from services.finance_rollups import refresh_rollups, month_of
+from services.fleet_costs import get_fleet
 from datetime import datetime
-import smtplib
 import os
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.application import MIMEApplication
-from services.pdf_generator import generate_pdf
-from services.calculators import AVAILABLE_CALCS, get_calculator
+from services.pdf_generator import render_pdf_bytes
+from services.email_queue import enqueue_email
+from services.price_book import price_materials
+from services.calculators import get_calculator, calculator_meta
+from services.batch_quote import quote_batch, CALC_BATCH_MAX
 
 quote_bp = Blueprint('quote', __name__)
 
@@ -32,16 +34,19 @@ def check_access():
 def get_calculator_meta():
     if not check_access(): return jsonify([]), 401
     
-    # DEBUG: Print what the server sees to the console
-    print(f"DEBUG: AVAILABLE_CALCS keys: {list(AVAILABLE_CALCS.keys())}")
-    
     try:
-        meta_data = [calc.get_config() for calc in AVAILABLE_CALCS.values()]
-        return jsonify(meta_data)
+        meta_data, etag = calculator_meta()
     except Exception as e:
         print(f"ERROR in get_calculator_meta: {e}")
         return jsonify({'error': str(e)}), 500
 
+    # Same schema for everyone until the next deploy - let the browser revalidate (304)
+    response = jsonify(meta_data)
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
 @quote_bp.route('/api/calculate/<trade_type>', methods=['POST'])
 def smart_calculate(trade_type):
     if not check_access(): return jsonify({'error': 'Unauthorized'}), 401
@@ -52,8 +57,8 @@ def smart_calculate(trade_type):
 
     conn = None
     try:
-        inputs = request.get_json()
-        requirements = calculator.calculate_requirements(inputs)
+        inputs = request.get_json() or {}
+        requirements = calculator.requirements(inputs)  # Memoized per input set
         
         # 1. Setup Database Connection
         comp_id = session.get('company_id')
@@ -61,42 +66,16 @@ def smart_calculate(trade_type):
         cur = conn.cursor()
         
         # 2. Get Markup Setting
-        cur.execute("SELECT value FROM settings WHERE company_id=%s AND key='material_markup_percent'", (comp_id,))
-        row = cur.fetchone()
-        markup_percent = float(row[0]) if row and row[0] else 20.0
+        markup_percent = get_setting(comp_id, 'material_markup_percent', 20.0, float)
         markup = 1 + (markup_percent / 100)
         
+        # 3. REAL DATABASE LOOKUP - whole list at once via the tenant price book
+        # (same prices and fallback estimates as PricingEngine)
         priced_materials = []
-        for item in requirements.get('materials', []):
-            item_name = item['name']
-            qty = item['qty']
-            est_cost = 0.00
-            
-            # 3. REAL DATABASE LOOKUP
-            # Try to find a material with a matching name (Case insensitive)
-            cur.execute("""
-                SELECT cost_price FROM materials 
-                WHERE company_id = %s AND name ILIKE %s 
-                LIMIT 1
-            """, (comp_id, f"%{item_name}%")) # Fuzzy match to find "Fence Post" in "Fence Post 2.4m"
-            
-            db_row = cur.fetchone()
-            
-            if db_row:
-                # FOUND IN DB
-                est_cost = float(db_row[0] or 0)
-            else:
-                # NOT FOUND - USE FALLBACK ESTIMATES (Safety Net)
-                name_lower = item_name.lower()
-                if 'post' in name_lower: est_cost = 15.00
-                elif 'rail' in name_lower: est_cost = 6.50
-                elif 'board' in name_lower: est_cost = 1.20
-                elif 'bag' in name_lower: est_cost = 6.50
-                elif 'cement' in name_lower: est_cost = 6.50
-                elif 'tile' in name_lower: est_cost = 1.10
-                elif 'batten' in name_lower: est_cost = 0.80
-                elif 'membrane' in name_lower: est_cost = 45.00
-                else: est_cost = 20.00 # Generic fallback
+        for line in price_materials(cur, comp_id, requirements.get('materials', [])):
+            item_name = line['name']
+            qty = line['qty']
+            est_cost = line['cost_price']
             
             # 4. Calculate Sell Price
             sell_price = est_cost * markup
@@ -121,12 +100,31 @@ def smart_calculate(trade_type):
     finally:
         if conn: conn.close()
 
+@quote_bp.route('/api/calculate/batch', methods=['POST'])
+def batch_calculate():
+    # {"jobs": [{"trade": "fencing", "inputs": {"length": 20}, "ref": "Plot 1"}, ...]}
+    if not check_access(): return jsonify({'error': 'Unauthorized'}), 401
+
+    jobs = (request.get_json(silent=True) or {}).get('jobs')
+    if not isinstance(jobs, list) or not jobs:
+        return jsonify({'error': 'Send a non-empty "jobs" list'}), 400
+    if len(jobs) > CALC_BATCH_MAX:
+        return jsonify({'error': f'Too many jobs (max {CALC_BATCH_MAX} per batch)'}), 400
+
+    comp_id = session.get('company_id')
+    markup = 1 + (get_setting(comp_id, 'material_markup_percent', 20.0, float) / 100)
+    conn = get_db()
+    try:
+        return jsonify(quote_batch(conn.cursor(), comp_id, jobs, markup))
+    except Exception as e:
+        print(f"BATCH CALC ERROR: {e}")
+        return jsonify({'error': str(e)}), 500
+    finally:
+        conn.close()
+
 # --- HELPER: GET SITE CONFIG (PRESERVED) ---
 def get_site_config(comp_id):
-    conn = get_db(); cur = conn.cursor()
-    cur.execute("SELECT key, value FROM settings WHERE company_id = %s", (comp_id,))
-    settings = {row[0]: row[1] for row in cur.fetchall()}
-    conn.close()
+    settings = get_settings(comp_id)
     return {
         'color': settings.get('brand_color', '#333333'),
         'logo': settings.get('logo', '')
@@ -152,49 +150,15 @@ def new_quote():
 
     # 3. FETCH VEHICLES & CALCULATE "TRUE GANG COST" (Matches Finance Logic)
     # This fixes the dropdown showing £0 or incorrect prices
-    cur.execute("""
-        SELECT v.id, v.reg_plate, v.make_model, v.daily_cost, v.assigned_driver_id
-        FROM vehicles v
-        WHERE v.company_id = %s AND v.status = 'Active'
-    """, (comp_id,))
-    
-    vehicles = []
-    for r in cur.fetchall():
-        v_id, reg, model, base_cost, driver_id = r
-        daily_total = float(base_cost or 0)
-        
-        # A. Add Driver Cost (Checking Pay Model)
-        if driver_id:
-            cur.execute("SELECT pay_rate, pay_model FROM staff WHERE id = %s", (driver_id,))
-            d_row = cur.fetchone()
-            if d_row:
-                rate, model_type = float(d_row[0] or 0), d_row[1]
-                if model_type == 'Hour': daily_total += (rate * 8)
-                elif model_type == 'Day': daily_total += rate
-                elif model_type == 'Year': daily_total += (rate / 260)
-
-        # B. Add Crew Cost (Checking Pay Model)
-        cur.execute("""
-            SELECT s.pay_rate, s.pay_model FROM vehicle_crews vc
-            JOIN staff s ON vc.staff_id = s.id
-            WHERE vc.vehicle_id = %s
-        """, (v_id,))
-        for c_row in cur.fetchall():
-            rate, model_type = float(c_row[0] or 0), c_row[1]
-            if model_type == 'Hour': daily_total += (rate * 8)
-            elif model_type == 'Day': daily_total += rate
-            elif model_type == 'Year': daily_total += (rate / 260)
-
-        vehicles.append({
-            'id': v_id, 
-            'reg_plate': reg, 
-            'make_model': model, 
-            'daily_cost': daily_total
-        })
+    vehicles = [{
+        'id': v['id'], 
+        'reg_plate': v['reg_plate'], 
+        'make_model': v['make_model'], 
+        'daily_cost': v['total_gang_cost']
+    } for v in get_fleet(cur, comp_id, active_only=True)]
 
     # 4. Fetch Settings
-    cur.execute("SELECT key, value FROM settings WHERE company_id = %s", (comp_id,))
-    settings = {row[0]: row[1] for row in cur.fetchall()}
+    settings = get_settings(comp_id)
     
     conn.close()
 
@@ -276,35 +240,12 @@ def save_unified_quote():
 
         # 5. INSERT AUTO-LABOR (The UPGRADED Smart Logic)
         if pref_van:
-            cur.execute("SELECT daily_cost, assigned_driver_id, reg_plate FROM vehicles WHERE id = %s", (pref_van,))
-            van = cur.fetchone()
+            van = get_fleet(cur, comp_id, vehicle_id=pref_van)
             
             if van:
-                daily_total = float(van[0]) if van[0] else 0.0
-                driver_id = van[1]
-                reg_plate = van[2]
-
-                # Add Driver (Checking Pay Model)
-                if driver_id:
-                    cur.execute("SELECT pay_rate, pay_model FROM staff WHERE id=%s", (driver_id,))
-                    d_row = cur.fetchone()
-                    if d_row:
-                        rate, model = float(d_row[0] or 0), d_row[1]
-                        if model == 'Hour': daily_total += (rate * 8)
-                        elif model == 'Day': daily_total += rate
-                        elif model == 'Year': daily_total += (rate / 260)
-
-                # Add Crew (Checking Pay Model)
-                cur.execute("""
-                    SELECT s.pay_rate, s.pay_model FROM vehicle_crews vc
-                    JOIN staff s ON vc.staff_id = s.id
-                    WHERE vc.vehicle_id = %s
-                """, (pref_van,))
-                for c_row in cur.fetchall():
-                    rate, model = float(c_row[0] or 0), c_row[1]
-                    if model == 'Hour': daily_total += (rate * 8)
-                    elif model == 'Day': daily_total += rate
-                    elif model == 'Year': daily_total += (rate / 260)
+                # Van + Driver + Crew (Checking Pay Models)
+                daily_total = van[0]['total_gang_cost']
+                reg_plate = van[0]['reg_plate']
 
                 res_total = daily_total * est_days
                 if res_total > 0:
@@ -333,8 +274,7 @@ def save_unified_quote():
         net = float(db_sum) if db_sum else 0.0
         
         # Calculate tax again for saving total
-        cur.execute("SELECT key, value FROM settings WHERE company_id = %s", (comp_id,))
-        settings = {row[0]: row[1] for row in cur.fetchall()}
+        settings = get_settings(comp_id)
         country = settings.get('country_code', 'UK')
         vat_reg = settings.get('vat_registered', 'no')
         tax_rate = 0.0
@@ -385,9 +325,7 @@ def view_quote(quote_id):
     
     quote = cur.fetchone()
 
-    cur.execute("SELECT value FROM settings WHERE key = 'currency_symbol' AND company_id = %s", (comp_id,))
-    res = cur.fetchone()
-    currency = res[0] if res else '£'
+    currency = get_setting(comp_id, 'currency_symbol', '£')
 
     conn.close()
     
@@ -486,8 +424,7 @@ def email_quote(quote_id):
     ref, client_name, client_email, title, desc, q_date, total_val, client_addr = q[0], q[1], q[2], q[3], q[4], q[5], float(q[6] or 0), q[7]
 
     # 3. Settings
-    cur.execute("SELECT key, value FROM settings WHERE company_id = %s", (company_id,))
-    settings = {row[0]: row[1] for row in cur.fetchall()}
+    settings = get_settings(company_id)
     
     if 'smtp_host' not in settings:
         conn.close(); flash("⚠️ SMTP Settings missing.", "warning")
@@ -536,33 +473,19 @@ def email_quote(quote_id):
     filename = f"Quote_{ref}.pdf"
     
     try:
-        pdf_path = generate_pdf('finance/pdf_invoice_template.html', context, filename)
-        
-        # 6. Send Email
-        msg = MIMEMultipart()
-        msg['From'] = settings.get('smtp_email')
-        msg['To'] = client_email
-        msg['Subject'] = f"Quote {ref} - {title or 'Proposal'}"
+        # Rendered in memory: an emailed copy doesn't need to live in uploads/documents
+        pdf_bytes = render_pdf_bytes('finance/pdf_invoice_template.html', context)
         
+        # 6. Queue Email (the outbound queue marks the quote 'Sent' once delivered)
+        subject = f"Quote {ref} - {title or 'Proposal'}"
         body = f"Dear {client_name},\n\nPlease find attached the quote for {title}.\n\nTotal: {settings.get('currency_symbol','£')}{total_val:.2f}\n\nKind regards,\n{session.get('company_name')}"
-        msg.attach(MIMEText(body, 'plain'))
-        
-        with open(pdf_path, "rb") as f:
-            part = MIMEApplication(f.read(), Name=filename)
-            part['Content-Disposition'] = f'attachment; filename="{filename}"'
-            msg.attach(part)
-
-        server = smtplib.SMTP(settings['smtp_host'], int(settings.get('smtp_port', 587)))
-        server.starttls()
-        server.login(settings['smtp_email'], settings['smtp_password'])
-        server.send_message(msg)
-        server.quit()
-        
-        cur.execute("UPDATE quotes SET status = 'Sent' WHERE id = %s", (quote_id,))
+        enqueue_email(cur, company_id, client_email, subject, body, body_type='plain',
+                      attachments=[(filename, pdf_bytes)], ref=('quote', quote_id))
         conn.commit()
-        flash(f"✅ Quote emailed to {client_email}!", "success")
+        flash(f"📤 Quote queued for sending to {client_email}.", "success")
 
     except Exception as e:
+        conn.rollback()
         flash(f"❌ Email failed: {e}", "error")
     
     conn.close()
@@ -608,33 +531,19 @@ def email_quote(quote_id):
     filename = f"Quote_{ref}.pdf"
     
     try:
-        pdf_path = generate_pdf('finance/pdf_invoice_template.html', context, filename)
-        
-        # 6. Send Email
-        msg = MIMEMultipart()
-        msg['From'] = settings.get('smtp_email')
-        msg['To'] = client_email
-        msg['Subject'] = f"Quote {ref} - {title or 'Proposal'}"
+        # Rendered in memory: an emailed copy doesn't need to live in uploads/documents
+        pdf_bytes = render_pdf_bytes('finance/pdf_invoice_template.html', context)
         
+        # 6. Queue Email (the outbound queue marks the quote 'Sent' once delivered)
+        subject = f"Quote {ref} - {title or 'Proposal'}"
         body = f"Dear {client_name},\n\nPlease find attached the quote for {title}.\n\nTotal: {settings.get('currency_symbol','£')}{total_val:.2f}\n\nKind regards,\n{session.get('company_name')}"
-        msg.attach(MIMEText(body, 'plain'))
-        
-        with open(pdf_path, "rb") as f:
-            part = MIMEApplication(f.read(), Name=filename)
-            part['Content-Disposition'] = f'attachment; filename="{filename}"'
-            msg.attach(part)
-
-        server = smtplib.SMTP(settings['smtp_host'], int(settings.get('smtp_port', 587)))
-        server.starttls()
-        server.login(settings['smtp_email'], settings['smtp_password'])
-        server.send_message(msg)
-        server.quit()
-        
-        cur.execute("UPDATE quotes SET status = 'Sent' WHERE id = %s", (quote_id,))
+        enqueue_email(cur, company_id, client_email, subject, body, body_type='plain',
+                      attachments=[(filename, pdf_bytes)], ref=('quote', quote_id))
         conn.commit()
-        flash(f"✅ Quote emailed to {client_email}!", "success")
+        flash(f"📤 Quote queued for sending to {client_email}.", "success")
 
     except Exception as e:
+        conn.rollback()
         flash(f"❌ Email failed: {e}", "error")
     
     conn.close()
@@ -656,8 +565,7 @@ def convert_to_invoice(quote_id):
     job_row = cur.fetchone(); job_id = job_row[0] if job_row else None
 
     # 3. Get Payment Days (RESTORED)
-    cur.execute("SELECT value FROM settings WHERE key = 'payment_days' AND company_id = %s", (comp_id,))
-    res = cur.fetchone(); days = int(res[0]) if res and res[0] else 14 
+    days = get_setting(comp_id, 'payment_days', 14, int)
 
     # 4. Create Invoice (UPDATED: Writes to reference, date, total)
     new_ref = f"INV-{quote[3]}" 
@@ -672,6 +580,7 @@ def convert_to_invoice(quote_id):
 
         cur.execute("INSERT INTO invoice_items (invoice_id, description, quantity, unit_price, total) SELECT %s, description, quantity, unit_price, total FROM quote_items WHERE quote_id = %s", (new_inv_id, quote_id))
         cur.execute("UPDATE quotes SET status = 'Converted' WHERE id = %s", (quote_id,))
+        refresh_rollups(cur, comp_id, 'invoices', month_of(datetime.now()))
         conn.commit()
         flash(f"✅ Converted to Invoice {new_ref}", "success")
         return redirect(f"/office/job/{job_id}/files") if job_id else redirect(url_for('finance.finance_invoices'))
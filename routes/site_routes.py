@@ -1,10 +1,10 @@
 from flask import Blueprint, render_template, session, redirect, url_for, flash, request, current_app
 from db import get_db, get_site_config
+from services.settings_cache import get_settings, get_setting
+from services.finance_rollups import refresh_rollups, month_of
+from services.email_queue import enqueue_email
 from werkzeug.utils import secure_filename
 import os
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 from datetime import datetime, timedelta, date
 try:
     from services.ai_assistant import scan_receipt
@@ -55,30 +55,24 @@ def get_staff_identity(user_id, cur):
     return staff_id, staff_name, comp_id, vehicle_id
 
 def send_email_notification(company_id, to_email, client_name, job_ref, address):
-    conn = get_db()
     try:
-        cur = conn.cursor()
-        cur.execute("SELECT key, value FROM settings WHERE company_id = %s AND key IN ('smtp_host', 'smtp_port', 'smtp_email', 'smtp_password')", (company_id,))
-        settings = {row[0]: row[1] for row in cur.fetchall()}
+        settings = get_settings(company_id)
         
         required = ['smtp_host', 'smtp_port', 'smtp_email', 'smtp_password']
         if not all(k in settings for k in required): return False
 
-        msg = MIMEMultipart()
-        msg['From'] = settings['smtp_email']
-        msg['To'] = to_email
-        msg['Subject'] = f"✅ Engineer Arrived: {job_ref}"
+        subject = f"✅ Engineer Arrived: {job_ref}"
         body = f"<h3>Hello {client_name},</h3><p>Our engineer has arrived at {address} and work is starting now.</p>"
-        msg.attach(MIMEText(body, 'html'))
 
-        server = smtplib.SMTP(settings['smtp_host'], int(settings['smtp_port']))
-        server.starttls()
-        server.login(settings['smtp_email'], settings['smtp_password'])
-        server.send_message(msg)
-        server.quit()
+        # Delivered by the outbound queue - the engineer's check-in doesn't wait on SMTP
+        conn = get_db(); cur = conn.cursor()
+        try:
+            enqueue_email(cur, company_id, to_email, subject, body)
+            conn.commit()
+        finally:
+            conn.close()
         return True
     except Exception: return False
-    finally: conn.close()
 
 # --- ROUTE: SITE DASHBOARD ---
 @site_bp.route('/site-hub')
@@ -99,13 +93,8 @@ def site_dashboard():
         if row and row[0]: profile_pic = row[0]
 
     # 2. GET LIVE SETTINGS (Table 28)
-    # We fetch Date Format, Brand Color, and Logo directly from the DB
-    cur.execute("""
-        SELECT key, value FROM settings 
-        WHERE company_id = %s 
-        AND key IN ('date_format', 'brand_color', 'logo')
-    """, (comp_id,))
-    settings = {row[0]: row[1] for row in cur.fetchall()}
+    # Date Format, Brand Color, and Logo come from the cached tenant settings
+    settings = get_settings(comp_id)
     
     date_fmt = settings.get('date_format', '%d/%m/%Y')
     brand_color = settings.get('brand_color') # No hardcoded default, template handles None
@@ -368,8 +357,7 @@ def job_details(job_id):
 
     # Branding
     comp_id = session.get('company_id')
-    cur.execute("SELECT value FROM settings WHERE company_id = %s AND key = 'logo'", (comp_id,))
-    logo_url = cur.fetchone()[0] if cur.rowcount > 0 else None
+    logo_url = get_setting(comp_id, 'logo')
     
     conn.close()
     return render_template('site/job_details.html', job=job, materials=materials, photos=photos, user_is_clocked_in=user_is_clocked_in, logo_url=logo_url)
@@ -418,12 +406,7 @@ def update_job(job_id):
             inv_id = cur.fetchone()[0]
 
             # 3. GET FINANCIAL SETTINGS (From DB)
-            cur.execute("""
-                SELECT key, value FROM settings 
-                WHERE company_id = %s 
-                AND key IN ('labour_markup_percent', 'material_markup_percent', 'vat_registered', 'country_code')
-            """, (comp_id,))
-            settings = {row[0]: row[1] for row in cur.fetchall()}
+            settings = get_settings(comp_id)
             
             # Calculate Multipliers (Default to 0 if not set in DB)
             labour_markup = float(settings.get('labour_markup_percent', 0)) / 100
@@ -484,6 +467,7 @@ def update_job(job_id):
             final_total = float(subtotal) + tax_amt
             
             cur.execute("UPDATE invoices SET subtotal = %s, tax = %s, total = %s WHERE id = %s", (subtotal, tax_amt, final_total, inv_id))
+            refresh_rollups(cur, comp_id, 'invoices', month_of(date.today()))
             flash(f"✅ Job Completed. Invoice {inv_ref} Generated.")
 
         # --- B. UPLOAD PHOTO ---
@@ -591,6 +575,7 @@ def site_log_fuel():
                 (company_id, vehicle_id, date, type, description, cost, receipt_path, mileage)
                 VALUES (%s, %s, %s, 'Fuel', %s, %s, %s, %s)
             """, (comp_id, vehicle_id, date.today(), f"Fuel: {litres}L ({fuel_type})", total_cost, receipt_path, mileage))
+            refresh_rollups(cur, comp_id, 'fleet', month_of(date.today()))
             
             conn.commit()
             flash("✅ Fuel logged successfully.", "success")
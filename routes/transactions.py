@@ -1,5 +1,8 @@
 from flask import Blueprint, render_template, session, redirect, url_for, flash, request
 from db import get_db, get_site_config
+from services.settings_cache import get_setting
+from services.finance_rollups import get_rollups, refresh_rollups, source_total, month_of
+from services.fleet_costs import daily_staff_cost
 from datetime import date, datetime, timedelta
 import json
 
@@ -14,11 +17,7 @@ COUNTRY_FORMATS = {
 
 def get_date_fmt_str(company_id):
     try:
-        conn = get_db(); cur = conn.cursor()
-        cur.execute("SELECT value FROM settings WHERE company_id = %s AND key = 'country_code'", (company_id,))
-        row = cur.fetchone()
-        conn.close()
-        country = row[0] if row else 'Default'
+        country = get_setting(company_id, 'country_code', 'Default')
         return COUNTRY_FORMATS.get(country, COUNTRY_FORMATS['Default'])
     except: return COUNTRY_FORMATS['Default']
 
@@ -35,17 +34,15 @@ def finance_dashboard():
     conn = get_db()
     cur = conn.cursor()
 
-    # --- A. CALCULATE TOTALS (Live from Invoices & Expenses) ---
+    # --- A. CALCULATE TOTALS (From the per-month finance rollups) ---
+    totals = get_rollups(cur, comp_id)['totals']
+
     # 1. Total Income (Only PAID Invoices count as cash)
-    cur.execute("SELECT COALESCE(SUM(total_amount), 0) FROM invoices WHERE company_id = %s AND status = 'Paid'", (comp_id,))
-    income = float(cur.fetchone()[0])
+    income = totals['invoices'].get('Paid', 0.0)
 
     # 2. Total Expense (Job Expenses + Overheads)
-    cur.execute("SELECT COALESCE(SUM(cost), 0) FROM job_expenses WHERE company_id = %s", (comp_id,))
-    job_costs = float(cur.fetchone()[0])
-    
-    cur.execute("SELECT COALESCE(SUM(amount), 0) FROM overhead_items WHERE category_id IN (SELECT id FROM overhead_categories WHERE company_id = %s)", (comp_id,))
-    overhead_costs = float(cur.fetchone()[0])
+    job_costs = source_total(totals['job_expenses'])
+    overhead_costs = source_total(totals['overheads'])
     
     expense = job_costs + overhead_costs
     balance = income - expense
@@ -58,13 +55,7 @@ def finance_dashboard():
     daily_fleet = cur.fetchone()[0] or 0.0
 
     cur.execute("SELECT pay_rate, pay_model FROM staff WHERE company_id = %s AND status='Active'", (comp_id,))
-    daily_staff = 0.0
-    for s in cur.fetchall():
-        rate = float(s[0] or 0)
-        model = s[1]
-        if model == 'Hour': daily_staff += (rate * 8)
-        elif model == 'Day': daily_staff += rate
-        elif model == 'Year': daily_staff += (rate / 260)
+    daily_staff = sum(daily_staff_cost(r[0], r[1]) for r in cur.fetchall())
 
     break_even_target = daily_overhead + float(daily_fleet) + daily_staff
 
@@ -158,8 +149,11 @@ def set_invoice_status(invoice_id, new_status):
     cur = conn.cursor()
     
     try:
-        cur.execute("UPDATE invoices SET status = %s WHERE id = %s AND company_id = %s", 
+        cur.execute("UPDATE invoices SET status = %s WHERE id = %s AND company_id = %s RETURNING date", 
                    (new_status, invoice_id, session.get('company_id')))
+        row = cur.fetchone()
+        # Status moves money between buckets of the invoice's month only
+        if row: refresh_rollups(cur, session.get('company_id'), 'invoices', month_of(row[0]))
         
         actor = session.get('user_name', 'Unknown')
         cur.execute("""
@@ -215,6 +209,7 @@ def bookkeeping_inbox():
                     INSERT INTO audit_logs (company_id, action, target, details, admin_email, created_at)
                     VALUES (%s, 'DOC_FILED', %s, %s, %s, CURRENT_TIMESTAMP)
                 """, (comp_id, f"Job #{job_id}", f"Receipt filed to Job: {desc}", user_name))
+                refresh_rollups(cur, comp_id, 'job_expenses')
                 
                 flash(f"✅ Filed to Job #{job_id}")
 
@@ -238,6 +233,8 @@ def bookkeeping_inbox():
                         INSERT INTO audit_logs (company_id, action, target, details, admin_email, created_at)
                         VALUES (%s, 'DOC_FILED', 'Overheads', %s, %s, CURRENT_TIMESTAMP)
                     """, (comp_id, f"Receipt filed to Overhead: {name}", user_name))
+                    refresh_rollups(cur, comp_id, 'job_expenses', month_of(date_val))
+                    refresh_rollups(cur, comp_id, 'overheads')
 
                     flash("✅ Filed to Overheads")
 
@@ -248,6 +245,7 @@ def bookkeeping_inbox():
                     INSERT INTO audit_logs (company_id, action, target, details, admin_email, created_at)
                     VALUES (%s, 'DOC_DELETED', 'Trash', 'Unsorted document deleted', %s, CURRENT_TIMESTAMP)
                 """, (comp_id, user_name))
+                refresh_rollups(cur, comp_id, 'job_expenses')
                 
                 flash("🗑️ Document Deleted")
 
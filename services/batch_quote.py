@@ -0,0 +1,77 @@
+# --- services/batch_quote.py ---
+import os
+from services.calculators import get_calculator
+from services.price_book import price_materials
+
+# --- BATCH QUOTING ---
+# Prices many calculator jobs (any mix of trades) in one call, e.g. every
+# plot on a housing-association bid. Identical input sets are only
+# calculated once (BaseCalculator.requirements memo), and every material
+# across every job is priced with ONE price-book lookup. Returns the
+# per-job shopping lists plus one aggregate list for ordering.
+CALC_BATCH_MAX = int(os.environ.get("CALC_BATCH_MAX", 1000))
+
+def quote_batch(cur, company_id, jobs, markup):
+    """
+    jobs: [{'trade', 'inputs', 'ref'(optional)}]. markup: sell = cost * markup.
+    A bad job is reported in its own row ('status': 'error'); the rest still price.
+    """
+    results, computed = [], []
+    distinct = set()
+    for index, job in enumerate(jobs):
+        job = job if isinstance(job, dict) else {}
+        trade = job.get('trade')
+        row = {'ref': job.get('ref', index), 'trade': trade}
+        calculator = get_calculator(trade)
+        if not calculator:
+            results.append({**row, 'status': 'error', 'error': f'Trade type "{trade}" not supported'})
+            continue
+        try:
+            inputs = job.get('inputs') or {}
+            distinct.add((trade, calculator.normalise_inputs(inputs)))
+            req = calculator.requirements(inputs)
+        except (ValueError, TypeError) as e:
+            results.append({**row, 'status': 'error', 'error': str(e)})
+            continue
+        results.append(row)
+        computed.append((row, req))
+
+    # One lookup for every material in the batch
+    totals = {}
+    for _, req in computed:
+        for item in req.get('materials', []):
+            totals[item['name']] = totals.get(item['name'], 0) + item['qty']
+    priced = {line['name']: line for line in price_materials(cur, company_id, [{'name': n, 'qty': q} for n, q in totals.items()])}
+
+    grand_total = 0.0
+    for row, req in computed:
+        materials, material_total = [], 0.0
+        for item in req.get('materials', []):
+            unit = round(priced[item['name']]['cost_price'] * markup, 2)
+            materials.append({'name': item['name'], 'qty': item['qty'], 'est_cost': unit,
+                              'line_total': round(unit * item['qty'], 2)})
+            material_total += unit * item['qty']
+        grand_total += material_total
+        row.update({'status': 'success', 'materials': materials, 'material_total': round(material_total, 2),
+                    'labor_hours': req.get('labor_hours', 0), 'waste_load': req.get('waste_load', 0),
+                    'summary': req.get('summary', '')})
+
+    shopping_list = []
+    for line in priced.values():
+        unit = round(line['cost_price'] * markup, 2)
+        shopping_list.append({'name': line['name'], 'qty': line['qty'], 'est_cost': unit,
+                              'line_total': round(unit * line['qty'], 2), 'supplier': line['supplier'],
+                              'in_catalogue': line['matched']})
+    shopping_list.sort(key=lambda l: (l['supplier'], l['name']))
+
+    return {
+        'status': 'success',
+        'jobs': results,
+        'shopping_list': shopping_list,
+        'totals': {
+            'jobs': len(results), 'priced': len(computed), 'errors': len(results) - len(computed),
+            'distinct_inputs': len(distinct), 'material_total': round(grand_total, 2),
+            'labor_hours': sum(req.get('labor_hours', 0) for _, req in computed),
+            'waste_load': sum(req.get('waste_load', 0) for _, req in computed)
+        }
+    }
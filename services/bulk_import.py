@@ -0,0 +1,327 @@
+# --- services/bulk_import.py ---
+import io
+import os
+import re
+import csv
+import json
+import time
+import uuid
+import tempfile
+import threading
+from db import get_db
+from services.material_import import parse_money
+
+# --- BULK IMPORT (CLIENTS / STAFF / VEHICLES) ---
+# The Migration Center used to INSERT row by row with no dedup. One bad row
+# halfway through left half a file imported, and importing the same export
+# twice doubled everything. Now every import:
+#   1. validates the whole file first (chunked, streamed from a spool file);
+#   2. COPYs the clean rows into a temp staging table;
+#   3. merges them in ONE transaction keyed on the natural key. That is
+#      email for clients and staff (clients without an email fall back to
+#      their name) and the normalised reg plate for vehicles. Known records
+#      are updated, new ones inserted, and re-running a file changes nothing.
+# "Validate only" (dry run) does steps 1-2, reports what WOULD be inserted /
+# updated, and rolls back. Files over IMPORT_BACKGROUND_BYTES run as a
+# background job and the page polls its progress. The job table is created by
+# /admin/setup-indexes-db (ensure_import_tables).
+IMPORT_BACKGROUND_BYTES = int(os.environ.get("IMPORT_BACKGROUND_BYTES", 256 * 1024))
+IMPORT_CHUNK = int(os.environ.get("IMPORT_CHUNK", 5000))
+IMPORT_MAX_ERRORS = int(os.environ.get("IMPORT_MAX_ERRORS", 1000))
+IMPORT_SPOOL_DIR = os.environ.get("IMPORT_SPOOL_DIR") or tempfile.gettempdir()
+IMPORT_JOB_STALE_AFTER = int(os.environ.get("IMPORT_JOB_STALE_AFTER", 1800))
+IMPORT_JOB_RETAIN_DAYS = int(os.environ.get("IMPORT_JOB_RETAIN_DAYS", 7))
+
+_schema_ready = False
+_EMAIL = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
+def _cell(row, i):
+    return row[i].replace('\x00', '').strip() if len(row) > i else ''
+
+def _money(raw, label):
+    # Same rules as supplier price lists: '12,50' is 12.50, not 1250
+    value = parse_money(raw, label)
+    if value < 0:
+        raise ValueError(f"Invalid {label} '{raw}'")
+    return value
+
+def _email(raw, required):
+    email = raw.lower()
+    if not email:
+        if required: raise ValueError("Missing email")
+        return ''
+    if not _EMAIL.match(email): raise ValueError(f"Invalid email '{raw}'")
+    return email
+
+# Each parser returns (key, values in 'columns' order) or raises ValueError.
+# The key must equal what 'key_sql' computes for the same record in the DB.
+def _parse_client(row):
+    # Name, Email, Phone, Address
+    name = _cell(row, 0)
+    if not name: raise ValueError("Missing name")
+    email = _email(_cell(row, 1), required=False)
+    address = _cell(row, 3)
+    return (email or f"name:{name.lower()}"), (name, email or None, _cell(row, 2), address, address)
+
+def _parse_staff(row):
+    # Name, Email, Position, Rate
+    name = _cell(row, 0)
+    if not name: raise ValueError("Missing name")
+    email = _email(_cell(row, 1), required=True)
+    return email, (name, email, _cell(row, 2), _money(_cell(row, 3), 'rate'))
+
+def _parse_vehicle(row):
+    # Reg Plate, Make/Model, Daily Cost
+    reg = re.sub(r"\s+", "", _cell(row, 0)).upper()
+    if not reg: raise ValueError("Missing reg plate")
+    return reg, (_cell(row, 0).upper(), _cell(row, 1), _money(_cell(row, 2), 'daily cost'))
+
+IMPORT_TYPES = {
+    'clients': {
+        'table': 'clients',
+        'parse': _parse_client,
+        'columns': ['name', 'email', 'phone', 'site_address', 'billing_address'],
+        'numeric': [],
+        'update': ['name', 'email', 'phone', 'site_address', 'billing_address'],
+        'insert_defaults': {'status': "'Active'"},
+        'key_sql': "COALESCE(NULLIF(LOWER(TRIM({t}.email)), ''), 'name:' || LOWER(TRIM({t}.name)))"
+    },
+    'staff': {
+        'table': 'staff',
+        'parse': _parse_staff,
+        'columns': ['name', 'email', 'position', 'pay_rate'],
+        'numeric': ['pay_rate'],
+        'update': ['name', 'position', 'pay_rate'],
+        'insert_defaults': {'pay_model': "'Hour'"},
+        'key_sql': "LOWER(TRIM({t}.email))"
+    },
+    'vehicles': {
+        'table': 'vehicles',
+        'parse': _parse_vehicle,
+        'columns': ['reg_plate', 'make_model', 'daily_cost'],
+        'numeric': ['daily_cost'],
+        'update': ['make_model', 'daily_cost'],
+        'insert_defaults': {'status': "'Active'"},
+        'key_sql': "UPPER(REGEXP_REPLACE({t}.reg_plate, '\\s', '', 'g'))"
+    }
+}
+
+def ensure_import_tables(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS import_jobs (
+            id VARCHAR(32) PRIMARY KEY,
+            company_id INTEGER NOT NULL,
+            kind VARCHAR(20),
+            dry_run BOOLEAN DEFAULT FALSE,
+            status VARCHAR(20) NOT NULL DEFAULT 'queued',
+            rows_processed INTEGER DEFAULT 0,
+            report JSONB,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_import_jobs_company_created ON import_jobs (company_id, created_at);")
+
+def _schema_exists(cur):
+    # Read-only check, once per process: DDL here would commit the caller's transaction
+    global _schema_ready
+    if not _schema_ready:
+        cur.execute("SELECT to_regclass('import_jobs') IS NOT NULL")
+        _schema_ready = cur.fetchone()[0]
+    return _schema_ready
+
+# =========================================================
+# PIPELINE
+# =========================================================
+def _copy_chunk(cur, columns, rows):
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    buf.seek(0)
+    cur.copy_expert(f"COPY import_stage (line_no, import_key, {', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buf)
+
+def _column_limits(cur, table, columns):
+    """{column: max length} for the target's VARCHAR columns."""
+    cur.execute("""
+        SELECT column_name, character_maximum_length FROM information_schema.columns
+        WHERE table_name = %s AND column_name = ANY(%s) AND character_maximum_length IS NOT NULL
+    """, (table, columns))
+    return dict(cur.fetchall())
+
+def run_import(cur, company_id, kind, text_stream, dry_run=False, progress=None):
+    """
+    Validates and (unless dry_run) merges a CSV into the company's records,
+    in the caller's transaction. The caller commits - or rolls back, which
+    is what a dry run needs anyway. progress(rows_processed) is called once
+    per chunk. Returns the report dict.
+    """
+    spec = IMPORT_TYPES[kind]
+    table, columns = spec['table'], spec['columns']
+    started = time.monotonic()
+    report = {'kind': kind, 'dry_run': dry_run, 'rows': 0, 'inserted': 0, 'updated': 0,
+              'duplicates': 0, 'rejected': 0, 'errors': [], 'errors_truncated': False}
+
+    stage_cols = ", ".join(f"{c} {'NUMERIC(12, 2)' if c in spec['numeric'] else 'TEXT'}" for c in columns)
+    cur.execute("DROP TABLE IF EXISTS pg_temp.import_stage")
+    cur.execute(f"CREATE TEMP TABLE import_stage (line_no INTEGER, import_key TEXT, {stage_cols}) ON COMMIT DROP")
+    limits = _column_limits(cur, table, columns)
+
+    reader = csv.reader(text_stream)
+    next(reader, None)  # Skip Header
+    chunk, seen = [], set()
+    for row in reader:
+        if not any(cell.strip() for cell in row):
+            continue
+        report['rows'] += 1
+        try:
+            key, values = spec['parse'](row)
+            for col, value in zip(columns, values):
+                # Caught here rather than as one opaque error that aborts the whole import
+                if col in limits and isinstance(value, str) and len(value) > limits[col]:
+                    raise ValueError(f"{col} is longer than {limits[col]} characters")
+        except ValueError as e:
+            report['rejected'] += 1
+            if len(report['errors']) < IMPORT_MAX_ERRORS:
+                report['errors'].append({'line': reader.line_num, 'value': _cell(row, 0)[:60], 'error': str(e)})
+            else:
+                report['errors_truncated'] = True
+            continue
+
+        if key in seen: report['duplicates'] += 1
+        else: seen.add(key)
+        chunk.append((reader.line_num, key, *values))
+        if len(chunk) >= IMPORT_CHUNK:
+            _copy_chunk(cur, columns, chunk)
+            chunk = []
+            if progress: progress(report['rows'])
+    if chunk:
+        _copy_chunk(cur, columns, chunk)
+    if progress: progress(report['rows'])
+
+    if seen:
+        cur.execute("ANALYZE import_stage")
+        # One import per company + type at a time, so two uploads can't both insert the same new key
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s), %s)", (f"import:{kind}", int(company_id)))
+        key_sql = spec['key_sql'].format(t='m')
+        latest = f"SELECT DISTINCT ON (import_key) * FROM import_stage ORDER BY import_key, line_no DESC"
+
+        if dry_run:
+            cur.execute(f"""
+                SELECT COUNT(*) FILTER (WHERE EXISTS (SELECT 1 FROM {table} m WHERE m.company_id = %(comp)s AND {key_sql} = l.import_key)),
+                       COUNT(*)
+                FROM ({latest}) l
+            """, {'comp': company_id})
+            existing, total = cur.fetchone()
+            report['updated'], report['inserted'] = existing, total - existing
+        else:
+            sets = ", ".join(f"{c} = l.{c}" for c in spec['update'])
+            cur.execute(f"""
+                UPDATE {table} m SET {sets}
+                FROM ({latest}) l
+                WHERE m.company_id = %(comp)s AND {key_sql} = l.import_key
+            """, {'comp': company_id})
+            report['updated'] = cur.rowcount
+
+            defaults = spec['insert_defaults']
+            insert_cols = ", ".join(['company_id', *columns, *defaults])
+            select_cols = ", ".join(['%(comp)s', *(f"l.{c}" for c in columns), *defaults.values()])
+            cur.execute(f"""
+                INSERT INTO {table} ({insert_cols})
+                SELECT {select_cols}
+                FROM ({latest}) l
+                WHERE NOT EXISTS (SELECT 1 FROM {table} m WHERE m.company_id = %(comp)s AND {key_sql} = l.import_key)
+            """, {'comp': company_id})
+            report['inserted'] = cur.rowcount
+
+    elapsed = time.monotonic() - started
+    report['seconds'] = round(elapsed, 3)
+    report['rows_per_sec'] = round(report['rows'] / elapsed) if elapsed else report['rows']
+    mode = "validated" if dry_run else "imported"
+    print(f"📥 Bulk Import ({kind}, company {company_id}): {report['rows']} rows {mode} in {elapsed:.2f}s "
+          f"({report['rows_per_sec']} rows/s) - {report['inserted']} new, {report['updated']} updated, {report['rejected']} rejected")
+    return report
+
+def import_file(cur, company_id, kind, path, dry_run=False, progress=None):
+    """run_import() over a spooled upload, committing (or rolling back a dry run)."""
+    try:
+        # utf-8-sig: CRM / Excel exports often start with a BOM
+        with open(path, encoding='utf-8-sig', newline='') as f:
+            report = run_import(cur, company_id, kind, f, dry_run=dry_run, progress=progress)
+        if dry_run: cur.connection.rollback()
+        else: cur.connection.commit()
+        return report
+    except Exception:
+        cur.connection.rollback()
+        raise
+
+def spool_upload(file_storage):
+    """Saves the upload to IMPORT_SPOOL_DIR; returns (path, size)."""
+    os.makedirs(IMPORT_SPOOL_DIR, exist_ok=True)
+    path = os.path.join(IMPORT_SPOOL_DIR, f"import_{uuid.uuid4().hex}.csv")
+    file_storage.save(path)
+    return path, os.path.getsize(path)
+
+# =========================================================
+# BACKGROUND JOBS
+# =========================================================
+def _update_job(job_id, finished=False, **fields):
+    conn = get_db()
+    if conn is None: return
+    try:
+        cur = conn.cursor()
+        sets = ", ".join([f"{k} = %s" for k in fields] + (["finished_at = NOW()"] if finished else []))
+        cur.execute(f"UPDATE import_jobs SET {sets} WHERE id = %s", (*fields.values(), job_id))
+        conn.commit()
+    except Exception as e:
+        print(f"❌ Import Job Update Error ({job_id}): {e}")
+    finally:
+        conn.close()
+
+def _run_job(job_id, company_id, kind, path, dry_run):
+    conn = get_db()
+    try:
+        if conn is None:
+            raise RuntimeError("no database connection")
+        _update_job(job_id, status='running')
+        report = import_file(conn.cursor(), company_id, kind, path, dry_run=dry_run,
+                             progress=lambda n: _update_job(job_id, rows_processed=n))
+        _update_job(job_id, finished=True, status='done', rows_processed=report['rows'], report=json.dumps(report))
+    except Exception as e:
+        print(f"❌ Import Job Failed ({job_id}): {e}")
+        _update_job(job_id, finished=True, status='failed', error=str(e)[:500])
+    finally:
+        if conn is not None: conn.close()
+        try: os.unlink(path)
+        except OSError: pass
+
+def start_import_job(cur, company_id, kind, path, dry_run=False):
+    """Records the job, starts it in a background thread and returns its id. Takes ownership of 'path'."""
+    if not _schema_exists(cur):
+        raise RuntimeError("import_jobs table is missing - run /admin/setup-indexes-db")
+    job_id = uuid.uuid4().hex
+    cur.execute("INSERT INTO import_jobs (id, company_id, kind, dry_run) VALUES (%s, %s, %s, %s)",
+                (job_id, company_id, kind, dry_run))
+    cur.execute("DELETE FROM import_jobs WHERE created_at < NOW() - make_interval(days => %s)", (IMPORT_JOB_RETAIN_DAYS,))
+    cur.connection.commit()
+    threading.Thread(target=_run_job, args=(job_id, company_id, kind, path, dry_run),
+                     name=f"import-{job_id[:8]}", daemon=True).start()
+    return job_id
+
+def get_import_job(cur, job_id, company_id):
+    """Job dict for this company (report included once done), or None."""
+    if not _schema_exists(cur): return None
+    cur.execute("""
+        SELECT id, kind, dry_run, status, rows_processed, report, error,
+               status IN ('queued', 'running') AND created_at < NOW() - make_interval(secs => %s)
+        FROM import_jobs WHERE id = %s AND company_id = %s
+    """, (IMPORT_JOB_STALE_AFTER, job_id, company_id))
+    row = cur.fetchone()
+    if not row: return None
+
+    job = {'id': row[0], 'kind': row[1], 'dry_run': row[2], 'status': row[3],
+           'rows_processed': row[4], 'report': row[5], 'error': row[6]}
+    if row[7]:
+        # The worker running it went away - its transaction was rolled back with it
+        _update_job(job_id, finished=True, status='failed', error='Import did not finish (worker restarted?)')
+        job.update(status='failed', error='Import did not finish (worker restarted?) - nothing was saved.')
+    return job
@@ -1,16 +1,76 @@
 # services/calculators/__init__.py
-from .fencing import FencingCalculator
-from .roofing import RoofingCalculator
+import json
+import hashlib
+import pkgutil
+import importlib
+import threading
+from collections.abc import Mapping
+from .base import BaseCalculator
 
-# Register available calculators here
-# If you add patio.py later, import it here and add to the dict.
-AVAILABLE_CALCS = {
-    'fencing': FencingCalculator(),
-    'roofing': RoofingCalculator(),
-}
+# --- CALCULATOR REGISTRY ---
+# Every module in this package (except base.py) is a trade calculator; the
+# module name is the trade id used in /api/calculate/<trade_type>. To add
+# one, drop e.g. patio.py in here with a BaseCalculator subclass - no
+# registration needed. Modules are only scanned by name at startup and
+# imported the first time that trade is asked for, so dozens of calculators
+# don't slow boot.
+
+_NOT_CALCULATORS = {'base'}
+_lock = threading.Lock()
+_instances = {}
+_meta = None   # (schema list, etag) - built once per process
+
+def _discover():
+    return sorted(m.name for m in pkgutil.iter_modules(__path__)
+                  if not m.ispkg and not m.name.startswith('_') and m.name not in _NOT_CALCULATORS)
+
+CALCULATOR_NAMES = _discover()
+
+def _load(trade_type):
+    module = importlib.import_module(f"{__name__}.{trade_type}")
+    for obj in vars(module).values():
+        if (isinstance(obj, type) and issubclass(obj, BaseCalculator) and obj is not BaseCalculator
+                and obj.__module__ == module.__name__):
+            return obj()
+    raise ImportError(f"{module.__name__} has no BaseCalculator subclass")
+
+class _Registry(Mapping):
+    """{trade id: calculator instance}, importing each module on first access."""
+
+    def __getitem__(self, trade_type):
+        calc = _instances.get(trade_type)
+        if calc is not None:
+            return calc
+        if trade_type not in CALCULATOR_NAMES:
+            raise KeyError(trade_type)
+        with _lock:
+            if trade_type not in _instances:
+                _instances[trade_type] = _load(trade_type)
+            return _instances[trade_type]
+
+    def __iter__(self):
+        return iter(CALCULATOR_NAMES)
+
+    def __len__(self):
+        return len(CALCULATOR_NAMES)
+
+AVAILABLE_CALCS = _Registry()
 
 def get_calculator(trade_type):
     """
     Factory function to retrieve the correct calculator class.
     """
-    return AVAILABLE_CALCS.get(trade_type)
\ No newline at end of file
+    if not isinstance(trade_type, str): return None
+    return AVAILABLE_CALCS.get(trade_type)
+
+def calculator_meta():
+    """
+    (schemas, etag) for the quote builder's trade picker. Configs are static,
+    so this is built once per process; the ETag lets browsers revalidate with a 304.
+    """
+    global _meta
+    if _meta is None:
+        schemas = [calc.get_config() for calc in AVAILABLE_CALCS.values()]
+        etag = hashlib.sha1(json.dumps(schemas, sort_keys=True).encode('utf-8')).hexdigest()
+        _meta = (schemas, etag)
+    return _meta
@@ -1,3 +1,16 @@
+import os
+import math
+import threading
+
+# --- REQUIREMENT MEMO ---
+# Bids for housing associations price the same fence run or roof size many
+# times over. requirements() keys the inputs on the calculator's own fields
+# (numbers as floats, so "20" and 20.0 are the same job) and only runs
+# calculate_requirements() once per distinct input set per process.
+CALC_MEMO_SIZE = int(os.environ.get("CALC_MEMO_SIZE", 4096))  # Per calculator
+
+_memo_lock = threading.Lock()
+
 class BaseCalculator:
     """
     The blueprint for all trade calculators.
@@ -31,4 +44,43 @@ class BaseCalculator:
         - 'labor_hours': Estimated man-hours to complete.
         - 'waste_load': Estimated waste in kg/bags.
         """
-        raise NotImplementedError("Every calculator must implement this method!")
\ No newline at end of file
+        raise NotImplementedError("Every calculator must implement this method!")
+
+    # --- Shared helpers (don't override) ---
+    def normalise_inputs(self, inputs):
+        """
+        The inputs this calculator reads, as a hashable key. Fields not sent are
+        left out so calculate_requirements() still applies its own defaults.
+        """
+        key = []
+        for field in self.get_config().get('fields', []):
+            fid = field['id']
+            if fid not in inputs or inputs[fid] is None or inputs[fid] == '':
+                continue
+            value = inputs[fid]
+            if field.get('type') == 'number':
+                try: value = float(value)
+                except (TypeError, ValueError): value = math.nan
+                if not math.isfinite(value):
+                    # 'inf' / 'nan' parse as floats but blow up the trade maths (math.ceil)
+                    raise ValueError(f"{field.get('label', fid)} must be a number")
+            else:
+                value = str(value)
+            key.append((fid, value))
+        return tuple(key)
+
+    def requirements(self, inputs):
+        """
+        Memoized calculate_requirements(). The result is shared between
+        callers - read it, don't modify it.
+        """
+        key = self.normalise_inputs(inputs or {})
+        memo = self.__dict__.setdefault('_memo', {})
+        result = memo.get(key)
+        if result is None:
+            result = self.calculate_requirements(dict(key))
+            with _memo_lock:
+                if len(memo) >= CALC_MEMO_SIZE:
+                    memo.clear()
+                memo[key] = result
+        return result
@@ -0,0 +1,451 @@
+# --- services/email_queue.py ---
+import os
+import time
+import random
+import smtplib
+import threading
+from psycopg2 import Binary
+from psycopg2.extras import execute_values
+from db import get_db
+from email_service import smtp_config, open_smtp, build_message
+from services.settings_cache import get_settings
+from services.finance_rollups import refresh_rollups, month_of
+
+# --- OUTBOUND EMAIL QUEUE ---
+# Invoice / quote / notification emails used to open a fresh SMTP connection
+# (connect + STARTTLS + login) inside the request, so a slow mail server held
+# the page and a failure lost the email. Now routes call enqueue_email() in
+# their own transaction and return; the message (and its PDFs) sit in
+# 'email_outbox' until a daemon thread in one of the workers claims it
+# (FOR UPDATE SKIP LOCKED, so workers never double-claim).
+#
+# The sender keeps one SMTP session per tenant open across messages and
+# closes it after EMAIL_SMTP_IDLE seconds without mail. Failures are retried
+# with exponential backoff (EMAIL_RETRY_BASE * 2^attempt, capped) up to
+# EMAIL_MAX_ATTEMPTS; 5xx rejections of the recipient fail straight away.
+# Sends are rate limited per SMTP host (EMAIL_HOST_RATE / EMAIL_HOST_BURST).
+# The outcome is written back to invoices / quotes (email_status, emailed_at).
+# Tables and columns are created by /admin/setup-indexes-db (ensure_email_tables).
+EMAIL_QUEUE_WORKER = os.environ.get("EMAIL_QUEUE_WORKER", "1" if os.environ.get("DATABASE_URL") else "0") == "1"
+EMAIL_POLL_INTERVAL = float(os.environ.get("EMAIL_POLL_INTERVAL", 5))
+EMAIL_BATCH_SIZE = int(os.environ.get("EMAIL_BATCH_SIZE", 20))
+EMAIL_MAX_ATTEMPTS = int(os.environ.get("EMAIL_MAX_ATTEMPTS", 6))
+EMAIL_RETRY_BASE = float(os.environ.get("EMAIL_RETRY_BASE", 30))
+EMAIL_RETRY_MAX = float(os.environ.get("EMAIL_RETRY_MAX", 3600))
+EMAIL_SMTP_IDLE = float(os.environ.get("EMAIL_SMTP_IDLE", 60))
+EMAIL_SMTP_MAX_PER_SESSION = int(os.environ.get("EMAIL_SMTP_MAX_PER_SESSION", 100))   # Many providers cap messages per connection
+EMAIL_SENDING_STALE_AFTER = int(os.environ.get("EMAIL_SENDING_STALE_AFTER", 600))    # 'sending' rows of a worker that died
+EMAIL_RETAIN_DAYS = int(os.environ.get("EMAIL_RETAIN_DAYS", 30))
+# Per SMTP host, per worker process: bulk runs (statements) mustn't trip the
+# provider's sending limits. Messages over the limit wait in the queue.
+EMAIL_HOST_RATE = float(os.environ.get("EMAIL_HOST_RATE", 60))     # messages / minute, 0 = unlimited
+EMAIL_HOST_BURST = float(os.environ.get("EMAIL_HOST_BURST", 10))
+
+# Where delivery status is recorded, per ref_type
+REF_TABLES = {'invoice': 'invoices', 'quote': 'quotes'}
+
+_worker_pid = None
+_worker_lock = threading.Lock()
+_wake = threading.Event()
+_schema_ready = False
+_last_housekeeping = 0.0
+
+# Per-process counters
+_stats = {
+    'sent': 0,
+    'retried': 0,
+    'failed': 0,
+    'deferred': 0,       # held back by the per-host rate limit
+    'connections': 0,     # SMTP logins (sent / connections = reuse ratio)
+    'cycles_failed': 0,
+    'last_error': None
+}
+
+def ensure_email_tables(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS email_outbox (
+            id SERIAL PRIMARY KEY,
+            company_id INTEGER,
+            to_email TEXT NOT NULL,
+            subject TEXT,
+            body TEXT,
+            body_type VARCHAR(10) DEFAULT 'html',
+            status VARCHAR(20) NOT NULL DEFAULT 'queued',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            claimed_at TIMESTAMP,
+            last_error TEXT,
+            ref_type VARCHAR(20),
+            ref_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sent_at TIMESTAMP
+        );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_email_outbox_due ON email_outbox (next_attempt_at) WHERE status = 'queued';")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_email_outbox_ref ON email_outbox (ref_type, ref_id);")
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS email_outbox_attachments (
+            id SERIAL PRIMARY KEY,
+            email_id INTEGER NOT NULL REFERENCES email_outbox(id) ON DELETE CASCADE,
+            filename VARCHAR(255),
+            content BYTEA
+        );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_email_outbox_attachments_email ON email_outbox_attachments (email_id);")
+
+    # Delivery status columns - only ALTER when missing (ALTER locks the table)
+    cur.execute("""
+        SELECT table_name, column_name FROM information_schema.columns
+        WHERE table_name IN ('invoices', 'quotes') AND column_name IN ('email_status', 'emailed_at')
+    """)
+    existing = set(cur.fetchall())
+    for table in REF_TABLES.values():
+        if (table, 'email_status') not in existing:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS email_status VARCHAR(20)")
+        if (table, 'emailed_at') not in existing:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS emailed_at TIMESTAMP")
+
+def _schema_exists(cur):
+    # Tables come from the /admin/setup-indexes-db migration (ensure_email_tables),
+    # never from a request: DDL there would commit the caller's transaction.
+    global _schema_ready
+    if not _schema_ready:
+        cur.execute("SELECT to_regclass('email_outbox') IS NOT NULL")
+        _schema_ready = cur.fetchone()[0]
+        if not _schema_ready:
+            print("⚠️ Email Queue: email_outbox missing - run /admin/setup-indexes-db")
+    return _schema_ready
+
+# =========================================================
+# ENQUEUE
+# =========================================================
+def enqueue_email(cur, company_id, to_email, subject, body, body_type='html', attachments=None, ref=None):
+    """
+    Queues an email and returns its outbox id. Runs in the caller's
+    transaction and never commits - nothing is sent unless the caller commits.
+    attachments: [(filename, bytes)]. ref: ('invoice' | 'quote', id) to
+    have the delivery status written back onto that document.
+    """
+    ref_type, ref_id = ref if ref else (None, None)
+    cur.execute("""
+        INSERT INTO email_outbox (company_id, to_email, subject, body, body_type, ref_type, ref_id)
+        VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id
+    """, (company_id, to_email, subject, body, body_type, ref_type, ref_id))
+    email_id = cur.fetchone()[0]
+
+    if attachments:
+        execute_values(cur, "INSERT INTO email_outbox_attachments (email_id, filename, content) VALUES %s",
+                       [(email_id, filename, Binary(bytes(content))) for filename, content in attachments])
+    if ref_type in REF_TABLES:
+        cur.execute(f"UPDATE {REF_TABLES[ref_type]} SET email_status = 'Queued' WHERE id = %s AND company_id = %s",
+                    (ref_id, company_id))
+
+    start_email_worker()
+    _wake.set()
+    return email_id
+
+# =========================================================
+# SMTP SESSIONS (one per tenant, worker thread only)
+# =========================================================
+class _TenantSession:
+    def __init__(self, config):
+        self.config = config
+        self.server = open_smtp(*config)
+        self.sent = 0
+        self.last_used = time.monotonic()
+        _stats['connections'] += 1
+
+    def close(self):
+        try: self.server.quit()
+        except Exception:
+            try: self.server.close()
+            except Exception: pass
+
+_sessions = {}
+_buckets = {}   # SMTP host -> (tokens, monotonic stamp)
+
+def _session_for(company_id, config):
+    session = _sessions.get(company_id)
+    if session and (session.config != config  # SMTP settings were changed
+                    or session.sent >= EMAIL_SMTP_MAX_PER_SESSION
+                    or time.monotonic() - session.last_used > EMAIL_SMTP_IDLE):
+        _drop_session(company_id)
+        session = None
+    if session is None:
+        session = _sessions[company_id] = _TenantSession(config)
+    return session
+
+def _drop_session(company_id):
+    session = _sessions.pop(company_id, None)
+    if session: session.close()
+
+def _close_idle_sessions():
+    now = time.monotonic()
+    for company_id in [c for c, s in _sessions.items() if now - s.last_used > EMAIL_SMTP_IDLE]:
+        _drop_session(company_id)
+
+def _deliver(company_id, config, msg):
+    """Sends on the tenant's session; one reconnect if the server had hung up on us."""
+    session = _session_for(company_id, config)
+    try:
+        session.server.send_message(msg)
+    except (smtplib.SMTPServerDisconnected, ConnectionError):
+        _drop_session(company_id)
+        session = _session_for(company_id, config)
+        session.server.send_message(msg)
+    session.sent += 1
+    session.last_used = time.monotonic()
+
+def _is_permanent(error):
+    # 5xx for this message (bad recipient, rejected content) won't change on retry.
+    # Auth failures are 5xx too, but get fixed in settings - keep retrying those.
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return True
+    if isinstance(error, smtplib.SMTPAuthenticationError):
+        return False
+    return isinstance(error, smtplib.SMTPResponseException) and 500 <= error.smtp_code < 600
+
+# =========================================================
+# WORKER
+# =========================================================
+def _connect():
+    conn = get_db()
+    if conn is None:
+        raise RuntimeError("no database connection")
+    return conn
+
+def _claim(cur):
+    cur.execute("""
+        UPDATE email_outbox SET status = 'sending', claimed_at = NOW(), attempts = attempts + 1
+        WHERE id IN (
+            SELECT id FROM email_outbox
+            WHERE status = 'queued' AND next_attempt_at <= NOW()
+            ORDER BY next_attempt_at, id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, company_id, to_email, subject, body, body_type, attempts, ref_type, ref_id
+    """, (EMAIL_BATCH_SIZE,))
+    rows = cur.fetchall()
+    if not rows: return []
+
+    cur.execute("SELECT email_id, filename, content FROM email_outbox_attachments WHERE email_id = ANY(%s) ORDER BY id",
+                ([r[0] for r in rows],))
+    files = {}
+    for email_id, filename, content in cur.fetchall():
+        files.setdefault(email_id, []).append((filename, bytes(content)))
+
+    return [{
+        'id': r[0], 'company_id': r[1], 'to': r[2], 'subject': r[3], 'body': r[4],
+        'body_type': r[5] or 'html', 'attempts': r[6], 'ref_type': r[7], 'ref_id': r[8],
+        'attachments': files.get(r[0], [])
+    } for r in rows]
+
+def _throttle(host):
+    """
+    0 if a message may go to this SMTP host now, else seconds to wait.
+    Token bucket: EMAIL_HOST_BURST straight away, then EMAIL_HOST_RATE per minute.
+    """
+    rate = EMAIL_HOST_RATE / 60.0
+    if rate <= 0: return 0
+    now = time.monotonic()
+    tokens, stamp = _buckets.get(host, (EMAIL_HOST_BURST, now))
+    tokens = min(EMAIL_HOST_BURST, tokens + (now - stamp) * rate)
+    if tokens < 1:
+        _buckets[host] = (tokens, now)
+        return (1 - tokens) / rate
+    _buckets[host] = (tokens - 1, now)
+    return 0
+
+def _send_batch(emails):
+    """
+    Sends a claimed batch grouped by tenant. Returns [(email, outcome, detail)]
+    with outcome 'sent' | 'retry' | 'failed' (detail = error) or 'deferred'
+    (detail = seconds until the host's rate limit allows another message).
+    """
+    results = []
+    by_company = {}
+    for email in emails:
+        by_company.setdefault(email['company_id'], []).append(email)
+
+    for company_id, batch in by_company.items():
+        settings = get_settings(company_id)
+        config = smtp_config(settings)
+        broken = None if config else "Missing SMTP settings"
+
+        for email in batch:
+            if broken:
+                # This tenant's server is unreachable - don't hammer it for every message
+                results.append((email, 'retry', broken))
+                continue
+            wait = _throttle(config[0])
+            if wait:
+                # Not a failure: hand it back without using up an attempt
+                results.append((email, 'deferred', wait))
+                continue
+            try:
+                msg = build_message(config[2], email['to'], email['subject'], email['body'],
+                                    email['body_type'], email['attachments'])
+                _deliver(company_id, config, msg)
+                results.append((email, 'sent', None))
+            except Exception as e:
+                error = repr(e)[:500]
+                if _is_permanent(e):
+                    results.append((email, 'failed', error))
+                else:
+                    results.append((email, 'retry', error))
+                    _drop_session(company_id)
+                    broken = error
+    return results
+
+def _record(cur, results):
+    for email, outcome, detail in results:
+        ref_table = REF_TABLES.get(email['ref_type'])
+        if outcome == 'sent':
+            cur.execute("UPDATE email_outbox SET status = 'sent', sent_at = NOW(), last_error = NULL WHERE id = %s",
+                        (email['id'],))
+            _stats['sent'] += 1
+            if email['ref_type'] == 'invoice':
+                # Only advance the workflow - never undo a payment recorded while the email sat in the queue
+                cur.execute("""
+                    UPDATE invoices SET email_status = 'Sent', emailed_at = NOW(),
+                           status = CASE WHEN status = 'Paid' THEN status ELSE 'Sent' END
+                    WHERE id = %s AND company_id = %s RETURNING date
+                """, (email['ref_id'], email['company_id']))
+                row = cur.fetchone()
+                if row: refresh_rollups(cur, email['company_id'], 'invoices', month_of(row[0]))
+            elif email['ref_type'] == 'quote':
+                cur.execute("""
+                    UPDATE quotes SET email_status = 'Sent', emailed_at = NOW(),
+                           status = CASE WHEN status IN ('Accepted', 'Converted') THEN status ELSE 'Sent' END
+                    WHERE id = %s AND company_id = %s
+                """, (email['ref_id'], email['company_id']))
+        elif outcome == 'deferred':
+            cur.execute("""
+                UPDATE email_outbox SET status = 'queued', attempts = attempts - 1,
+                       next_attempt_at = NOW() + make_interval(secs => %s)
+                WHERE id = %s
+            """, (detail, email['id']))
+            _stats['deferred'] += 1
+        elif outcome == 'failed' or email['attempts'] >= EMAIL_MAX_ATTEMPTS:
+            cur.execute("UPDATE email_outbox SET status = 'failed', last_error = %s WHERE id = %s", (detail, email['id']))
+            _stats['failed'] += 1
+            print(f"❌ Email {email['id']} to {email['to']} failed after {email['attempts']} attempt(s): {detail}")
+            if ref_table:
+                cur.execute(f"UPDATE {ref_table} SET email_status = 'Failed' WHERE id = %s AND company_id = %s",
+                            (email['ref_id'], email['company_id']))
+        else:
+            delay = min(EMAIL_RETRY_MAX, EMAIL_RETRY_BASE * 2 ** (email['attempts'] - 1))
+            delay *= random.uniform(0.8, 1.2)  # Jitter, so a recovered server isn't hit by everything at once
+            cur.execute("""
+                UPDATE email_outbox SET status = 'queued', last_error = %s,
+                       next_attempt_at = NOW() + make_interval(secs => %s)
+                WHERE id = %s
+            """, (detail, delay, email['id']))
+            _stats['retried'] += 1
+            if ref_table:
+                cur.execute(f"UPDATE {ref_table} SET email_status = 'Retrying' WHERE id = %s AND company_id = %s",
+                            (email['ref_id'], email['company_id']))
+
+def _housekeeping(cur):
+    global _last_housekeeping
+    if time.monotonic() - _last_housekeeping < 300: return
+    _last_housekeeping = time.monotonic()
+    # Claimed by a worker that died mid-send: hand it back (at-least-once delivery)
+    cur.execute("""
+        UPDATE email_outbox SET status = 'queued', next_attempt_at = NOW()
+        WHERE status = 'sending' AND claimed_at < NOW() - make_interval(secs => %s)
+    """, (EMAIL_SENDING_STALE_AFTER,))
+    cur.execute("""
+        DELETE FROM email_outbox
+        WHERE status IN ('sent', 'failed') AND created_at < NOW() - make_interval(days => %s)
+    """, (EMAIL_RETAIN_DAYS,))
+
+def process_queue():
+    """
+    Claims and sends due emails until the queue is empty. Returns the number
+    of emails handled. The DB connection is released while SMTP is talking.
+    """
+    handled = 0
+    while True:
+        conn = _connect()
+        try:
+            cur = conn.cursor()
+            if not _schema_exists(cur):
+                return handled
+            _housekeeping(cur)
+            emails = _claim(cur)
+            conn.commit()
+        finally:
+            conn.close()
+        if not emails:
+            return handled
+
+        results = _send_batch(emails)
+
+        conn = _connect()
+        try:
+            _record(conn.cursor(), results)
+            conn.commit()
+        except Exception:
+            try: conn.rollback()
+            except Exception: pass
+            raise
+        finally:
+            conn.close()
+        handled += len(emails)
+
+def _run_forever():
+    time.sleep(random.uniform(0, 2))
+    while True:
+        try:
+            process_queue()
+        except Exception as e:
+            _stats['cycles_failed'] += 1
+            _stats['last_error'] = str(e)
+            print(f"❌ Email Queue Error: {e}")
+        _close_idle_sessions()
+        if _wake.wait(EMAIL_POLL_INTERVAL):
+            _wake.clear()
+            time.sleep(0.2)  # enqueue_email() runs before the caller's commit
+
+def start_email_worker():
+    """Starts the sender thread for this process (once per pid, safe on every request)."""
+    global _worker_pid
+    if not EMAIL_QUEUE_WORKER or _worker_pid == os.getpid():
+        return
+    with _worker_lock:
+        if _worker_pid == os.getpid():
+            return
+        _sessions.clear()  # Sockets inherited through fork belong to the parent
+        threading.Thread(target=_run_forever, name="email-queue", daemon=True).start()
+        _worker_pid = os.getpid()
+
+# =========================================================
+# METRICS
+# =========================================================
+def get_email_queue_metrics(cur):
+    """Queue depth by status, oldest due message and this worker's counters."""
+    metrics = {
+        'pid': os.getpid(),
+        'enabled': EMAIL_QUEUE_WORKER,
+        'thread_running': _worker_pid == os.getpid(),
+        'open_smtp_sessions': len(_sessions),
+        'this_worker': dict(_stats)
+    }
+    try:
+        cur.execute("SAVEPOINT email_metrics")
+        cur.execute("SELECT status, COUNT(*) FROM email_outbox GROUP BY status")
+        metrics['by_status'] = dict(cur.fetchall())
+        cur.execute("""
+            SELECT EXTRACT(EPOCH FROM NOW() - MIN(next_attempt_at))
+            FROM email_outbox WHERE status = 'queued' AND next_attempt_at <= NOW()
+        """)
+        lag = cur.fetchone()[0]
+        metrics['oldest_due_s'] = round(float(lag), 1) if lag is not None else None
+        cur.execute("RELEASE SAVEPOINT email_metrics")
+    except Exception as e:
+        try: cur.execute("ROLLBACK TO SAVEPOINT email_metrics")
+        except Exception: pass
+        metrics['error'] = f"Email queue tables not available: {e}"
+    return metrics
@@ -0,0 +1,204 @@
+# --- services/finance_rollups.py ---
+import os
+from datetime import date
+from db import get_pooled_db
+
+# --- PER-TENANT FINANCIAL ROLLUPS ---
+# The finance dashboards used to SUM every invoice / expense / fleet log on
+# each page load. Instead we keep one row per
+# (company, month, source, bucket) in 'finance_rollups' and refresh only the
+# affected source (and month, when known) whenever money moves.
+#
+# Write paths call refresh_rollups(cur, company_id, source, period) BEFORE
+# their conn.commit(), so the rollup lands in the same transaction as the
+# change. The refresh runs inside a SAVEPOINT: if it fails, the user's write
+# still commits and the tenant is simply flagged for a full rebuild.
+#
+# Safety net: get_rollups() rebuilds a tenant whose rollups are missing or
+# older than ROLLUP_MAX_AGE seconds, which catches writers without a hook.
+# The rebuild commits on a pool connection of its own, never the caller's.
+# Tables are created by /admin/setup-indexes-db (ensure_rollup_tables).
+ROLLUP_MAX_AGE = int(os.environ.get("ROLLUP_MAX_AGE", 3600))
+
+# Undated rows (and recurring overheads) are filed under this period
+STANDING_PERIOD = date(1970, 1, 1)
+
+# source -> how to aggregate it. 'bucket' splits a source (e.g. invoice status).
+SOURCES = {
+    'invoices':     {'table': 'invoices', 'company_col': 'company_id', 'amount': 'total', 'bucket': "COALESCE(status, '')", 'date': 'date'},
+    'job_expenses': {'table': 'job_expenses', 'company_col': 'company_id', 'amount': 'cost', 'bucket': "''", 'date': 'date'},
+    'fleet':        {'table': 'maintenance_logs', 'company_col': 'company_id', 'amount': 'cost', 'bucket': "''", 'date': 'date'},
+    'overheads':    {'table': 'overhead_items JOIN overhead_categories oc ON overhead_items.category_id = oc.id', 'company_col': 'oc.company_id', 'amount': 'overhead_items.amount', 'bucket': "''", 'date': None},
+}
+
+_schema_ready = False
+
+def ensure_rollup_tables(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS finance_rollups (
+            company_id INTEGER NOT NULL,
+            period DATE NOT NULL,
+            source VARCHAR(30) NOT NULL,
+            bucket VARCHAR(50) NOT NULL DEFAULT '',
+            amount DECIMAL(14,2) NOT NULL DEFAULT 0.00,
+            row_count INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (company_id, period, source, bucket)
+        );
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS finance_rollup_state (
+            company_id INTEGER PRIMARY KEY,
+            built_at TIMESTAMP
+        );
+    """)
+
+def month_of(d):
+    """First day of the month for a date/datetime, STANDING_PERIOD for None."""
+    if not d: return STANDING_PERIOD
+    return date(d.year, d.month, 1)
+
+def _refresh_sql(source, period):
+    spec = SOURCES[source]
+    if spec['date']:
+        period_expr = f"COALESCE(date_trunc('month', {spec['date']})::date, %(standing)s)"
+    else:
+        period_expr = "%(standing)s::date"
+
+    range_sql = ""
+    if period is not None:
+        if not spec['date']:
+            range_sql = ""  # undated source: the only period is STANDING_PERIOD
+        elif period == STANDING_PERIOD:
+            range_sql = f"AND {spec['date']} IS NULL"
+        else:
+            range_sql = f"AND {spec['date']} >= %(period)s AND {spec['date']} < %(period)s + INTERVAL '1 month'"
+
+    return f"""
+        WITH fresh AS (
+            SELECT %(company_id)s AS company_id, {period_expr} AS period, %(source)s AS source,
+                   {spec['bucket']} AS bucket, COALESCE(SUM({spec['amount']}), 0) AS amount, COUNT(*) AS row_count
+            FROM {spec['table']}
+            WHERE {spec['company_col']} = %(company_id)s {range_sql}
+            GROUP BY 2, 4
+        ),
+        upserted AS (
+            INSERT INTO finance_rollups (company_id, period, source, bucket, amount, row_count, updated_at)
+            SELECT company_id, period, source, bucket, amount, row_count, NOW() FROM fresh
+            ON CONFLICT (company_id, period, source, bucket)
+            DO UPDATE SET amount = EXCLUDED.amount, row_count = EXCLUDED.row_count, updated_at = NOW()
+        )
+        DELETE FROM finance_rollups r
+        WHERE r.company_id = %(company_id)s AND r.source = %(source)s
+          {"AND r.period = %(period)s" if period is not None else ""}
+          AND NOT EXISTS (SELECT 1 FROM fresh f WHERE f.period = r.period AND f.bucket = r.bucket)
+    """
+
+def _run(cur, company_id, source, period):
+    cur.execute(_refresh_sql(source, period), {
+        'company_id': company_id, 'source': source,
+        'period': period, 'standing': STANDING_PERIOD
+    })
+
+def refresh_rollups(cur, company_id, source, period=None):
+    """
+    Recompute one source for a tenant. Pass 'period' (see month_of) to limit
+    it to a single month. Never raises - returns False if the refresh failed.
+    """
+    if not company_id or source not in SOURCES: return False
+    try:
+        cur.execute("SAVEPOINT finance_rollup")
+    except Exception as e:
+        print(f"❌ Rollup Savepoint Error: {e}")
+        return False
+
+    try:
+        _run(cur, company_id, source, period)
+        cur.execute("RELEASE SAVEPOINT finance_rollup")
+        return True
+    except Exception as e:
+        print(f"❌ Rollup Refresh Error ({source}, company {company_id}): {e}")
+        try: cur.execute("ROLLBACK TO SAVEPOINT finance_rollup")
+        except Exception: return False
+
+    # Flag the tenant so the next dashboard load rebuilds from scratch
+    invalidate_rollups(cur, company_id)
+    return False
+
+def invalidate_rollups(cur, company_id=None):
+    """
+    Forces a full rebuild on the next dashboard load (None = every tenant).
+    For bulk deletes/wipes where a targeted refresh isn't worth it.
+    """
+    try:
+        cur.execute("SAVEPOINT finance_rollup_state")
+        if company_id is None:
+            cur.execute("UPDATE finance_rollup_state SET built_at = NULL")
+        else:
+            cur.execute("UPDATE finance_rollup_state SET built_at = NULL WHERE company_id = %s", (company_id,))
+        cur.execute("RELEASE SAVEPOINT finance_rollup_state")
+    except Exception:
+        # Table not created yet - nothing to invalidate
+        try: cur.execute("ROLLBACK TO SAVEPOINT finance_rollup_state")
+        except Exception: pass
+
+def rebuild_rollups(cur, company_id):
+    """Full rebuild of every source for one tenant (caller commits)."""
+    for source in SOURCES:
+        _run(cur, company_id, source, None)
+    cur.execute("""
+        INSERT INTO finance_rollup_state (company_id, built_at) VALUES (%s, NOW())
+        ON CONFLICT (company_id) DO UPDATE SET built_at = NOW()
+    """, (company_id,))
+
+def _rebuild_on_own_connection(company_id):
+    conn = get_pooled_db()
+    if conn is None:
+        raise RuntimeError("no database connection")
+    try:
+        rebuild_rollups(conn.cursor(), company_id)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def get_rollups(cur, company_id):
+    """
+    Returns {'totals': {source: {bucket: amount}}, 'monthly': {period: {source: {bucket: amount}}}}.
+    Read-only on 'cur': a missing or stale tenant is rebuilt (and committed)
+    on a separate pool connection first.
+    """
+    global _schema_ready
+    if not _schema_ready:
+        cur.execute("SELECT to_regclass('finance_rollup_state') IS NOT NULL")
+        if not cur.fetchone()[0]:
+            raise RuntimeError("Finance rollup tables are missing - run /admin/setup-indexes-db")
+        _schema_ready = True
+
+    sql = """
+        SELECT s.built_at < NOW() - make_interval(secs => %s), r.period, r.source, r.bucket, r.amount
+        FROM finance_rollup_state s
+        LEFT JOIN finance_rollups r ON r.company_id = s.company_id
+        WHERE s.company_id = %s AND s.built_at IS NOT NULL
+    """
+    cur.execute(sql, (ROLLUP_MAX_AGE, company_id))
+    rows = cur.fetchall()
+
+    if not rows or rows[0][0]:
+        _rebuild_on_own_connection(company_id)
+        cur.execute(sql, (ROLLUP_MAX_AGE, company_id))
+        rows = cur.fetchall()
+
+    totals = {s: {} for s in SOURCES}
+    monthly = {}
+    for _, period, source, bucket, amount in rows:
+        if source is None: continue
+        amount = float(amount or 0)
+        totals[source][bucket] = totals[source].get(bucket, 0.0) + amount
+        monthly.setdefault(period, {}).setdefault(source, {})[bucket] = amount
+    return {'totals': totals, 'monthly': monthly}
+
+def source_total(buckets, exclude=()):
+    return sum(v for k, v in buckets.items() if k not in exclude)
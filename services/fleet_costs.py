@@ -0,0 +1,74 @@
+# --- services/fleet_costs.py ---
+
+# --- DAILY GANG COST (VAN + DRIVER + CREW) ---
+# One place for the Hour/Day/Year -> daily wage rule that finance, office and
+# quoting all use, and one query that loads every vehicle with its driver and
+# crew (crew aggregated with json_agg) instead of 2 queries per van.
+HOURS_PER_DAY = 8
+WORKING_DAYS_PER_YEAR = 260
+
+def daily_staff_cost(rate, model):
+    """Daily cost of one staff member from their pay rate + pay model."""
+    rate = float(rate or 0)
+    if model == 'Hour': return rate * HOURS_PER_DAY
+    if model == 'Day': return rate
+    if model == 'Year': return rate / WORKING_DAYS_PER_YEAR
+    return 0.0
+
+def daily_staff_cost_sql(alias):
+    """Same rule as daily_staff_cost() as a SQL expression over a 'staff' alias."""
+    return f"""COALESCE(CASE {alias}.pay_model
+                WHEN 'Hour' THEN {alias}.pay_rate * {HOURS_PER_DAY}
+                WHEN 'Day' THEN {alias}.pay_rate
+                WHEN 'Year' THEN {alias}.pay_rate / {WORKING_DAYS_PER_YEAR}
+            END, 0)"""
+
+def get_fleet(cur, company_id, active_only=False, vehicle_id=None):
+    """
+    Every vehicle for a company with driver, crew and 'total_gang_cost'
+    (van daily cost + driver + crew), in ONE query.
+    """
+    filters = ""
+    params = [company_id]
+    if active_only:
+        filters += " AND v.status = 'Active'"
+    if vehicle_id:
+        filters += " AND v.id = %s"
+        params.append(vehicle_id)
+
+    cur.execute(f"""
+        SELECT v.id, v.reg_plate, v.make_model, v.daily_cost, v.status,
+               v.assigned_driver_id, d.name,
+               v.tracker_url,
+               v.mot_expiry, v.tax_expiry, v.ins_expiry, v.service_expiry,
+               COALESCE(crew.members, '[]'::json),
+               COALESCE(v.daily_cost, 0) + {daily_staff_cost_sql('d')} + COALESCE(crew.daily_wages, 0)
+        FROM vehicles v
+        LEFT JOIN staff d ON v.assigned_driver_id = d.id
+        LEFT JOIN LATERAL (
+            SELECT json_agg(json_build_object('id', s.id, 'name', s.name) ORDER BY s.name) AS members,
+                   SUM({daily_staff_cost_sql('s')}) AS daily_wages
+            FROM vehicle_crews vc
+            JOIN staff s ON vc.staff_id = s.id
+            WHERE vc.vehicle_id = v.id
+        ) crew ON TRUE
+        WHERE v.company_id = %s {filters}
+        ORDER BY v.reg_plate
+    """, params)
+
+    return [{
+        'id': r[0],
+        'reg_plate': r[1],
+        'make_model': r[2],
+        'daily_cost': r[3] or 0.0,
+        'status': r[4],
+        'assigned_driver_id': r[5],
+        'driver_name': r[6],
+        'tracker_url': r[7],
+        'mot_expiry': r[8],
+        'tax_expiry': r[9],
+        'ins_expiry': r[10],
+        'service_expiry': r[11],
+        'crew': r[12],
+        'total_gang_cost': float(r[13] or 0)
+    } for r in cur.fetchall()]
@@ -0,0 +1,239 @@
+# --- services/live_updates.py ---
+import os
+import json
+import time
+import queue
+import threading
+from db import get_db
+from services.settings_cache import get_setting
+from services.telematics_poller import read_positions
+
+# --- LIVE MAP UPDATES (SERVER-SENT EVENTS) ---
+# /track/<ref> and Live Ops used to need a full page reload (joined query +
+# telematics lookup) to move a van. Now the page opens an EventSource and
+# subscribes to a topic - ('job', ref) or ('fleet', company_id).
+#
+# One hub thread per worker loads each topic that has viewers once every
+# LIVE_PUSH_INTERVAL seconds, diffs it against the previous load and pushes
+# only the changed items to every subscriber's queue. N viewers of the same
+# fleet cost one load per interval, not N.
+#
+# Each open stream holds a gunicorn thread (the Dockerfile runs the gthread
+# worker with 8 threads). Streams end after LIVE_STREAM_MAX_SECONDS (the
+# browser reconnects on its own), and each process holds at most
+# LIVE_MAX_STREAMS open - half the threads, so live maps can never starve
+# normal page loads. Past that the client is told to retry later and keeps
+# the server-rendered view. Raise it only together with --threads.
+LIVE_PUSH_INTERVAL = float(os.environ.get("LIVE_PUSH_INTERVAL", 5))
+LIVE_HEARTBEAT = float(os.environ.get("LIVE_HEARTBEAT", 15))
+LIVE_STREAM_MAX_SECONDS = float(os.environ.get("LIVE_STREAM_MAX_SECONDS", 300))
+LIVE_MAX_STREAMS = int(os.environ.get("LIVE_MAX_STREAMS", 4))   # Keep well under gunicorn --threads
+LIVE_RETRY_MS = int(os.environ.get("LIVE_RETRY_MS", 3000))
+LIVE_QUEUE_SIZE = 50
+
+# =========================================================
+# TOPIC LOADERS: (cur, arg) -> {item_key: payload}
+# =========================================================
+def load_fleet(cur, company_id):
+    cur.execute("""
+        SELECT v.id, v.reg_plate, v.tracker_url, d.name
+        FROM vehicles v
+        LEFT JOIN staff d ON v.assigned_driver_id = d.id
+        WHERE v.company_id = %s
+    """, (company_id,))
+    vehicles = cur.fetchall()
+
+    api_key = get_setting(company_id, 'samsara_api_key')
+    positions = read_positions(cur, company_id, [v[2] for v in vehicles], api_key=api_key)
+
+    items = {}
+    for v_id, reg, tracker, driver in vehicles:
+        pos = positions.get(tracker) if tracker else None
+        if not pos or pos.get('lat') is None: continue
+        items[str(v_id)] = {
+            'id': v_id, 'reg': reg, 'driver': driver,
+            'lat': pos.get('lat'), 'lon': pos.get('lon'),
+            'speed': pos.get('speed'), 'fuel_level': pos.get('fuel_level'),
+            'status': pos.get('status')
+        }
+    return items
+
+def load_job(cur, job_ref):
+    cur.execute("""
+        SELECT j.status, j.company_id, v.tracker_url
+        FROM jobs j
+        LEFT JOIN vehicles v ON j.vehicle_id = v.id
+        WHERE j.ref = %s
+    """, (job_ref,))
+    row = cur.fetchone()
+    if not row: return {}
+
+    items = {'job': {'status': row[0]}}
+    if row[2]:
+        api_key = get_setting(row[1], 'samsara_api_key')
+        pos = read_positions(cur, row[1], [row[2]], api_key=api_key).get(row[2])
+        if pos and pos.get('lat') is not None:
+            items['van'] = {'lat': pos.get('lat'), 'lon': pos.get('lon'), 'speed': pos.get('speed')}
+    return items
+
+LOADERS = {
+    'fleet': load_fleet,
+    'job': load_job
+}
+
+# =========================================================
+# FAN-OUT HUB
+# =========================================================
+class Subscription:
+    def __init__(self, topic):
+        self.topic = topic
+        self.queue = queue.Queue(maxsize=LIVE_QUEUE_SIZE)
+
+    def push(self, event, data):
+        try:
+            self.queue.put_nowait((event, data))
+        except queue.Full:
+            # Client isn't reading - end its stream, it will reconnect fresh
+            self.queue = _closed_queue()
+
+def _closed_queue():
+    q = queue.Queue(maxsize=1)
+    q.put_nowait((None, None))
+    return q
+
+class LiveHub:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._subs = {}        # topic -> set(Subscription)
+        self._snapshots = {}   # topic -> last loaded items
+        self._pid = None
+        self.stats = {'loads': 0, 'load_errors': 0, 'events': 0, 'rejected': 0}
+
+    def stream_count(self):
+        return sum(len(s) for s in self._subs.values())
+
+    def subscribe(self, topic):
+        """Returns a Subscription, or None when this worker is at LIVE_MAX_STREAMS."""
+        self._ensure_thread()
+        with self._lock:
+            if self.stream_count() >= LIVE_MAX_STREAMS:
+                self.stats['rejected'] += 1
+                return None
+            sub = Subscription(topic)
+            self._subs.setdefault(topic, set()).add(sub)
+            snapshot = self._snapshots.get(topic)
+
+        if snapshot is not None:
+            sub.push('snapshot', snapshot)
+        else:
+            self._wake.set()  # First viewer of this topic: load now, not next tick
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            subs = self._subs.get(sub.topic)
+            if subs is None: return
+            subs.discard(sub)
+            if not subs:
+                del self._subs[sub.topic]
+                self._snapshots.pop(sub.topic, None)
+
+    def _ensure_thread(self):
+        # Once per pid (gunicorn forks workers after import)
+        if self._pid == os.getpid(): return
+        with self._lock:
+            if self._pid == os.getpid(): return
+            threading.Thread(target=self._run, name="live-updates", daemon=True).start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            self._wake.wait(LIVE_PUSH_INTERVAL)
+            self._wake.clear()
+            with self._lock:
+                topics = list(self._subs)
+            if not topics: continue
+
+            try:
+                self._tick(topics)
+            except Exception as e:
+                self.stats['load_errors'] += 1
+                print(f"❌ Live Updates Error: {e}")
+
+    def _tick(self, topics):
+        conn = get_db()
+        if conn is None: return
+        try:
+            cur = conn.cursor()
+            for topic in topics:
+                kind, arg = topic
+                try:
+                    items = LOADERS[kind](cur, arg)
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    self.stats['load_errors'] += 1
+                    print(f"❌ Live Updates Load Error ({kind}): {e}")
+                    continue
+                self.stats['loads'] += 1
+                self._publish(topic, items)
+        finally:
+            conn.close()
+
+    def _publish(self, topic, items):
+        with self._lock:
+            subs = list(self._subs.get(topic, ()))
+            previous = self._snapshots.get(topic)
+            if subs: self._snapshots[topic] = items
+
+        if previous is None:
+            event = ('snapshot', items)
+        else:
+            changed = {k: v for k, v in items.items() if previous.get(k) != v}
+            removed = [k for k in previous if k not in items]
+            if not changed and not removed: return
+            event = ('delta', {'changed': changed, 'removed': removed})
+
+        for sub in subs:
+            sub.push(*event)
+        self.stats['events'] += len(subs)
+
+hub = LiveHub()
+
+# =========================================================
+# SSE STREAM
+# =========================================================
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+def event_stream(topic):
+    """
+    Generator of SSE frames for one viewer. Call it after all auth / DB work
+    is done and return it WITHOUT stream_with_context, so the request's pooled
+    connection goes back to the pool instead of being held for the stream.
+    """
+    sub = hub.subscribe(topic)
+    if sub is None:
+        # Over capacity: ask the browser to come back later
+        yield f"retry: {int(LIVE_STREAM_MAX_SECONDS * 1000)}\n\n"
+        return
+
+    try:
+        yield f"retry: {LIVE_RETRY_MS}\n\n"
+        deadline = time.monotonic() + LIVE_STREAM_MAX_SECONDS
+        while time.monotonic() < deadline:
+            try:
+                event, data = sub.queue.get(timeout=min(LIVE_HEARTBEAT, max(0.1, deadline - time.monotonic())))
+            except queue.Empty:
+                yield ": ping\n\n"
+                continue
+            if event is None: break
+            yield _sse(event, data)
+    finally:
+        hub.unsubscribe(sub)
+
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'X-Accel-Buffering': 'no'   # Stop nginx / Render's proxy buffering the stream
+}
@@ -0,0 +1,158 @@
+# --- services/material_import.py ---
+import io
+import os
+import re
+import csv
+import time
+from decimal import Decimal, InvalidOperation
+
+# --- STREAMING PRICE LIST IMPORT ---
+# Supplier price lists used to go in one INSERT per line, and re-uploading a
+# list duplicated every item instead of updating its price. Here the upload
+# is read as a stream and validated CHUNK rows at a time. Each clean chunk
+# is COPY'd into a temp staging table, so memory stays flat however big the
+# catalogue is. The whole file is then merged into 'materials' by
+# (company_id, sku) in two set-based statements:
+#   - UPDATE: SKUs we already have get the new name / price / supplier
+#   - INSERT: new SKUs
+# If a SKU appears twice in the file, the later line wins. Rows that fail
+# validation are skipped and listed in the report with their line number.
+# The DB side is all-or-nothing.
+MATERIAL_IMPORT_CHUNK = int(os.environ.get("MATERIAL_IMPORT_CHUNK", 5000))
+MATERIAL_IMPORT_MAX_ERRORS = int(os.environ.get("MATERIAL_IMPORT_MAX_ERRORS", 1000))  # Listed in the report (the count is always exact)
+
+_PRICE_JUNK = re.compile(r"[£$€\s]")
+_THOUSANDS_COMMA = re.compile(r"\d{1,3}(,\d{3})+(\.\d+)?")   # 1,250 / 1,234.50
+_THOUSANDS_DOT = re.compile(r"\d{1,3}(\.\d{3})+,\d{1,2}")      # 1.234,50
+_DECIMAL_COMMA = re.compile(r"\d+,\d{1,2}")                    # 12,50
+
+def parse_money(raw, label='amount'):
+    """
+    Decimal for a price cell as suppliers / spreadsheets write it: currency
+    signs and spaces ignored, '1,250' and '1,234.50' (comma thousands),
+    '12,50' and '1.234,50' (decimal comma). Any other comma is ambiguous:
+    ValueError rather than a guess that is off by 100x.
+    """
+    text = _PRICE_JUNK.sub('', raw)
+    if not text: return Decimal('0.00')
+    if ',' in text:
+        if _THOUSANDS_COMMA.fullmatch(text):
+            text = text.replace(',', '')
+        elif _THOUSANDS_DOT.fullmatch(text):
+            text = text.replace('.', '').replace(',', '.')
+        elif _DECIMAL_COMMA.fullmatch(text):
+            text = text.replace(',', '.')
+        else:
+            raise ValueError(f"Ambiguous {label} '{raw}' (write 12.50 or 1250)")
+    try:
+        value = Decimal(text)
+    except InvalidOperation:
+        raise ValueError(f"Invalid {label} '{raw}'")
+    if not value.is_finite():
+        raise ValueError(f"Invalid {label} '{raw}'")
+    return value
+
+def _clean(value):
+    # NUL bytes are the one thing COPY can't take in a text column
+    return value.replace('\x00', '').strip()
+
+def parse_material_row(row):
+    """(sku, name, category, unit, cost) for a CSV row, or ValueError saying what's wrong."""
+    if len(row) < 2:
+        raise ValueError("Expected at least SKU and Name")
+    sku, name = _clean(row[0]), _clean(row[1])
+    if not sku: raise ValueError("Missing SKU")
+    if not name: raise ValueError("Missing name")
+    category = (_clean(row[2]) if len(row) > 2 else '') or 'General'
+    unit = (_clean(row[3]) if len(row) > 3 else '') or 'Each'
+
+    raw_cost = _clean(row[4]) if len(row) > 4 else ''
+    cost = parse_money(raw_cost, 'cost price')
+    if cost < 0:
+        raise ValueError(f"Invalid cost price '{raw_cost}'")
+    return sku, name, category, unit, cost
+
+def _ensure_stage(cur):
+    # The merge's (company_id, sku) index comes from /admin/setup-indexes-db
+    cur.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS material_import_stage (
+            line_no INTEGER, sku TEXT, name TEXT, category TEXT, unit TEXT, cost_price NUMERIC(12, 2)
+        ) ON COMMIT DROP;
+    """)
+
+def _copy_chunk(cur, rows):
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    buf.seek(0)
+    cur.copy_expert("COPY material_import_stage (line_no, sku, name, category, unit, cost_price) FROM STDIN WITH (FORMAT csv)", buf)
+
+def import_materials_csv(cur, company_id, supplier_id, text_stream):
+    """
+    Loads a 'SKU, Name, Category, Unit, Cost Price' CSV (header line first)
+    for one company. Runs in the caller's transaction - the caller commits.
+    Returns the report dict (counts, rows/sec, per-row errors).
+    """
+    started = time.monotonic()
+    report = {'rows': 0, 'inserted': 0, 'updated': 0, 'duplicates': 0, 'rejected': 0,
+              'errors': [], 'errors_truncated': False}
+
+    _ensure_stage(cur)
+    reader = csv.reader(text_stream)
+    next(reader, None)  # Skip Header
+
+    chunk, seen = [], set()
+    for row in reader:
+        if not any(cell.strip() for cell in row):
+            continue  # Blank line (spreadsheets love trailing ones)
+        report['rows'] += 1
+        try:
+            sku, name, category, unit, cost = parse_material_row(row)
+        except ValueError as e:
+            report['rejected'] += 1
+            if len(report['errors']) < MATERIAL_IMPORT_MAX_ERRORS:
+                report['errors'].append({'line': reader.line_num, 'sku': row[0].strip() if row else '', 'error': str(e)})
+            else:
+                report['errors_truncated'] = True
+            continue
+
+        if sku in seen: report['duplicates'] += 1
+        else: seen.add(sku)
+        chunk.append((reader.line_num, sku, name, category, unit, cost))
+        if len(chunk) >= MATERIAL_IMPORT_CHUNK:
+            _copy_chunk(cur, chunk)
+            chunk = []
+    if chunk:
+        _copy_chunk(cur, chunk)
+
+    if seen:
+        cur.execute("ANALYZE material_import_stage")
+        # One import per company at a time, so two uploads can't both INSERT the same new SKU
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('material_import'), %s)", (int(company_id),))
+        cur.execute("""
+            WITH latest AS (
+                SELECT DISTINCT ON (sku) sku, name, category, unit, cost_price
+                FROM material_import_stage ORDER BY sku, line_no DESC
+            )
+            UPDATE materials m
+            SET name = l.name, category = l.category, unit = l.unit, cost_price = l.cost_price,
+                supplier_id = COALESCE(%(supplier)s, m.supplier_id)
+            FROM latest l
+            WHERE m.company_id = %(comp)s AND m.sku = l.sku
+        """, {'comp': company_id, 'supplier': supplier_id})
+        report['updated'] = cur.rowcount
+        cur.execute("""
+            INSERT INTO materials (company_id, sku, name, category, unit, cost_price, supplier_id)
+            SELECT DISTINCT ON (s.sku) %(comp)s, s.sku, s.name, s.category, s.unit, s.cost_price, %(supplier)s
+            FROM material_import_stage s
+            WHERE NOT EXISTS (SELECT 1 FROM materials m WHERE m.company_id = %(comp)s AND m.sku = s.sku)
+            ORDER BY s.sku, s.line_no DESC
+        """, {'comp': company_id, 'supplier': supplier_id})
+        report['inserted'] = cur.rowcount
+    cur.execute("TRUNCATE material_import_stage")  # Same transaction may import again
+
+    elapsed = time.monotonic() - started
+    report['seconds'] = round(elapsed, 3)
+    report['rows_per_sec'] = round(report['rows'] / elapsed) if elapsed else report['rows']
+    print(f"📥 Material Import (company {company_id}): {report['rows']} rows in {elapsed:.2f}s "
+          f"({report['rows_per_sec']} rows/s) - {report['inserted']} new, {report['updated']} updated, {report['rejected']} rejected")
+    return report
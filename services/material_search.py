@@ -0,0 +1,124 @@
+# --- services/material_search.py ---
+import os
+import time
+import threading
+
+# --- MATERIAL SEARCH (pg_trgm) ---
+# The search box used to introspect information_schema on every keystroke and
+# then run LOWER(name) LIKE '%q%' (a sequential scan of the whole catalogue).
+# Calculators did the same once per shopping-list line. Now:
+#   - the materials table's metadata (price column name, whether pg_trgm is
+#     installed) is read once per MATERIAL_META_TTL, not per request;
+#   - with pg_trgm, search uses the GIN trigram index on LOWER(name)
+#     (/admin/setup-indexes-db creates it) and ranks by word similarity, so
+#     typos and partial words still find "Copper Pipe 15mm x 3m";
+#   - resolve_materials() prices a whole shopping list in ONE query.
+# Without pg_trgm everything falls back to plain LIKE matching.
+MATERIAL_META_TTL = float(os.environ.get("MATERIAL_META_TTL", 600))
+MATERIAL_SEARCH_LIMIT = int(os.environ.get("MATERIAL_SEARCH_LIMIT", 10))
+
+_meta = {'loaded_at': None, 'price_col': 'cost_price', 'trgm': False}
+_lock = threading.Lock()
+
+def get_material_meta(cur):
+    """{'price_col', 'trgm'} for the materials table, cached per process."""
+    now = time.monotonic()
+    if _meta['loaded_at'] is not None and now - _meta['loaded_at'] < MATERIAL_META_TTL:
+        return _meta
+
+    try:
+        cur.execute("SAVEPOINT material_meta")
+        cur.execute("""
+            SELECT
+                EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name = 'materials' AND column_name = 'cost_price'),
+                EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')
+        """)
+        has_cost_price, has_trgm = cur.fetchone()
+        cur.execute("RELEASE SAVEPOINT material_meta")
+    except Exception as e:
+        try: cur.execute("ROLLBACK TO SAVEPOINT material_meta")
+        except Exception: pass
+        print(f"⚠️ Material Meta Error: {e}")
+        return _meta
+
+    with _lock:
+        _meta.update(loaded_at=now, price_col='cost_price' if has_cost_price else 'price', trgm=bool(has_trgm))
+    return _meta
+
+def invalidate_material_meta():
+    with _lock:
+        _meta['loaded_at'] = None
+
+def _like_pattern(text):
+    # Escape LIKE wildcards typed by the user ("50% off", "2_4 timber")
+    text = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return f"%{text}%"
+
+def search_materials(cur, company_id, query, limit=MATERIAL_SEARCH_LIMIT):
+    """Ranked matches for the search box: [{'id', 'name', 'supplier', 'cost', 'sku'}]."""
+    query = (query or '').strip().lower()
+    if not query: return []
+    meta = get_material_meta(cur)
+    params = {'comp': company_id, 'q': query, 'like': _like_pattern(query), 'limit': limit}
+
+    if meta['trgm']:
+        # Substring hits first, then the closest fuzzy matches (<% = word similarity, GIN-indexed)
+        sql = f"""
+            SELECT m.id, m.name, s.name, COALESCE(m.{meta['price_col']}, 0), m.sku
+            FROM materials m
+            LEFT JOIN suppliers s ON m.supplier_id = s.id
+            WHERE m.company_id = %(comp)s
+              AND (LOWER(m.name) LIKE %(like)s OR %(q)s <%% LOWER(m.name) OR LOWER(m.sku) = %(q)s)
+            ORDER BY (LOWER(m.sku) = %(q)s) DESC, (LOWER(m.name) LIKE %(like)s) DESC,
+                     word_similarity(%(q)s, LOWER(m.name)) DESC, LENGTH(m.name), m.name
+            LIMIT %(limit)s
+        """
+    else:
+        sql = f"""
+            SELECT m.id, m.name, s.name, COALESCE(m.{meta['price_col']}, 0), m.sku
+            FROM materials m
+            LEFT JOIN suppliers s ON m.supplier_id = s.id
+            WHERE m.company_id = %(comp)s AND (LOWER(m.name) LIKE %(like)s OR LOWER(m.sku) = %(q)s)
+            ORDER BY (LOWER(m.sku) = %(q)s) DESC, LENGTH(m.name), m.name
+            LIMIT %(limit)s
+        """
+    cur.execute(sql, params)
+    return [{'id': r[0], 'name': r[1], 'supplier': r[2] or 'Generic', 'cost': float(r[3]), 'sku': r[4]}
+            for r in cur.fetchall()]
+
+def resolve_materials(cur, company_id, names, fuzzy=True):
+    """
+    Best catalogue match for every name in a shopping list, in one query.
+    Returns {name: {'id', 'name', 'cost_price', 'supplier', 'supplier_email'}}
+    for the names that matched. Preference: exact name, then the name as a
+    substring ("Fence Post" -> "Fence Post 2.4m"), then (fuzzy + pg_trgm)
+    the closest word-similarity match. fuzzy=False only takes exact names.
+    """
+    names = list(dict.fromkeys(n for n in names if n))
+    if not names: return {}
+    meta = get_material_meta(cur)
+    price_col = meta['price_col']
+
+    if not fuzzy:
+        match = "LOWER(m.name) = q.lname"
+    elif meta['trgm']:
+        match = "(LOWER(m.name) = q.lname OR LOWER(m.name) LIKE q.pattern OR q.lname <%% LOWER(m.name))"
+    else:
+        match = "(LOWER(m.name) = q.lname OR LOWER(m.name) LIKE q.pattern)"
+    similarity = "word_similarity(q.lname, LOWER(m.name))" if fuzzy and meta['trgm'] else "0"
+
+    cur.execute(f"""
+        SELECT q.name, best.id, best.name, best.price, best.supplier, best.supplier_email
+        FROM unnest(%s::text[], %s::text[], %s::text[]) AS q(name, lname, pattern)
+        JOIN LATERAL (
+            SELECT m.id, m.name, COALESCE(m.{price_col}, 0) AS price, s.name AS supplier, s.email AS supplier_email
+            FROM materials m
+            LEFT JOIN suppliers s ON m.supplier_id = s.id
+            WHERE m.company_id = %s AND {match}
+            ORDER BY (LOWER(m.name) = q.lname) DESC, (LOWER(m.name) LIKE q.pattern) DESC, {similarity} DESC, m.id
+            LIMIT 1
+        ) best ON TRUE
+    """, (names, [n.lower() for n in names], [_like_pattern(n.lower()) for n in names], company_id))
+
+    return {r[0]: {'id': r[1], 'name': r[2], 'cost_price': float(r[3] or 0), 'supplier': r[4], 'supplier_email': r[5]}
+            for r in cur.fetchall()}
@@ -0,0 +1,109 @@
+# --- services/pdf_assets.py ---
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+try:
+    from PIL import Image
+    from fpdf.fpdf import ImageInfo
+    from fpdf.image_parsing import get_img_info
+except ImportError:
+    Image = None
+    get_img_info = None
+
+# --- PDF ASSET CACHE (LOGOS) ---
+# Every render used to probe up to three paths for the tenant logo and let
+# fpdf decode + recompress the PNG/JPEG from scratch. Here each logo is
+# decoded once, scaled down to the size it is printed at (LOGO_DPI), and the
+# finished image stream is kept in an LRU (PDF_ASSET_CACHE_MAX entries).
+# place_logo() drops that stream straight into a new FPDF document.
+#
+# Entries are keyed by path + mtime + size, so uploading a new logo (or
+# overwriting the old file) is picked up on the next render.
+PDF_ASSET_CACHE_MAX = int(os.environ.get("PDF_ASSET_CACHE_MAX", 64))
+LOGO_DPI = int(os.environ.get("PDF_LOGO_DPI", 200))
+MM_PER_INCH = 25.4
+
+_images = OrderedDict()
+_paths = {}
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0}
+
+@lru_cache(maxsize=256)
+def hex_to_rgb(hex_code):
+    try:
+        hex_code = hex_code.lstrip('#')
+        return tuple(int(hex_code[i:i+2], 16) for i in (0, 2, 4))
+    except:
+        return (50, 50, 50)
+
+def cached_logo_path(raw_logo, static_folder, root_path, resolver):
+    """resolver() result, remembered per (logo, folders) while the file still exists."""
+    if not raw_logo: return None
+    key = (raw_logo, static_folder, root_path)
+    path = _paths.get(key)
+    if path and os.path.exists(path):
+        return path
+    path = resolver(raw_logo, static_folder, root_path)
+    if path: _paths[key] = path
+    return path
+
+def _target_dims(path, width_mm):
+    """Pixel size for printing at width_mm and LOGO_DPI (None = leave as is)."""
+    with Image.open(path) as img:
+        px_w, px_h = img.size
+    target_w = int(width_mm / MM_PER_INCH * LOGO_DPI)
+    if px_w <= target_w: return None
+    return (target_w, max(1, round(px_h * target_w / px_w)))
+
+def _image_info(path, width_mm, image_filter):
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size, width_mm, image_filter)
+    with _lock:
+        info = _images.get(key)
+        if info is not None:
+            _images.move_to_end(key)
+            _stats['hits'] += 1
+            return key, info
+
+    info = dict(get_img_info(path, None, image_filter, _target_dims(path, width_mm)))
+    with _lock:
+        _stats['misses'] += 1
+        _images[key] = info
+        _images.move_to_end(key)
+        while len(_images) > PDF_ASSET_CACHE_MAX:
+            _images.popitem(last=False)
+    return key, info
+
+def place_logo(pdf, path, x, y, w):
+    """
+    pdf.image(path, x, y, w) using the cached image stream. Falls back to a
+    plain pdf.image() if Pillow / fpdf internals aren't what we expect.
+    """
+    if get_img_info is None:
+        return pdf.image(path, x, y, w)
+    try:
+        key, info = _image_info(path, w, pdf.image_filter)
+    except Exception as e:
+        print(f"⚠️ PDF Logo Cache Error: {e}")
+        return pdf.image(path, x, y, w)
+
+    name = f"logo:{key[0]}:{key[1]}:{key[3]}"
+    if name not in pdf.images:
+        # Register it the way FPDF.preload_image() would, minus the decode
+        entry = ImageInfo(info)
+        entry['i'] = len(pdf.images) + 1
+        entry['usages'] = 0
+        entry['iccp_i'] = None
+        iccp = entry.get('iccp')
+        if iccp:
+            if iccp not in pdf.icc_profiles:
+                pdf.icc_profiles[iccp] = len(pdf.icc_profiles)
+            entry['iccp_i'] = pdf.icc_profiles[iccp]
+            entry['iccp'] = None
+        pdf.images[name] = entry
+    return pdf.image(name, x, y, w)
+
+def get_asset_cache_stats():
+    return {'entries': len(_images), 'max_entries': PDF_ASSET_CACHE_MAX, **_stats}
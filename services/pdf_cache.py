@@ -0,0 +1,107 @@
+# --- services/pdf_cache.py ---
+import os
+import json
+import hashlib
+import threading
+from flask import send_file
+from services.pdf_generator import generate_pdf, resolve_logo_path, PDF_SETTINGS_KEYS
+from utils.static_assets import file_hash
+
+# --- CONTENT-ADDRESSED PDF CACHE ---
+# Invoice / quote downloads re-rendered the PDF on every click. The cache key
+# is a hash of everything the renderer reads: the document row, its line
+# items, the company block, the PDF-relevant settings (theme, brand colour,
+# bank details...) and the logo's bytes. Editing an item, a setting or the
+# logo produces a new key, so there is nothing to invalidate by hand - stale
+# files simply stop being asked for and are pruned oldest-first.
+#
+# Files live outside /static (PDF_CACHE_DIR, default <app root>/pdf_cache)
+# so cached invoices are only reachable through the authenticated routes.
+PDF_CACHE_DIR = os.environ.get("PDF_CACHE_DIR")
+PDF_CACHE_MAX_FILES = int(os.environ.get("PDF_CACHE_MAX_FILES", 2000))
+PDF_RENDER_VERSION = "2"   # Bump when generate_pdf()'s layout changes
+
+_writes = 0
+_lock = threading.Lock()
+
+def cache_dir_for(root_path):
+    return PDF_CACHE_DIR or os.path.join(root_path, 'pdf_cache')
+
+def _logo_fingerprint(logo_path):
+    if not logo_path: return None
+    digest = file_hash(logo_path)
+    if digest: return digest
+    try:
+        # Too big to hash cheaply - size + mtime still catches a replaced logo
+        stat = os.stat(logo_path)
+        return f"{stat.st_size}-{stat.st_mtime_ns}"
+    except OSError:
+        return None
+
+def pdf_cache_key(template_name, context, static_folder, root_path):
+    settings = context.get('settings') or {}
+    config = context.get('config') or {}
+    payload = {
+        'version': PDF_RENDER_VERSION,
+        'template': template_name,
+        'invoice': context.get('invoice'),
+        'items': context.get('items'),
+        'company': context.get('company'),
+        'is_quote': bool(context.get('is_quote')),
+        'settings': {k: settings.get(k) for k in PDF_SETTINGS_KEYS},
+        'logo': _logo_fingerprint(resolve_logo_path(config.get('logo'), static_folder, root_path))
+    }
+    raw = json.dumps(payload, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()[:32]
+
+def get_or_render_pdf(template_name, context, static_folder, root_path):
+    """
+    Returns (path, key). Serves an existing render when the inputs haven't
+    changed, otherwise renders into the cache (atomic rename, so a reader
+    never sees half a file).
+    """
+    key = pdf_cache_key(template_name, context, static_folder, root_path)
+    cache_dir = cache_dir_for(root_path)
+    path = os.path.join(cache_dir, f"{key}.pdf")
+
+    if os.path.exists(path):
+        try: os.utime(path)  # Keeps hot documents out of the prune
+        except OSError: pass
+        return path, key
+
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        generate_pdf(template_name, context, tmp_path, static_folder=static_folder, root_path=root_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+
+    _maybe_prune(cache_dir)
+    return path, key
+
+def _maybe_prune(cache_dir):
+    global _writes
+    with _lock:
+        _writes += 1
+        if _writes % 50: return
+    try:
+        entries = [e for e in os.scandir(cache_dir) if e.name.endswith('.pdf')]
+        if len(entries) <= PDF_CACHE_MAX_FILES: return
+        entries.sort(key=lambda e: e.stat().st_mtime)
+        for entry in entries[:len(entries) - PDF_CACHE_MAX_FILES]:
+            try: os.unlink(entry.path)
+            except OSError: pass
+    except OSError as e:
+        print(f"⚠️ PDF Cache Prune Error: {e}")
+
+def send_cached_pdf(path, download_name, key):
+    """
+    Inline PDF with the cache key as a strong ETag. The browser must
+    revalidate (documents change), but an unchanged one costs a 304.
+    """
+    response = send_file(path, mimetype='application/pdf', as_attachment=False, download_name=download_name, etag=key)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
@@ -0,0 +1,81 @@
+# --- services/pdf_export.py ---
+import os
+import time
+import zipfile
+from concurrent.futures import as_completed
+from services.pdf_jobs import get_pool, render_pdf
+
+# --- BULK PDF EXPORT (STREAMED ZIP) ---
+# Month-end used to mean downloading invoices one by one. stream_pdf_zip()
+# renders a batch across the PDF process pool (through the PDF cache, so
+# unchanged invoices are free) and writes each file into the ZIP the moment
+# it finishes. zipfile writes to our non-seekable sink using data
+# descriptors, so only the current file is in memory - never the archive.
+PDF_EXPORT_MAX_DOCS = int(os.environ.get("PDF_EXPORT_MAX_DOCS", 500))
+
+class _ZipSink:
+    """Write-only file object; the generator drains it after each entry."""
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def _unique_name(name, used):
+    base, ext = os.path.splitext(name)
+    candidate, n = name, 1
+    while candidate in used:
+        n += 1
+        candidate = f"{base}_{n}{ext}"
+    used.add(candidate)
+    return candidate
+
+def stream_pdf_zip(docs, template_name, static_folder, root_path):
+    """
+    Generator of ZIP bytes for [(doc_id, context, filename)]. Failed renders
+    are listed in an ERRORS.txt entry instead of aborting the download.
+    """
+    started = time.monotonic()
+    sink = _ZipSink()
+    used, errors, done = set(), [], 0
+
+    futures = {
+        get_pool().submit(render_pdf, template_name, context, filename, static_folder, root_path, True): (doc_id, filename)
+        for doc_id, context, filename in docs
+    }
+
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as zf:
+        try:
+            for future in as_completed(futures):
+                doc_id, filename = futures[future]
+                try:
+                    path = future.result()
+                except Exception as e:
+                    errors.append(f"{filename} (id {doc_id}): {e}")
+                    continue
+                # PDFs are already compressed - STORED is much cheaper than DEFLATE here
+                zf.write(path, arcname=_unique_name(filename, used))
+                done += 1
+                yield sink.drain()
+        except GeneratorExit:
+            # Client went away: don't keep the pool busy for nobody
+            for future in futures:
+                future.cancel()
+            raise
+
+        if errors:
+            zf.writestr('ERRORS.txt', "\n".join(errors) + "\n")
+    yield sink.drain()
+
+    elapsed = time.monotonic() - started
+    rate = done / elapsed if elapsed else 0
+    print(f"📦 PDF Export: {done} documents in {elapsed:.1f}s ({rate:.1f} docs/s), {len(errors)} failed")
@@ -1,9 +1,10 @@
 import os
+import io
 import base64
-import tempfile
 from decimal import Decimal
 from fpdf import FPDF
 from flask import current_app
+from services.pdf_assets import hex_to_rgb, cached_logo_path, place_logo
 
 class BasePDF(FPDF):
     def __init__(self, brand_color_hex, company_name):
@@ -12,11 +13,7 @@ class BasePDF(FPDF):
         self.company_name = company_name
         
     def hex_to_rgb(self, hex_code):
-        try:
-            hex_code = hex_code.lstrip('#')
-            return tuple(int(hex_code[i:i+2], 16) for i in (0, 2, 4))
-        except:
-            return (50, 50, 50)
+        return hex_to_rgb(hex_code)  # Memoised (services/pdf_assets.py)
 
     def footer(self):
         self.set_y(-20)
@@ -42,22 +39,58 @@ class MinimalPDF(BasePDF):
     def header(self):
         self.ln(15)
 
-# --- HELPER: SAVE BASE64 IMAGE ---
-def save_base64_image(data_str):
+THEMES = {'Modern': ModernPDF, 'Classic': ClassicPDF, 'Minimal': MinimalPDF}
+
+# --- HELPER: DECODE BASE64 IMAGE ---
+# Signatures arrive as data URLs. fpdf reads a BytesIO directly, so there's
+# no temp file to write, fsync and unlink per certificate.
+def decode_base64_image(data_str):
     if not data_str or 'base64,' not in data_str: return None
     try:
         header, encoded = data_str.split('base64,', 1)
-        data = base64.b64decode(encoded)
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as f:
-            f.write(data)
-            return f.name
+        return io.BytesIO(base64.b64decode(encoded))
     except:
         return None
 
+# --- HELPER: FINISH A DOCUMENT ---
+def _finish(pdf, file_path):
+    """Writes to file_path and returns it, or returns the PDF bytes if file_path is None."""
+    if file_path is None:
+        return bytes(pdf.output())
+    pdf.output(file_path)
+    return file_path
+
+# --- HELPER: FIND THE LOGO ON DISK ---
+def resolve_logo_path(raw_logo, static_folder, root_path):
+    """Disk path for a config logo ('/static/...', 'file://...', relative), or None."""
+    if not raw_logo: return None
+    if os.path.exists(raw_logo):
+        return raw_logo
+    if '/static/' in raw_logo:
+        try:
+            clean_path = raw_logo.split('/static/')[-1]
+            possible_path = os.path.join(static_folder, clean_path)
+            if os.path.exists(possible_path): return possible_path
+        except: pass
+
+    # Try relative fallback
+    try:
+        rel_path = raw_logo.lstrip('/')
+        possible_path = os.path.join(root_path, rel_path)
+        if os.path.exists(possible_path): return possible_path
+    except: pass
+    return None
+
+# Settings generate_pdf() actually reads (anything else can't change the output)
+PDF_SETTINGS_KEYS = (
+    'brand_color', 'currency_symbol', 'pdf_theme', 'company_address', 'company_email',
+    'tax_id', 'vat_registered', 'payment_terms', 'bank_name', 'sort_code', 'account_number'
+)
+
 # =========================================================
 # 1. CP12 GENERATOR (GAS SAFETY)
 # =========================================================
-def generate_cp12(context, file_path):
+def generate_cp12(context, file_path=None):
     prop = context.get('prop', {})
     data = context.get('data', {})
     
@@ -157,21 +190,19 @@ def generate_cp12(context, file_path):
     pdf.multi_cell(0, 5, "I certify that the appliances detailed above have been checked for safety in accordance with the Gas Safety (Installation and Use) Regulations.")
     pdf.ln(5)
     
-    sig_file = save_base64_image(data.get('signature_img'))
-    if sig_file:
-        pdf.image(sig_file, x=pdf.get_x(), y=pdf.get_y(), w=50)
-        os.unlink(sig_file) 
+    sig_img = decode_base64_image(data.get('signature_img'))
+    if sig_img:
+        pdf.image(sig_img, x=pdf.get_x(), y=pdf.get_y(), w=50)
     
     pdf.ln(25)
     pdf.cell(0, 6, f"Next Inspection Due: {context.get('next_year_date')}", ln=True)
 
-    pdf.output(file_path)
-    return file_path
+    return _finish(pdf, file_path)
 
 # =========================================================
 # 2. EICR GENERATOR (ELECTRICAL)
 # =========================================================
-def generate_eicr(context, file_path):
+def generate_eicr(context, file_path=None):
     prop = context.get('prop', {})
     data = context.get('data', {})
     
@@ -256,24 +287,32 @@ def generate_eicr(context, file_path):
     pdf.set_text_color(*color)
     pdf.cell(0, 10, f"Outcome: {data.get('outcome', 'Not Set').upper()}", ln=True, align='C')
     
-    pdf.output(file_path)
-    return file_path
+    return _finish(pdf, file_path)
 
 
 # =========================================================
 # 3. MAIN ROUTER (The Invoice/Quote Logic)
 # =========================================================
-def generate_pdf(template_name, context, output_filename):
+def generate_pdf(template_name, context, output_filename, static_folder=None, root_path=None):
     """
     Main entry point. Routes to specific generator based on filename/template.
+    Writes the file (uploads/documents/<output_filename>, or an absolute path)
+    and returns its path - use this when the PDF should be archived.
+    output_filename=None returns the PDF bytes instead (see render_pdf_bytes).
+    'static_folder' / 'root_path' default to the Flask app's; pass them when
+    rendering outside a request (e.g. in the PDF job worker processes).
     """
+    if static_folder is None: static_folder = current_app.static_folder
+    if root_path is None: root_path = current_app.root_path
+
     # 1. SETUP PATHS
-    save_dir = os.path.join(current_app.static_folder, 'uploads', 'documents')
-    os.makedirs(save_dir, exist_ok=True)
-    
-    if os.path.isabs(output_filename):
+    if output_filename is None:
+        file_path = None
+    elif os.path.isabs(output_filename):
         file_path = output_filename
     else:
+        save_dir = os.path.join(static_folder, 'uploads', 'documents')
+        os.makedirs(save_dir, exist_ok=True)
         file_path = os.path.join(save_dir, output_filename)
 
     # 2. ROUTE TO SPECIALTY GENERATORS
@@ -295,41 +334,17 @@ def generate_pdf(template_name, context, output_filename):
     selected_theme = settings.get('pdf_theme', 'Modern')
     
     # Init PDF
-    if selected_theme == 'Classic':
-        pdf = ClassicPDF(brand_color, company.get('name', ''))
-    elif selected_theme == 'Minimal':
-        pdf = MinimalPDF(brand_color, company.get('name', ''))
-    else:
-        pdf = ModernPDF(brand_color, company.get('name', ''))
+    pdf = THEMES.get(selected_theme, ModernPDF)(brand_color, company.get('name', ''))
 
     pdf.alias_nb_pages()
     pdf.add_page()
     pdf.set_auto_page_break(auto=True, margin=15)
     
     # --- LOGO LOGIC ---
-    if config.get('logo'):
-        raw_logo = config['logo']
-        final_logo_path = None
-        if os.path.exists(raw_logo):
-            final_logo_path = raw_logo
-        elif '/static/' in raw_logo:
-            try:
-                clean_path = raw_logo.split('/static/')[-1]
-                possible_path = os.path.join(current_app.static_folder, clean_path)
-                if os.path.exists(possible_path): final_logo_path = possible_path
-            except: pass
-        
-        # Try relative fallback
-        if not final_logo_path:
-            try:
-                rel_path = raw_logo.lstrip('/')
-                possible_path = os.path.join(current_app.root_path, rel_path)
-                if os.path.exists(possible_path): final_logo_path = possible_path
-            except: pass
-
-        if final_logo_path:
-            try: pdf.image(final_logo_path, 10, 10 if selected_theme=='Minimal' else 25, 40 if selected_theme=='Minimal' else 50)
-            except: pass
+    final_logo_path = cached_logo_path(config.get('logo'), static_folder, root_path, resolve_logo_path)
+    if final_logo_path:
+        try: place_logo(pdf, final_logo_path, 10, 10 if selected_theme=='Minimal' else 25, 40 if selected_theme=='Minimal' else 50)
+        except: pass
 
     # --- HEADER ---
     pdf.set_y(25 if selected_theme != 'Minimal' else 15)
@@ -472,6 +487,10 @@ def generate_pdf(template_name, context, output_filename):
     
     pdf.multi_cell(0, 5, terms + bank)
 
-    # --- SAVE ---
-    pdf.output(file_path)
-    return file_path
\ No newline at end of file
+    # --- SAVE (or hand back the bytes) ---
+    return _finish(pdf, file_path)
+
+
+def render_pdf_bytes(template_name, context, static_folder=None, root_path=None):
+    """PDF as bytes for a response / email attachment - nothing is written to disk."""
+    return generate_pdf(template_name, context, None, static_folder=static_folder, root_path=root_path)
@@ -0,0 +1,180 @@
+# --- services/pdf_jobs.py ---
+import os
+import uuid
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from db import get_pooled_db
+
+# --- ASYNC PDF RENDERING ---
+# fpdf renders (plus the disk write) used to run inside the request, holding
+# a gunicorn sync worker for the whole time. submit_pdf() hands the render
+# to a local process pool and returns a job id straight away; the UI polls
+# /pdf/jobs/<id> and downloads the file once the job is 'done'.
+#
+# Job state lives in the 'pdf_jobs' table so any worker can answer the poll,
+# while the pool itself belongs to the worker that accepted the job. The
+# pool process marks the job 'running' (started_at) when it picks it up, so
+# a job waiting behind a bulk export isn't mistaken for a dead one: only a
+# render running longer than PDF_JOB_STALE_AFTER, or a job never started
+# within PDF_JOB_QUEUE_TIMEOUT, is turned into 'failed' on the next status
+# check. The table is created by /admin/setup-indexes-db (ensure_pdf_job_table).
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", 2))
+PDF_START_METHOD = os.environ.get("PDF_START_METHOD", "forkserver")  # don't fork a process full of threads + DB sockets
+PDF_JOB_STALE_AFTER = int(os.environ.get("PDF_JOB_STALE_AFTER", 300))
+PDF_JOB_QUEUE_TIMEOUT = int(os.environ.get("PDF_JOB_QUEUE_TIMEOUT", 1800))
+PDF_JOB_RETAIN_DAYS = int(os.environ.get("PDF_JOB_RETAIN_DAYS", 2))
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_schema_ready = False
+
+def ensure_pdf_job_table(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS pdf_jobs (
+            id VARCHAR(32) PRIMARY KEY,
+            company_id INTEGER,
+            kind VARCHAR(30),
+            status VARCHAR(20) NOT NULL DEFAULT 'queued',
+            file_name VARCHAR(255),
+            file_path TEXT,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP
+        );
+    """)
+    # Tables created before started_at existed - only ALTER when missing (ALTER locks the table)
+    cur.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'pdf_jobs' AND column_name = 'started_at' AND table_schema = current_schema()
+    """)
+    if not cur.fetchone():
+        cur.execute("ALTER TABLE pdf_jobs ADD COLUMN IF NOT EXISTS started_at TIMESTAMP")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_pdf_jobs_company_created ON pdf_jobs (company_id, created_at);")
+
+def _schema_exists(cur):
+    # Checked once per process; the table itself comes from the migration, never a request
+    global _schema_ready
+    if not _schema_ready:
+        cur.execute("SELECT to_regclass('pdf_jobs') IS NOT NULL")
+        _schema_ready = cur.fetchone()[0]
+    return _schema_ready
+
+def get_pool():
+    # One pool per gunicorn worker (a pool inherited through fork is unusable)
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool_pid != os.getpid():
+                try:
+                    ctx = multiprocessing.get_context(PDF_START_METHOD)
+                except ValueError:
+                    ctx = multiprocessing.get_context()
+                _pool = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=ctx)
+                _pool_pid = os.getpid()
+    return _pool
+
+def render_pdf(template_name, context, output_filename, static_folder, root_path, cache, job_id=None):
+    # Runs in a pool process: no Flask app, so paths are passed in
+    if job_id:
+        _mark_running(job_id)
+    if cache:
+        from services.pdf_cache import get_or_render_pdf
+        return get_or_render_pdf(template_name, context, static_folder, root_path)[0]
+    from services.pdf_generator import generate_pdf
+    return generate_pdf(template_name, context, output_filename, static_folder=static_folder, root_path=root_path)
+
+def _mark_running(job_id):
+    # Pool process side: the render starts now, whatever time it spent queued
+    conn = get_pooled_db()
+    if conn is None: return
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE pdf_jobs SET status = 'running', started_at = NOW() WHERE id = %s AND status = 'queued'
+        """, (job_id,))
+        conn.commit()
+    except Exception as e:
+        print(f"⚠️ PDF Job Start Error ({job_id}): {e}")
+    finally:
+        conn.close()
+
+def _set_status(job_id, status, file_path=None, error=None):
+    conn = get_pooled_db()
+    if conn is None: return
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE pdf_jobs
+            SET status = %s, file_path = COALESCE(%s, file_path), error = %s, finished_at = NOW()
+            WHERE id = %s
+        """, (status, file_path, error, job_id))
+        conn.commit()
+    except Exception as e:
+        print(f"❌ PDF Job Status Error ({job_id}): {e}")
+    finally:
+        conn.close()
+
+def _on_done(job_id, future):
+    # Called from the pool's management thread - outside any request
+    try:
+        file_path = future.result()
+        _set_status(job_id, 'done', file_path=file_path)
+    except Exception as e:
+        print(f"❌ PDF Job Failed ({job_id}): {e}")
+        _set_status(job_id, 'failed', error=str(e)[:500])
+
+def submit_pdf(company_id, kind, template_name, context, output_filename, static_folder, root_path, cache=False):
+    """
+    Queues a render and returns the job id. 'context' must be picklable
+    (plain dicts / dates / Decimals - what the routes already build).
+    cache=True renders through services/pdf_cache.py (invoices / quotes).
+    The job row is written and committed on a pool connection of its own, so
+    other workers can see it at once and the caller's transaction is left alone.
+    Call it after committing anything the PDF depends on.
+    """
+    conn = get_pooled_db()
+    if conn is None:
+        raise RuntimeError("no database connection")
+    job_id = uuid.uuid4().hex
+    try:
+        cur = conn.cursor()
+        if not _schema_exists(cur):
+            raise RuntimeError("pdf_jobs table is missing - run /admin/setup-indexes-db")
+        cur.execute("""
+            INSERT INTO pdf_jobs (id, company_id, kind, status, file_name) VALUES (%s, %s, %s, 'queued', %s)
+        """, (job_id, company_id, kind, output_filename))
+        # Housekeeping: old job rows (the PDFs themselves stay where they are)
+        cur.execute("DELETE FROM pdf_jobs WHERE created_at < NOW() - make_interval(days => %s)", (PDF_JOB_RETAIN_DAYS,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    future = get_pool().submit(render_pdf, template_name, context, output_filename, static_folder, root_path, cache, job_id)
+    future.add_done_callback(lambda f: _on_done(job_id, f))
+    return job_id
+
+def get_pdf_job(cur, job_id, company_id):
+    """Job dict for this company, or None. Flags jobs whose worker went away."""
+    if not _schema_exists(cur): return None
+    cur.execute("""
+        SELECT id, kind, status, file_name, file_path, error,
+               CASE WHEN status = 'running' AND started_at < NOW() - make_interval(secs => %s)
+                        THEN 'Render did not finish (worker restarted?)'
+                    WHEN status = 'queued' AND created_at < NOW() - make_interval(secs => %s)
+                        THEN 'Render never started (worker restarted?)' END
+        FROM pdf_jobs WHERE id = %s AND company_id = %s
+    """, (PDF_JOB_STALE_AFTER, PDF_JOB_QUEUE_TIMEOUT, job_id, company_id))
+    row = cur.fetchone()
+    if not row: return None
+
+    job = {'id': row[0], 'kind': row[1], 'status': row[2], 'file_name': row[3], 'file_path': row[4], 'error': row[5]}
+    if row[6]:
+        _set_status(job_id, 'failed', error=row[6])
+        job.update(status='failed', error=row[6])
+    return job
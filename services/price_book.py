@@ -0,0 +1,96 @@
+# --- services/price_book.py ---
+import os
+import time
+import threading
+from services.material_search import resolve_materials
+
+# --- TENANT PRICE BOOK ---
+# smart_calculate and PricingEngine both price a calculator's shopping list.
+# They used to run one query per line with different matching rules (fuzzy
+# ILIKE vs exact name), so the same job could be priced differently by each.
+# Both now go through price_materials():
+#   - names already resolved for this tenant come from memory;
+#   - the rest are resolved together in ONE query (resolve_materials:
+#     exact name, then substring, then trigram similarity);
+#   - lines with no catalogue match get the same fallback estimate everywhere.
+# Misses are cached too, so a calculator asking for an item the tenant
+# doesn't stock doesn't hit the DB every time. Anything that changes
+# 'materials' or supplier names calls invalidate_price_book(company_id).
+# As with the settings cache, other gunicorn workers can lag behind by up
+# to PRICE_BOOK_TTL seconds.
+PRICE_BOOK_TTL = float(os.environ.get("PRICE_BOOK_TTL", 300))
+PRICE_BOOK_MAX_NAMES = int(os.environ.get("PRICE_BOOK_MAX_NAMES", 2000))  # Per tenant
+
+_cache = {}   # company_id -> {'loaded_at': t, 'prices': {lower(name): match or None}}
+_lock = threading.Lock()
+
+# Rough trade prices for lines the catalogue doesn't have (first keyword wins)
+FALLBACK_COSTS = [
+    ('post', 15.00), ('rail', 6.50), ('board', 1.20), ('bag', 6.50), ('cement', 6.50),
+    ('tile', 1.10), ('batten', 0.80), ('membrane', 45.00),
+]
+FALLBACK_DEFAULT_COST = 20.00
+
+def _cache_key(company_id):
+    # Session company IDs can arrive as str or int
+    try: return int(company_id)
+    except (TypeError, ValueError): return company_id
+
+def fallback_cost(name):
+    name_lower = (name or '').lower()
+    for keyword, cost in FALLBACK_COSTS:
+        if keyword in name_lower:
+            return cost
+    return FALLBACK_DEFAULT_COST
+
+def resolve_prices(cur, company_id, names):
+    """{name: match or None} for a list of material names (see resolve_materials for 'match')."""
+    key = _cache_key(company_id)
+    now = time.monotonic()
+    with _lock:
+        entry = _cache.get(key)
+        if not entry or now - entry['loaded_at'] >= PRICE_BOOK_TTL:
+            entry = _cache[key] = {'loaded_at': now, 'prices': {}}
+        prices = entry['prices']
+        found = {n: prices[n.lower()] for n in names if n and n.lower() in prices}
+
+    missing = [n for n in dict.fromkeys(names) if n and n not in found]
+    if missing:
+        resolved = resolve_materials(cur, company_id, missing)
+        with _lock:
+            if len(prices) + len(missing) > PRICE_BOOK_MAX_NAMES:
+                prices.clear()
+            for n in missing:
+                found[n] = resolved.get(n)
+                prices[n.lower()] = found[n]
+    return found
+
+def price_materials(cur, company_id, materials):
+    """
+    Prices a calculator's 'materials' list ([{'name', 'qty'}, ...]) at cost.
+    Returns one dict per line, in order: name, qty, cost_price, supplier,
+    supplier_email, matched (False = fallback estimate). Markup is the caller's job.
+    """
+    matches = resolve_prices(cur, company_id, [item['name'] for item in materials])
+    lines = []
+    for item in materials:
+        match = matches.get(item['name'])
+        lines.append({
+            'name': item['name'],
+            'qty': item['qty'],
+            'cost_price': match['cost_price'] if match else fallback_cost(item['name']),
+            'supplier': (match['supplier'] if match else None) or 'Generic',
+            'supplier_email': match['supplier_email'] if match else None,
+            'matched': bool(match),
+        })
+    return lines
+
+def invalidate_price_book(company_id=None):
+    """
+    Call after writing to 'materials' (or renaming/deleting suppliers). Pass None to clear every tenant.
+    """
+    with _lock:
+        if company_id is None:
+            _cache.clear()
+        else:
+            _cache.pop(_cache_key(company_id), None)
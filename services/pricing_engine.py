@@ -1,4 +1,6 @@
 from db import get_db
+from services.settings_cache import get_setting
+from services.price_book import price_materials
 
 class PricingEngine:
     
@@ -7,32 +9,21 @@ class PricingEngine:
         conn = get_db()
         cur = conn.cursor()
         
-        # 1. GET SETTINGS
-        cur.execute("SELECT key, value FROM settings WHERE company_id = %s", (company_id,))
-        settings = {row[0]: row[1] for row in cur.fetchall()}
-        
-        mat_markup = float(settings.get('material_markup_percent', 0)) / 100
-        lab_markup = float(settings.get('labour_markup_percent', 0)) / 100
+        # 1. GET SETTINGS (Cached per tenant)
+        mat_markup = get_setting(company_id, 'material_markup_percent', 0.0, float) / 100
+        lab_markup = get_setting(company_id, 'labour_markup_percent', 0.0, float) / 100
         
         # 2. CALCULATE MATERIALS
         total_material_cost = 0.0
         priced_materials = [] # Detailed list for the "Material File"
         shopping_list_by_supplier = {} 
 
-        for item in requirements.get('materials', []):
-            item_name = item['name']
-            qty = item['qty']
-            
-            # Lookup Logic (Simplified for brevity - same as before)
-            cur.execute("""
-                SELECT m.cost_price, s.name, s.email FROM materials m
-                LEFT JOIN suppliers s ON m.supplier_id = s.id
-                WHERE m.company_id = %s AND LOWER(m.name) = LOWER(%s)
-            """, (company_id, item_name))
-            match = cur.fetchone()
-            
-            cost_price = float(match[0]) if match else 0.0
-            supplier_name = match[1] if match else "Generic"
+        # One query for the whole list (cached per tenant) - same prices as smart_calculate
+        for line in price_materials(cur, company_id, requirements.get('materials', [])):
+            item_name = line['name']
+            qty = line['qty']
+            cost_price = line['cost_price']
+            supplier_name = line['supplier']
             
             # Calculate Sell Price
             sell_price = cost_price * (1 + mat_markup)
@@ -0,0 +1,80 @@
+# --- services/settings_cache.py ---
+import os
+import time
+import threading
+from db import get_db
+
+# --- TENANT SETTINGS CACHE ---
+# The 'settings' key/value table is read on nearly every page (branding,
+# currency, SMTP, markups...). We keep one dict per company in memory and
+# only go back to the DB when the entry is older than the TTL or a settings
+# page has saved new values (see invalidate_settings).
+# Note: each gunicorn worker has its own cache, so other workers can lag
+# behind a save by up to SETTINGS_CACHE_TTL seconds.
+SETTINGS_CACHE_TTL = float(os.environ.get("SETTINGS_CACHE_TTL", 300))
+
+_cache = {}
+_lock = threading.Lock()
+
+def _cache_key(company_id):
+    # Session company IDs can arrive as str or int
+    try: return int(company_id)
+    except (TypeError, ValueError): return company_id
+
+def get_settings(company_id):
+    """
+    Returns ALL settings for a company as a {key: value} dict.
+    Callers get their own copy, so it is safe to modify.
+    """
+    if not company_id:
+        return {}
+
+    cache_key = _cache_key(company_id)
+    now = time.monotonic()
+    entry = _cache.get(cache_key)
+    if entry and now - entry[0] < SETTINGS_CACHE_TTL:
+        return dict(entry[1])
+
+    conn = get_db()
+    if not conn:
+        return {}
+
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT key, value FROM settings WHERE company_id = %s", (company_id,))
+        settings = {row[0]: row[1] for row in cur.fetchall()}
+    except Exception as e:
+        print(f"Settings Cache Error: {e}")
+        return {}
+    finally:
+        conn.close()
+
+    with _lock:
+        _cache[cache_key] = (now, settings)
+    return dict(settings)
+
+def get_setting(company_id, key, default=None, cast=None):
+    """
+    Typed accessor for a single setting.
+    e.g. get_setting(comp_id, 'material_markup_percent', 20.0, float)
+    Empty / missing / un-castable values fall back to 'default'.
+    """
+    value = get_settings(company_id).get(key)
+    if value is None or value == '':
+        return default
+    if cast:
+        try:
+            return cast(value)
+        except (TypeError, ValueError):
+            return default
+    return value
+
+def invalidate_settings(company_id=None):
+    """
+    Call after writing to the settings table. Pass None to clear every tenant.
+    """
+    with _lock:
+        if company_id is None:
+            _cache.clear()
+        else:
+            _cache.pop(_cache_key(company_id), None)
@@ -0,0 +1,246 @@
+# --- services/statement_mailer.py ---
+import os
+import time
+import threading
+from concurrent.futures import as_completed
+from db import get_db
+from services.pdf_jobs import get_pool, render_pdf
+from services.email_queue import enqueue_email
+
+# --- OVERDUE STATEMENT RUNS ---
+# Chasing overdue invoices meant emailing them one at a time. A statement run
+# takes every overdue invoice for a company, renders the PDFs in parallel on
+# the PDF process pool (through the PDF cache), and queues ONE email per
+# client with all of that client's invoices attached. Each client's email is
+# queued as soon as their last PDF is ready, so sending overlaps rendering.
+#
+# Delivery goes through services/email_queue.py: one reused SMTP session per
+# tenant and the per-host rate limit. Progress is the run row here
+# (rendered / emails_queued) plus the outbox rows tagged ('statement', run id).
+# The table is created by /admin/setup-indexes-db (ensure_statement_tables).
+STATEMENT_MAX_INVOICES = int(os.environ.get("STATEMENT_MAX_INVOICES", 500))
+STATEMENT_STALE_AFTER = int(os.environ.get("STATEMENT_STALE_AFTER", 900))   # Run whose worker died mid-render
+
+_schema_ready = False
+
+def ensure_statement_tables(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS statement_runs (
+            id SERIAL PRIMARY KEY,
+            company_id INTEGER NOT NULL,
+            status VARCHAR(20) NOT NULL DEFAULT 'rendering',
+            clients INTEGER DEFAULT 0,
+            invoices INTEGER DEFAULT 0,
+            rendered INTEGER DEFAULT 0,
+            emails_queued INTEGER DEFAULT 0,
+            skipped_clients INTEGER DEFAULT 0,
+            errors TEXT,
+            created_by INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_statement_runs_company ON statement_runs (company_id, created_at);")
+
+def _schema_exists(cur):
+    # Read-only check, once per process: DDL here would commit the caller's transaction
+    global _schema_ready
+    if not _schema_ready:
+        cur.execute("SELECT to_regclass('statement_runs') IS NOT NULL")
+        _schema_ready = cur.fetchone()[0]
+    return _schema_ready
+
+def _require_schema(cur):
+    if not _schema_exists(cur):
+        raise RuntimeError("statement_runs table is missing - run /admin/setup-indexes-db")
+
+def get_overdue_by_client(cur, company_id):
+    """
+    {client_id: {'name', 'email', 'invoice_ids'}} for invoices marked Overdue
+    or past their due date and still unpaid.
+    """
+    cur.execute("""
+        SELECT i.id, c.id, c.name, c.email
+        FROM invoices i
+        JOIN clients c ON i.client_id = c.id
+        WHERE i.company_id = %s
+          AND (i.status = 'Overdue' OR (i.due_date < CURRENT_DATE AND i.status IN ('Unpaid', 'Sent')))
+        ORDER BY c.id, i.due_date, i.id
+    """, (company_id,))
+    clients = {}
+    for invoice_id, client_id, name, email in cur.fetchall():
+        entry = clients.setdefault(client_id, {'name': name, 'email': (email or '').strip(), 'invoice_ids': []})
+        entry['invoice_ids'].append(invoice_id)
+    return clients
+
+def _statement_body(client_name, company_name, invoices):
+    currency = invoices[0]['currency_symbol'] if invoices else '£'
+    rows = "".join(
+        f"<tr><td>{inv['ref']}</td><td>{inv['date']}</td><td>{inv['due']}</td>"
+        f"<td style='text-align:right'>{currency}{inv['total']:.2f}</td></tr>"
+        for inv in invoices
+    )
+    total = sum(inv['total'] for inv in invoices)
+    return f"""
+        <p>Dear {client_name},</p>
+        <p>Our records show the following invoices are now overdue. Copies are attached.</p>
+        <table cellpadding="6" style="border-collapse:collapse">
+            <tr><th align="left">Invoice</th><th align="left">Date</th><th align="left">Due</th><th align="right">Amount</th></tr>
+            {rows}
+            <tr><td colspan="3"><strong>Total outstanding</strong></td><td style='text-align:right'><strong>{currency}{total:.2f}</strong></td></tr>
+        </table>
+        <p>If you have already paid, please ignore this reminder.</p>
+        <p>Kind regards,<br>{company_name}</p>
+    """
+
+# =========================================================
+# RUN
+# =========================================================
+def _update_run(run_id, finished=False, **fields):
+    conn = get_db()
+    if conn is None: return
+    try:
+        cur = conn.cursor()
+        sets = ", ".join([f"{k} = %s" for k in fields] + (["finished_at = NOW()"] if finished else []))
+        cur.execute(f"UPDATE statement_runs SET {sets} WHERE id = %s", (*fields.values(), run_id))
+        conn.commit()
+    except Exception as e:
+        print(f"❌ Statement Run Update Error ({run_id}): {e}")
+    finally:
+        conn.close()
+
+def _queue_client_email(run_id, company_id, company_name, client, files):
+    """files: [(filename, pdf_bytes, invoice context)] in statement order."""
+    conn = get_db()
+    if conn is None:
+        raise RuntimeError("no database connection")
+    try:
+        cur = conn.cursor()
+        enqueue_email(cur, company_id, client['email'], f"Statement of overdue invoices - {company_name}",
+                      _statement_body(client['name'], company_name, [inv for _, _, inv in files]),
+                      attachments=[(filename, data) for filename, data, _ in files],
+                      ref=('statement', run_id))
+        cur.execute("UPDATE statement_runs SET emails_queued = emails_queued + 1 WHERE id = %s", (run_id,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def _run(run_id, company_id, company_name, clients, docs, static_folder, root_path):
+    started = time.monotonic()
+    errors = []
+    # Invoice -> client, and how many PDFs each client is still waiting on
+    client_of = {inv_id: cid for cid, c in clients.items() for inv_id in c['invoice_ids']}
+    waiting = {cid: 0 for cid in clients}
+    for doc_id, _, _ in docs:
+        waiting[client_of[doc_id]] += 1
+    ready = {cid: {} for cid in clients}
+    rendered, queued, last_progress = 0, 0, time.monotonic()
+
+    try:
+        futures = {
+            get_pool().submit(render_pdf, 'finance/pdf_invoice_template.html', context, filename,
+                              static_folder, root_path, True): (doc_id, context, filename)
+            for doc_id, context, filename in docs
+        }
+        for future in as_completed(futures):
+            doc_id, context, filename = futures[future]
+            cid = client_of[doc_id]
+            try:
+                with open(future.result(), 'rb') as f:
+                    ready[cid][doc_id] = (filename, f.read(), context['invoice'])
+            except Exception as e:
+                errors.append(f"{filename}: {e}")
+            rendered += 1
+            waiting[cid] -= 1
+
+            if waiting[cid] == 0 and ready[cid]:
+                files = ready.pop(cid)
+                try:
+                    _queue_client_email(run_id, company_id, company_name, clients[cid],
+                                        [files[i] for i in clients[cid]['invoice_ids'] if i in files])
+                    queued += 1
+                except Exception as e:
+                    errors.append(f"{clients[cid]['name']}: {e}")
+
+            if time.monotonic() - last_progress > 1:
+                _update_run(run_id, rendered=rendered)
+                last_progress = time.monotonic()
+    except Exception as e:
+        errors.append(f"Run aborted: {e}")
+        print(f"❌ Statement Run {run_id} Error: {e}")
+
+    _update_run(run_id, finished=True, status='queued' if queued else 'failed',
+                rendered=rendered, errors="\n".join(errors) or None)
+    elapsed = time.monotonic() - started
+    print(f"📨 Statement Run {run_id}: {rendered}/{len(docs)} invoices for {len(clients)} clients in {elapsed:.1f}s, {len(errors)} errors")
+
+def start_statement_run(cur, company_id, company_name, clients, docs, static_folder, root_path, skipped=0, user_id=None):
+    """
+    Records the run and starts it in a background thread; returns the run id.
+    clients: get_overdue_by_client() (already filtered to clients with an
+    email). docs: [(invoice_id, context, filename)] from build_invoice_pdfs().
+    skipped: overdue clients left out for having no email address.
+    """
+    _require_schema(cur)
+    cur.execute("""
+        INSERT INTO statement_runs (company_id, clients, invoices, skipped_clients, created_by)
+        VALUES (%s, %s, %s, %s, %s) RETURNING id
+    """, (company_id, len(clients), len(docs), skipped, user_id))
+    run_id = cur.fetchone()[0]
+    cur.connection.commit()
+
+    threading.Thread(target=_run, args=(run_id, company_id, company_name, clients, docs, static_folder, root_path),
+                     name=f"statement-run-{run_id}", daemon=True).start()
+    return run_id
+
+def get_active_run(cur, company_id):
+    """
+    Id of a run still rendering for this company (one at a time), or None.
+    Also takes the company's statement-run lock for the rest of the caller's
+    transaction, so a double-click or a second admin waits here until
+    start_statement_run() has committed the first run - then sees it.
+    """
+    _require_schema(cur)
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext('statement_run'), %s)", (int(company_id),))
+    cur.execute("""
+        SELECT id FROM statement_runs
+        WHERE company_id = %s AND status = 'rendering' AND created_at > NOW() - make_interval(secs => %s)
+        ORDER BY id DESC LIMIT 1
+    """, (company_id, STATEMENT_STALE_AFTER))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def get_statement_run(cur, run_id, company_id):
+    """Progress dict for a run (render phase + delivery counts from the outbox), or None."""
+    if not _schema_exists(cur): return None
+    cur.execute("""
+        SELECT id, status, clients, invoices, rendered, emails_queued, skipped_clients, errors, created_at, finished_at,
+               status = 'rendering' AND created_at < NOW() - make_interval(secs => %s)
+        FROM statement_runs WHERE id = %s AND company_id = %s
+    """, (STATEMENT_STALE_AFTER, run_id, company_id))
+    row = cur.fetchone()
+    if not row: return None
+
+    run = {
+        'id': row[0], 'status': row[1], 'clients': row[2], 'invoices': row[3], 'rendered': row[4],
+        'emails_queued': row[5], 'skipped_clients': row[6], 'errors': row[7].splitlines() if row[7] else [],
+        'created_at': row[8].isoformat() if row[8] else None,
+        'finished_at': row[9].isoformat() if row[9] else None
+    }
+    if row[10]:
+        _update_run(run_id, finished=True, status='failed', errors='Run did not finish (worker restarted?)')
+        run.update(status='failed', errors=['Run did not finish (worker restarted?)'])
+
+    cur.execute("""
+        SELECT status, COUNT(*) FROM email_outbox
+        WHERE ref_type = 'statement' AND ref_id = %s AND company_id = %s GROUP BY status
+    """, (run_id, company_id))
+    delivery = dict(cur.fetchall())
+    run['delivery'] = {'sent': delivery.get('sent', 0), 'failed': delivery.get('failed', 0),
+                       'pending': delivery.get('queued', 0) + delivery.get('sending', 0)}
+    if run['status'] == 'queued' and not run['delivery']['pending']:
+        run['status'] = 'done'
+    return run
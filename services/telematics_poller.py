@@ -0,0 +1,314 @@
+# --- services/telematics_poller.py ---
+import os
+import json
+import time
+import random
+import threading
+from concurrent.futures import wait
+from psycopg2.extras import execute_values
+from db import get_db
+from telematics_engine import fetch_live, get_executor, get_fleet_positions, get_breaker_states
+
+# --- BACKGROUND TELEMATICS POLLER + POSITION STORE ---
+# Page views used to call the provider for every tracked van they showed, so
+# provider load grew with traffic. Now a daemon thread in each worker wakes
+# every TELEMATICS_POLL_INTERVAL seconds and tries to claim the next poll in
+# 'telematics_poll_state'. Only one worker wins per interval; it fetches every
+# tracked vehicle across all tenants (concurrently, via the engine's executor
+# and breakers) and upserts the result into 'vehicle_positions'.
+#
+# Pages call read_positions(), which serves fresh rows from that table and
+# only falls back to a live (cached, time-boxed) fetch for trackers the poller
+# hasn't covered yet - e.g. a van added a few seconds ago, or poller disabled.
+# Tables are created by /admin/setup-indexes-db (ensure_position_tables).
+TELEMATICS_POLL_INTERVAL = float(os.environ.get("TELEMATICS_POLL_INTERVAL", 30))
+TELEMATICS_POLL_BUDGET = float(os.environ.get("TELEMATICS_POLL_BUDGET", 20))        # Max seconds one cycle waits on providers
+TELEMATICS_STALE_AFTER = float(os.environ.get("TELEMATICS_STALE_AFTER", TELEMATICS_POLL_INTERVAL * 3))
+TELEMATICS_RETAIN_HOURS = int(os.environ.get("TELEMATICS_RETAIN_HOURS", 24))       # Drop rows for trackers nobody polls any more
+# On by default wherever there's a database to write to
+TELEMATICS_POLLER = os.environ.get("TELEMATICS_POLLER", "1" if os.environ.get("DATABASE_URL") else "0") == "1"
+
+_poller_pid = None
+_poller_lock = threading.Lock()
+_schema_ready = False
+
+# Per-process counters (the last cycle's numbers are also in the DB for every worker)
+_stats = {
+    'cycles': 0,
+    'skipped': 0,        # woke up but another worker had already claimed the interval
+    'failed': 0,         # cycle aborted (DB down etc.)
+    'polled': 0,
+    'errors': 0,
+    'last_cycle_at': None,
+    'last_error': None
+}
+
+def ensure_position_tables(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS vehicle_positions (
+            company_id INTEGER NOT NULL,
+            tracker_url TEXT NOT NULL,
+            lat DOUBLE PRECISION,
+            lon DOUBLE PRECISION,
+            speed DOUBLE PRECISION,
+            fuel_level DOUBLE PRECISION,
+            status VARCHAR(30),
+            provider VARCHAR(50),
+            polled_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (company_id, tracker_url)
+        );
+    """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS telematics_poll_state (
+            id INTEGER PRIMARY KEY,
+            claimed_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            duration_ms INTEGER,
+            vehicles INTEGER DEFAULT 0,
+            errors INTEGER DEFAULT 0,
+            error_breakdown JSONB,
+            worker_pid INTEGER
+        );
+    """)
+
+def _schema_exists(cur):
+    # Tables come from the /admin/setup-indexes-db migration (ensure_position_tables),
+    # never from a worker: DDL takes locks every page reading positions would queue behind.
+    global _schema_ready
+    if not _schema_ready:
+        cur.execute("SELECT to_regclass('telematics_poll_state') IS NOT NULL")
+        _schema_ready = cur.fetchone()[0]
+        if not _schema_ready:
+            print("⚠️ Telematics Poller: telematics_poll_state missing - run /admin/setup-indexes-db")
+    return _schema_ready
+
+# =========================================================
+# POLLER
+# =========================================================
+def _claim(cur):
+    """True if this worker gets to run the current interval's poll."""
+    cur.execute("""
+        INSERT INTO telematics_poll_state (id, claimed_at, worker_pid) VALUES (1, NOW(), %(pid)s)
+        ON CONFLICT (id) DO UPDATE SET claimed_at = NOW(), worker_pid = %(pid)s
+        WHERE telematics_poll_state.claimed_at IS NULL
+           OR telematics_poll_state.claimed_at < NOW() - make_interval(secs => %(gap)s)
+        RETURNING id
+    """, {'pid': os.getpid(), 'gap': TELEMATICS_POLL_INTERVAL * 0.9})
+    return cur.fetchone() is not None
+
+def _tracked_vehicles(cur):
+    # Distinct (tenant, tracker) pairs with the tenant's provider key
+    cur.execute("""
+        SELECT DISTINCT v.company_id, v.tracker_url, st.value
+        FROM vehicles v
+        LEFT JOIN settings st ON st.company_id = v.company_id AND st.key = 'samsara_api_key'
+        WHERE v.tracker_url IS NOT NULL AND v.tracker_url <> ''
+    """)
+    return cur.fetchall()
+
+def _connect():
+    conn = get_db()
+    if conn is None:
+        raise RuntimeError("no database connection")
+    return conn
+
+def poll_once():
+    """
+    Runs one poll cycle if this worker can claim it. Returns the cycle's
+    summary dict, or None if another worker already polled this interval
+    (or the tables haven't been created yet).
+    The pooled connection is handed back while the providers answer.
+    """
+    conn = _connect()
+    try:
+        cur = conn.cursor()
+        claimed = _schema_exists(cur) and _claim(cur)
+        vehicles = _tracked_vehicles(cur) if claimed else []
+        conn.commit()
+    finally:
+        conn.close()
+
+    if not claimed:
+        _stats['skipped'] += 1
+        return None
+
+    started = time.monotonic()
+    futures = {
+        get_executor().submit(fetch_live, tracker, api_key): (company_id, tracker)
+        for company_id, tracker, api_key in vehicles
+    }
+    done, _ = wait(futures, timeout=TELEMATICS_POLL_BUDGET) if futures else (set(), set())
+
+    rows, breakdown = [], {}
+    for future, (company_id, tracker) in futures.items():
+        if future not in done:
+            error = 'timeout'
+        else:
+            data, error = future.result()
+            if error is None:
+                rows.append((company_id, tracker, data.get('lat'), data.get('lon'), data.get('speed'),
+                             data.get('fuel_level'), data.get('status'), data.get('provider')))
+        if error:
+            breakdown[error] = breakdown.get(error, 0) + 1
+
+    errors = sum(breakdown.values())
+    duration_ms = int((time.monotonic() - started) * 1000)
+
+    conn = _connect()
+    try:
+        cur = conn.cursor()
+        if rows:
+            execute_values(cur, """
+                INSERT INTO vehicle_positions (company_id, tracker_url, lat, lon, speed, fuel_level, status, provider, polled_at)
+                VALUES %s
+                ON CONFLICT (company_id, tracker_url) DO UPDATE SET
+                    lat = EXCLUDED.lat, lon = EXCLUDED.lon, speed = EXCLUDED.speed,
+                    fuel_level = EXCLUDED.fuel_level, status = EXCLUDED.status,
+                    provider = EXCLUDED.provider, polled_at = EXCLUDED.polled_at
+            """, rows, template="(%s, %s, %s, %s, %s, %s, %s, %s, NOW())")
+        cur.execute("DELETE FROM vehicle_positions WHERE polled_at < NOW() - make_interval(hours => %s)",
+                    (TELEMATICS_RETAIN_HOURS,))
+        cur.execute("""
+            UPDATE telematics_poll_state
+            SET finished_at = NOW(), duration_ms = %s, vehicles = %s, errors = %s, error_breakdown = %s::jsonb
+            WHERE id = 1
+        """, (duration_ms, len(vehicles), errors, json.dumps(breakdown)))
+        conn.commit()
+    except Exception:
+        try: conn.rollback()
+        except Exception: pass
+        raise
+    finally:
+        conn.close()
+
+    _stats['cycles'] += 1
+    _stats['polled'] += len(vehicles)
+    _stats['errors'] += errors
+    _stats['last_cycle_at'] = time.time()
+    return {'vehicles': len(vehicles), 'stored': len(rows), 'errors': errors, 'duration_ms': duration_ms}
+
+def _run_forever():
+    # Random start offset so workers booted together don't all race the claim
+    time.sleep(random.uniform(0, min(5, TELEMATICS_POLL_INTERVAL)))
+    while True:
+        started = time.monotonic()
+        try:
+            poll_once()
+        except Exception as e:
+            _stats['failed'] += 1
+            _stats['last_error'] = str(e)
+            print(f"❌ Telematics Poller Error: {e}")
+        elapsed = time.monotonic() - started
+        time.sleep(max(1.0, TELEMATICS_POLL_INTERVAL - elapsed))
+
+def start_poller():
+    """
+    Starts the poller thread for this process (once per pid, so it is safe to
+    call on every request and survives gunicorn forking workers).
+    """
+    global _poller_pid
+    if not TELEMATICS_POLLER or _poller_pid == os.getpid():
+        return
+    with _poller_lock:
+        if _poller_pid == os.getpid():
+            return
+        threading.Thread(target=_run_forever, name="telematics-poller", daemon=True).start()
+        _poller_pid = os.getpid()
+
+# =========================================================
+# READS
+# =========================================================
+def get_stored_positions(cur, company_id, trackers):
+    """{tracker_url: data} for trackers with a position newer than TELEMATICS_STALE_AFTER."""
+    trackers = list({t for t in trackers if t})
+    if not trackers or not TELEMATICS_POLLER:
+        return {}  # Nothing writes the store in this deployment
+    try:
+        cur.execute("SAVEPOINT telematics_read")
+        cur.execute("""
+            SELECT tracker_url, lat, lon, speed, fuel_level, status, provider
+            FROM vehicle_positions
+            WHERE company_id = %s AND tracker_url = ANY(%s)
+              AND polled_at > NOW() - make_interval(secs => %s)
+        """, (company_id, trackers, TELEMATICS_STALE_AFTER))
+        rows = cur.fetchall()
+        cur.execute("RELEASE SAVEPOINT telematics_read")
+    except Exception:
+        # Table not created yet (poller never ran) - fall back to live reads
+        try: cur.execute("ROLLBACK TO SAVEPOINT telematics_read")
+        except Exception: pass
+        return {}
+
+    return {r[0]: {
+        'lat': r[1], 'lon': r[2], 'speed': r[3], 'fuel_level': r[4],
+        'status': r[5], 'provider': r[6]
+    } for r in rows}
+
+def read_positions(cur, company_id, trackers, api_key=None):
+    """
+    Positions for a page: stored rows first, a live time-boxed fetch only for
+    trackers the poller has no fresh row for.
+    """
+    positions = get_stored_positions(cur, company_id, trackers)
+    missing = [t for t in trackers if t and t not in positions]
+    if missing:
+        positions.update(get_fleet_positions(missing, api_key=api_key))
+    return positions
+
+# =========================================================
+# METRICS
+# =========================================================
+def get_poller_metrics(cur):
+    """Poll interval, lag (age of stored positions) and error rate, for /admin/telematics-metrics."""
+    metrics = {
+        'pid': os.getpid(),
+        'enabled': TELEMATICS_POLLER,
+        'thread_running': _poller_pid == os.getpid(),
+        'poll_interval_s': TELEMATICS_POLL_INTERVAL,
+        'stale_after_s': TELEMATICS_STALE_AFTER,
+        'breakers': get_breaker_states(),
+        'this_worker': dict(_stats)
+    }
+    try:
+        cur.execute("SAVEPOINT telematics_metrics")
+        cur.execute("""
+            SELECT claimed_at, finished_at, duration_ms, vehicles, errors, error_breakdown, worker_pid,
+                   EXTRACT(EPOCH FROM NOW() - finished_at)
+            FROM telematics_poll_state WHERE id = 1
+        """)
+        state = cur.fetchone()
+        cur.execute("""
+            SELECT COUNT(*),
+                   EXTRACT(EPOCH FROM NOW() - MIN(polled_at)),
+                   EXTRACT(EPOCH FROM AVG(NOW() - polled_at)),
+                   COUNT(*) FILTER (WHERE polled_at < NOW() - make_interval(secs => %s))
+            FROM vehicle_positions
+        """, (TELEMATICS_STALE_AFTER,))
+        positions = cur.fetchone()
+        cur.execute("RELEASE SAVEPOINT telematics_metrics")
+    except Exception as e:
+        try: cur.execute("ROLLBACK TO SAVEPOINT telematics_metrics")
+        except Exception: pass
+        metrics['error'] = f"Poller tables not available: {e}"
+        return metrics
+
+    if state:
+        vehicles = state[3] or 0
+        metrics['last_cycle'] = {
+            'claimed_at': state[0].isoformat() if state[0] else None,
+            'finished_at': state[1].isoformat() if state[1] else None,
+            'seconds_since_finish': round(float(state[7]), 1) if state[7] is not None else None,
+            'duration_ms': state[2],
+            'vehicles': vehicles,
+            'errors': state[4] or 0,
+            'error_rate_pct': round((state[4] or 0) / vehicles * 100, 1) if vehicles else 0,
+            'error_breakdown': state[5] or {},
+            'worker_pid': state[6]
+        }
+    metrics['positions'] = {
+        'stored': positions[0],
+        'max_lag_s': round(float(positions[1]), 1) if positions[1] is not None else None,
+        'avg_lag_s': round(float(positions[2]), 1) if positions[2] is not None else None,
+        'stale': positions[3]
+    }
+    return metrics
@@ -0,0 +1,70 @@
+# --- services/tenant_cache.py ---
+import os
+import time
+import threading
+from db import get_db
+
+# --- SUBDOMAIN -> TENANT CACHE ---
+# load_tenant_context() runs before every request on a white-label host.
+# Subdomains almost never change, so we map them to (company_id, name) in
+# memory instead of querying 'companies' each time.
+# Unknown subdomains are cached too (for a shorter time) so bots hammering
+# random hosts don't each cost a DB round trip.
+TENANT_CACHE_TTL = float(os.environ.get("TENANT_CACHE_TTL", 300))
+TENANT_NEGATIVE_TTL = float(os.environ.get("TENANT_NEGATIVE_TTL", 60))
+TENANT_CACHE_MAX = int(os.environ.get("TENANT_CACHE_MAX", 5000))
+
+_cache = {}
+_lock = threading.Lock()
+
+def resolve_subdomain(subdomain):
+    """
+    Returns (company_id, company_name) for a subdomain, or None if no company uses it.
+    """
+    subdomain = (subdomain or '').strip().lower()
+    if not subdomain:
+        return None
+
+    now = time.monotonic()
+    entry = _cache.get(subdomain)
+    if entry and now < entry[0]:
+        return entry[1]
+
+    conn = get_db()
+    if not conn:
+        return None
+
+    try:
+        cur = conn.cursor()
+        # Matches the idx_companies_sub_domain_lower expression index
+        cur.execute("SELECT id, name FROM companies WHERE LOWER(sub_domain) = %s", (subdomain,))
+        row = cur.fetchone()
+    except Exception as e:
+        # Don't cache failures - the next request should try again
+        print(f"Subdomain Check Error: {e}")
+        return None
+    finally:
+        conn.close()
+
+    tenant = (row[0], row[1]) if row else None
+    ttl = TENANT_CACHE_TTL if tenant else TENANT_NEGATIVE_TTL
+
+    with _lock:
+        if len(_cache) >= TENANT_CACHE_MAX:
+            # Random-host scans fill the map with misses; drop expired entries first
+            for key in [k for k, v in _cache.items() if v[0] <= now]:
+                del _cache[key]
+            if len(_cache) >= TENANT_CACHE_MAX:
+                _cache.clear()
+        _cache[subdomain] = (now + ttl, tenant)
+    return tenant
+
+def invalidate_tenant(subdomain=None):
+    """
+    Call after creating, renaming or deleting a company. Pass None to clear everything.
+    """
+    with _lock:
+        if subdomain is None:
+            _cache.clear()
+        else:
+            _cache.pop(subdomain.strip().lower(), None)
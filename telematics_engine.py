@@ -1,64 +1,180 @@
+import os
 import requests
 import random
 import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from requests.adapters import HTTPAdapter
 
 # --- TELEMATICS ENGINE (WHITE LABEL READY) ---
-# This engine is 'Stateless'. It accepts an API Key dynamically 
+# This engine is 'Stateless'. It accepts an API Key dynamically
 # for each request, ensuring total separation between companies.
+#
+# Performance layer (page renders must never wait on a slow provider):
+#  - one pooled requests.Session shared by every adapter
+#  - positions cached per device for TELEMATICS_CACHE_SECONDS
+#  - get_fleet_positions() fetches a whole fleet concurrently with a time budget
+#  - a circuit breaker per provider stops calling it after repeated failures
+#  - services/telematics_poller.py polls every tracked vehicle in the
+#    background so page views read a stored position instead of the provider
+
+SAMSARA_API_BASE = os.environ.get("SAMSARA_API_BASE", "https://api.samsara.com")
+SAMSARA_LIVE = os.environ.get("SAMSARA_LIVE", "0") == "1"   # '1' = real API instead of simulation
+TELEMATICS_TIMEOUT = float(os.environ.get("TELEMATICS_TIMEOUT", 3))
+TELEMATICS_CACHE_SECONDS = float(os.environ.get("TELEMATICS_CACHE_SECONDS", 30))
+TELEMATICS_PAGE_BUDGET = float(os.environ.get("TELEMATICS_PAGE_BUDGET", 2))
+TELEMATICS_WORKERS = int(os.environ.get("TELEMATICS_WORKERS", 8))
+
+class ProviderError(Exception):
+    """Timeouts, connection errors, 5xx and unreadable bodies - the kind that trips the breaker."""
+    pass
+
+# --- SHARED HTTP SESSION ---
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                s = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=TELEMATICS_WORKERS)
+                s.mount("https://", adapter)
+                s.mount("http://", adapter)
+                _session = s
+    return _session
+
+# --- CIRCUIT BREAKER ---
+class CircuitBreaker:
+    """
+    CLOSED: calls go through. After 'threshold' consecutive failures -> OPEN.
+    OPEN: calls are skipped for 'reset_after' seconds, then one trial call
+    is let through (HALF-OPEN). Success closes it again, failure re-opens.
+    """
+    def __init__(self, name, threshold=3, reset_after=30):
+        self.name = name
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None: return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_after: return 'half-open'
+        return 'open'
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed': return True
+            if state == 'half-open' and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.failures >= self.threshold or self.opened_at is not None:
+                if self.opened_at is None:
+                    print(f"⚠️ Telematics circuit OPEN for {self.name}")
+                self.opened_at = time.monotonic()
+
+_breakers = {}
+
+def get_breaker_states():
+    return {name: b.state for name, b in _breakers.items()}
+
+def get_breaker(provider):
+    if provider not in _breakers:
+        _breakers[provider] = CircuitBreaker(
+            provider,
+            threshold=int(os.environ.get("TELEMATICS_BREAKER_THRESHOLD", 3)),
+            reset_after=float(os.environ.get("TELEMATICS_BREAKER_RESET", 30))
+        )
+    return _breakers[provider]
 
 class TelematicsBase:
+    provider = 'base'
+
     def get_stats(self, identifier):
         raise NotImplementedError("Must implement get_stats")
 
 # --- 1. SAMSARA ADAPTER ---
 class SamsaraAdapter(TelematicsBase):
+    provider = 'samsara'
+
     def __init__(self, api_key):
-        self.api_key = api_key 
+        self.api_key = api_key
 
     def get_stats(self, url_or_id):
         if not self.api_key:
             return None # Cannot connect without a company key
-            
+
         # Extract ID (e.g. from "https://api.samsara.com/.../12345" -> "12345")
         device_id = str(url_or_id).split('/')[-1] if '/' in str(url_or_id) else str(url_or_id)
-        
-        # Real Endpoint (Example)
-        url = f"https://api.samsara.com/fleet/vehicles/{device_id}/stats"
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        try:
-            # --- REAL API CALL (Enable when you have a key) ---
-            # response = requests.get(url, headers=headers, timeout=5)
-            # if response.status_code == 200:
-            #     data = response.json()
-            #     return {
-            #         "lat": data.get('gps', {}).get('latitude'),
-            #         "lon": data.get('gps', {}).get('longitude'),
-            #         "speed": data.get('gps', {}).get('speedMilesPerHour'),
-            #         "fuel_level": data.get('fuelLevel', {}).get('percent'),
-            #         "status": "Active",
-            #         "provider": "Samsara"
-            #     }
-            
-            # --- SIMULATION (For Testing) ---
-            # Returns dummy data so the map works immediately
-            return {
-                "lat": 51.5074 + (random.uniform(-0.01, 0.01)), 
-                "lon": -0.1278 + (random.uniform(-0.01, 0.01)),
-                "speed": 45,
-                "fuel_level": 78,
-                "status": "Active",
-                "provider": "Samsara (Sim)"
+
+        if SAMSARA_LIVE:
+            url = f"{SAMSARA_API_BASE}/fleet/vehicles/{device_id}/stats"
+            headers = {
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json"
             }
-        except Exception as e:
-            print(f"Samsara API Error: {e}")
-            return None
+            try:
+                response = get_session().get(url, headers=headers, timeout=TELEMATICS_TIMEOUT)
+            except requests.RequestException as e:
+                raise ProviderError(f"Samsara API Error: {e}")
+
+            if response.status_code >= 500:
+                raise ProviderError(f"Samsara API Error: HTTP {response.status_code}")
+            if response.status_code != 200:
+                # Bad key / unknown device: the provider is healthy, the request isn't
+                print(f"Samsara API Error: HTTP {response.status_code} for {device_id}")
+                return None
+
+            # A 200 with a body we can't read is the provider misbehaving too
+            try:
+                data = response.json()
+                gps = data.get('gps') or {}
+                fuel = data.get('fuelLevel') or {}
+                return {
+                    "lat": gps.get('latitude'),
+                    "lon": gps.get('longitude'),
+                    "speed": gps.get('speedMilesPerHour'),
+                    "fuel_level": fuel.get('percent'),
+                    "status": "Active",
+                    "provider": "Samsara"
+                }
+            except (ValueError, AttributeError, TypeError) as e:
+                raise ProviderError(f"Samsara API Error: unreadable response ({e})")
+
+        # --- SIMULATION (For Testing) ---
+        # Returns dummy data so the map works immediately
+        return {
+            "lat": 51.5074 + (random.uniform(-0.01, 0.01)),
+            "lon": -0.1278 + (random.uniform(-0.01, 0.01)),
+            "speed": 45,
+            "fuel_level": 78,
+            "status": "Active",
+            "provider": "Samsara (Sim)"
+        }
 
 # --- 2. SIMULATION ADAPTER ---
 class SimulationAdapter(TelematicsBase):
+    provider = 'simulation'
+
     def get_stats(self, seed):
         base_lat = 54.5; base_lon = -3.0
         return {
@@ -70,26 +186,123 @@ class SimulationAdapter(TelematicsBase):
             "provider": "Simulation"
         }
 
-# --- FACTORY FUNCTION ---
-def get_tracker_data(tracker_input, api_key=None):
+def get_adapter(tracker_input, api_key=None):
     """
     Decides which tracker to use based on the input URL/ID.
-    Requires 'api_key' to be passed in from the database.
+    Returns None for providers we can't talk to yet.
     """
-    if not tracker_input: return None
-
     input_lower = str(tracker_input).lower()
 
     # 1. Check for Advanced Providers
     if "samsara" in input_lower:
-        adapter = SamsaraAdapter(api_key)
-        return adapter.get_stats(tracker_input)
-        
+        return SamsaraAdapter(api_key)
     elif "geotab" in input_lower:
         # Placeholder for Geotab
-        return None 
+        return None
 
     # 2. Fallback to Simulation (No Key Needed)
-    else:
-        adapter = SimulationAdapter()
-        return adapter.get_stats(tracker_input)
\ No newline at end of file
+    return SimulationAdapter()
+
+# --- POSITION CACHE ---
+# Keyed by tracker + a hash of the company's key, so two tenants pointing at
+# the same device never share results.
+_positions = {}
+_positions_lock = threading.Lock()
+
+def _cache_key(tracker_input, api_key):
+    key_hash = hashlib.sha256(api_key.encode()).hexdigest()[:12] if api_key else ''
+    return (str(tracker_input), key_hash)
+
+def _cached(key, max_age):
+    entry = _positions.get(key)
+    if entry and time.monotonic() - entry[0] < max_age:
+        return entry[1]
+    return None
+
+def fetch_live(tracker_input, api_key):
+    """
+    One live call through the provider's breaker. Updates the cache.
+    Returns (data, error) - 'error' is None on success, otherwise a short
+    reason ('breaker_open', 'provider_error', 'error', 'no_data'), and 'data'
+    falls back to the last known position where there is one.
+    """
+    adapter = get_adapter(tracker_input, api_key)
+    if adapter is None: return None, 'unsupported'
+
+    key = _cache_key(tracker_input, api_key)
+    breaker = get_breaker(adapter.provider)
+    if not breaker.allow():
+        # Provider is down: serve the last known position, however old
+        entry = _positions.get(key)
+        return (entry[1] if entry else None), 'breaker_open'
+
+    try:
+        data = adapter.get_stats(tracker_input)
+        breaker.record_success()
+    except ProviderError as e:
+        print(e)
+        breaker.record_failure()
+        entry = _positions.get(key)
+        return (entry[1] if entry else None), 'provider_error'
+    except Exception as e:
+        # Still settle the breaker, or a half-open trial would never end
+        print(f"Telematics Error ({adapter.provider}): {e}")
+        breaker.record_failure()
+        return None, 'error'
+
+    if data is None:
+        return None, 'no_data'
+    with _positions_lock:
+        _positions[key] = (time.monotonic(), data)
+    return data, None
+
+def _fetch(tracker_input, api_key):
+    return fetch_live(tracker_input, api_key)[0]
+
+# --- FACTORY FUNCTION ---
+def get_tracker_data(tracker_input, api_key=None):
+    """
+    Latest stats for one tracker (cached for TELEMATICS_CACHE_SECONDS).
+    Requires 'api_key' to be passed in from the database.
+    """
+    if not tracker_input: return None
+    cached = _cached(_cache_key(tracker_input, api_key), TELEMATICS_CACHE_SECONDS)
+    if cached is not None: return cached
+    return _fetch(tracker_input, api_key)
+
+_executor = None
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _session_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=TELEMATICS_WORKERS, thread_name_prefix="telematics")
+    return _executor
+
+def get_fleet_positions(trackers, api_key=None, budget=None):
+    """
+    Stats for many trackers at once: {tracker_input: data or None}.
+    Cache hits return immediately; misses are fetched in parallel. Anything
+    still running after 'budget' seconds comes back as its last known value
+    (or None) and finishes in the background to warm the cache.
+    """
+    budget = TELEMATICS_PAGE_BUDGET if budget is None else budget
+    results, pending = {}, {}
+
+    for tracker in {t for t in trackers if t}:
+        cached = _cached(_cache_key(tracker, api_key), TELEMATICS_CACHE_SECONDS)
+        if cached is not None:
+            results[tracker] = cached
+        else:
+            pending[get_executor().submit(_fetch, tracker, api_key)] = tracker
+
+    if pending:
+        done, _ = wait(pending, timeout=budget)
+        for future, tracker in pending.items():
+            if future in done:
+                results[tracker] = future.result()
+            else:
+                entry = _positions.get(_cache_key(tracker, api_key))
+                results[tracker] = entry[1] if entry else None
+    return results
@@ -0,0 +1,55 @@
+# tests/conftest.py
+# Unit tests for the pure service code (no Postgres needed).
+# Run from the repo root: python -m pytest -q tests
+# Tests marked with the 'pg' fixture also run against a real database when
+# TEST_DATABASE_URL points at a scratch one; otherwise they are skipped.
+import io
+import os
+import csv
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+class RecordingCursor:
+    """
+    Stand-in for a psycopg2 cursor: records SQL, keeps what was COPY'd, and
+    answers fetches from 'results' ({SQL substring: rows}).
+    """
+
+    def __init__(self, results=None):
+        self.results = results or {}
+        self.statements = []
+        self.copied = []   # parsed CSV rows, in COPY order
+        self.rowcount = 0
+        self._last = None
+
+    def execute(self, sql, params=None):
+        self.statements.append((sql, params))
+        self._last = next((rows for needle, rows in self.results.items() if needle in sql), [])
+
+    def copy_expert(self, sql, buf):
+        self.statements.append((sql, None))
+        self.copied.extend(csv.reader(io.StringIO(buf.read())))
+
+    def fetchall(self):
+        return list(self._last)
+
+    def fetchone(self):
+        return self._last[0] if self._last else None
+
+@pytest.fixture
+def recording_cursor():
+    return RecordingCursor
+
+@pytest.fixture
+def pg():
+    dsn = os.environ.get("TEST_DATABASE_URL")
+    if not dsn:
+        pytest.skip("TEST_DATABASE_URL not set")
+    import psycopg2
+    conn = psycopg2.connect(dsn)
+    yield conn
+    conn.rollback()
+    conn.close()
@@ -0,0 +1,115 @@
+# tests/test_bulk_import.py
+import io
+from decimal import Decimal
+
+import pytest
+from services import bulk_import
+from services.bulk_import import IMPORT_TYPES, run_import
+
+def parse(kind, row):
+    return IMPORT_TYPES[kind]['parse'](row)
+
+# =========================================================
+# PARSERS
+# =========================================================
+def test_client_key_is_email_or_name():
+    assert parse('clients', ['Jo Bloggs', ' Jo@Example.COM ', '0700', '1 High St']) == \
+        ('jo@example.com', ('Jo Bloggs', 'jo@example.com', '0700', '1 High St', '1 High St'))
+    key, values = parse('clients', ['  Acme Ltd ', '', '', ''])
+    assert key == 'name:acme ltd' and values[1] is None   # NULL, not '', so the email stays unset
+
+def test_staff_rate_accepts_decimal_comma():
+    assert parse('staff', ['Sam', 'sam@example.com', 'Fitter', '18,50']) == \
+        ('sam@example.com', ('Sam', 'sam@example.com', 'Fitter', Decimal('18.50')))
+    assert parse('staff', ['Sam', 'sam@example.com'])[1][3] == Decimal('0.00')
+
+def test_vehicle_key_ignores_spacing_and_case():
+    assert parse('vehicles', ['ab12 cde', 'Ford Transit', '£45'])[0] == 'AB12CDE'
+    assert parse('vehicles', [' AB12  CDE', '', ''])[0] == 'AB12CDE'
+
+@pytest.mark.parametrize('kind, row, message', [
+    ('clients', ['', 'jo@example.com'], 'Missing name'),
+    ('clients', ['Jo', 'not-an-email'], 'Invalid email'),
+    ('staff', ['Sam', ''], 'Missing email'),
+    ('staff', ['Sam', 'sam@example.com', '', 'lots'], 'Invalid rate'),
+    ('staff', ['Sam', 'sam@example.com', '', '-12'], 'Invalid rate'),
+    ('staff', ['Sam', 'sam@example.com', '', '12,5000'], 'Ambiguous rate'),
+    ('vehicles', ['  ', 'Van'], 'Missing reg plate'),
+    ('vehicles', ['AB12CDE', 'Van', '£4O'], 'Invalid daily cost'),
+])
+def test_parser_errors(kind, row, message):
+    with pytest.raises(ValueError, match=message):
+        parse(kind, row)
+
+# =========================================================
+# RUN_IMPORT (recording cursor, no database)
+# =========================================================
+def _run(cur, kind, text, **kwargs):
+    return run_import(cur, 7, kind, io.StringIO(text), **kwargs)
+
+def test_duplicate_keys_are_counted_and_all_staged(recording_cursor):
+    cur = recording_cursor()
+    report = _run(cur, 'vehicles', "Reg,Model,Cost\nAB12 CDE,Transit,40\nab12cde,Transit Custom,45\nXY99 ZZZ,Vivaro,35\n")
+    assert (report['rows'], report['duplicates'], report['rejected']) == (3, 1, 0)
+    # The merge picks the last line per key; both are staged
+    assert [(r[0], r[1]) for r in cur.copied] == [('2', 'AB12CDE'), ('3', 'AB12CDE'), ('4', 'XY99ZZZ')]
+
+def test_bad_rows_are_reported_by_line(recording_cursor):
+    cur = recording_cursor()
+    report = _run(cur, 'staff', "Name,Email,Position,Rate\nSam,sam@example.com,,15\n,,,\nAl,,,15\nBo,bo@example.com,,\"1,5000\"\n")
+    assert report['rejected'] == 2
+    assert [(e['line'], e['value']) for e in report['errors']] == [(4, 'Al'), (5, 'Bo')]
+    assert len(cur.copied) == 1
+
+def test_values_longer_than_the_column_are_rejected(recording_cursor):
+    cur = recording_cursor({'information_schema.columns': [('reg_plate', 8)]})
+    report = _run(cur, 'vehicles', "Reg\nAB12 CDE\nAB12 CDE FGH IJK\n")
+    assert report['rejected'] == 1
+    assert report['errors'][0]['error'] == 'reg_plate is longer than 8 characters'
+
+def test_error_list_is_capped(recording_cursor, monkeypatch):
+    monkeypatch.setattr(bulk_import, 'IMPORT_MAX_ERRORS', 2)
+    report = _run(recording_cursor(), 'clients', "Name\n" + ",x\n" * 5)
+    assert report['rejected'] == 5 and len(report['errors']) == 2 and report['errors_truncated']
+
+def test_merge_uses_key_sql(recording_cursor):
+    cur = recording_cursor()
+    _run(cur, 'clients', "Name,Email\nJo,jo@example.com\n")
+    key_sql = IMPORT_TYPES['clients']['key_sql'].format(t='m')
+    merges = [sql for sql, _ in cur.statements if 'UPDATE clients' in sql or 'INSERT INTO clients' in sql]
+    assert len(merges) == 2 and all(key_sql in sql for sql in merges)
+
+def test_dry_run_only_counts(recording_cursor):
+    cur = recording_cursor({'COUNT(*) FILTER': [(1, 3)]})
+    report = _run(cur, 'clients', "Name\nA\nB\nC\n", dry_run=True)
+    assert (report['updated'], report['inserted']) == (1, 2)
+    assert not any('UPDATE clients' in sql or 'INSERT INTO clients' in sql for sql, _ in cur.statements)
+
+def test_nothing_valid_skips_the_merge(recording_cursor):
+    cur = recording_cursor()
+    report = _run(cur, 'staff', "Name,Email\nSam,\n")
+    assert report['rejected'] == 1
+    assert not any('pg_advisory_xact_lock' in sql for sql, _ in cur.statements)
+
+# =========================================================
+# KEY MATCHING (needs TEST_DATABASE_URL)
+# =========================================================
+# The parser's key and key_sql over the stored record must agree, or
+# re-importing a file inserts duplicates instead of updating.
+@pytest.mark.parametrize('kind, row, stored', [
+    ('clients', ['Jo Bloggs', 'Jo@Example.com'], {'email': ' JO@example.com ', 'name': 'Jo'}),
+    ('clients', ['Acme Ltd', ''], {'email': None, 'name': ' ACME Ltd '}),
+    ('clients', ['Acme Ltd', ''], {'email': '', 'name': 'acme ltd'}),
+    ('staff', ['Sam', 'Sam@Example.com'], {'email': 'sam@example.com ', 'name': 'Sam'}),
+    ('vehicles', ['ab12 cde'], {'reg_plate': 'AB12  CDE', 'name': None}),
+    ('vehicles', ['AB12CDE'], {'reg_plate': 'ab12\tcde', 'name': None}),
+])
+def test_parser_key_matches_key_sql(pg, kind, row, stored):
+    key, _ = parse(kind, row)
+    record = {'email': None, 'name': None, 'reg_plate': None, **stored}
+    cur = pg.cursor()
+    cur.execute(f"""
+        SELECT {IMPORT_TYPES[kind]['key_sql'].format(t='m')}
+        FROM (SELECT %(email)s::text AS email, %(name)s::text AS name, %(reg_plate)s::text AS reg_plate) m
+    """, record)
+    assert cur.fetchone()[0] == key
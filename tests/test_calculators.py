@@ -0,0 +1,135 @@
+# tests/test_calculators.py
+import pytest
+from services import batch_quote
+from services.calculators import base, get_calculator, AVAILABLE_CALCS
+from services.calculators.base import BaseCalculator
+from services.batch_quote import quote_batch
+
+class DeckCalculator(BaseCalculator):
+    def __init__(self):
+        self.name, self.id, self.calls = "Decking", "decking", 0
+
+    def get_config(self):
+        return {'id': self.id, 'name': self.name, 'fields': [
+            {'id': 'area', 'label': 'Area (m2)', 'type': 'number'},
+            {'id': 'finish', 'label': 'Finish', 'type': 'select'}
+        ]}
+
+    def calculate_requirements(self, inputs):
+        self.calls += 1
+        area = inputs.get('area', 10.0)
+        if area < 0: raise ValueError("Area can't be negative")
+        return {'materials': [{'name': 'Deck Board', 'qty': area * 2}, {'name': 'Screws', 'qty': 1}],
+                'labor_hours': area / 2, 'waste_load': 1}
+
+# =========================================================
+# NORMALISE_INPUTS / REQUIREMENTS
+# =========================================================
+def test_numeric_strings_and_numbers_share_a_key():
+    calc = DeckCalculator()
+    assert calc.normalise_inputs({'area': '20'}) == calc.normalise_inputs({'area': 20}) == (('area', 20.0),)
+    assert calc.normalise_inputs({'area': ' 2.5 '}) == (('area', 2.5),)
+
+def test_unknown_blank_and_missing_fields_are_left_out():
+    calc = DeckCalculator()
+    assert calc.normalise_inputs({'area': '', 'finish': None, 'colour': 'red'}) == ()
+    assert calc.normalise_inputs({'finish': 3}) == (('finish', '3'),)   # Non-number fields become text
+
+@pytest.mark.parametrize('value', ['twenty', '1,5', [20], {}, 'inf', '-Infinity', 'nan', float('inf')])
+def test_bad_numbers_raise_value_error(value):
+    with pytest.raises(ValueError, match='Area \\(m2\\) must be a number'):
+        DeckCalculator().normalise_inputs({'area': value})
+
+def test_requirements_are_memoized_per_distinct_input():
+    calc = DeckCalculator()
+    first = calc.requirements({'area': '20'})
+    assert calc.requirements({'area': 20.0, 'colour': 'ignored'}) is first
+    calc.requirements({'area': 21})
+    calc.requirements(None)   # Defaults
+    assert calc.calls == 3
+
+def test_memo_is_per_instance_and_bounded(monkeypatch):
+    monkeypatch.setattr(base, 'CALC_MEMO_SIZE', 2)
+    calc, other = DeckCalculator(), DeckCalculator()
+    for area in (1, 2, 3):
+        calc.requirements({'area': area})
+    assert len(calc._memo) == 1   # Cleared when full, then the new entry added
+    other.requirements({'area': 3})
+    assert other.calls == 1
+
+def test_failures_are_not_memoized():
+    calc = DeckCalculator()
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            calc.requirements({'area': -1})
+    assert calc.calls == 2
+
+def test_registry_lookup():
+    assert get_calculator('fencing') is AVAILABLE_CALCS['fencing']
+    assert get_calculator('base') is None
+    assert get_calculator(['fencing']) is None
+    reqs = get_calculator('fencing').requirements({'length': '20', 'height': '1.8'})
+    assert reqs is get_calculator('fencing').requirements({'length': 20, 'height': 1.8})
+
+# =========================================================
+# QUOTE_BATCH
+# =========================================================
+@pytest.fixture
+def batch(monkeypatch):
+    calc = DeckCalculator()
+    lookups = []
+
+    def fake_price_materials(cur, company_id, materials):
+        lookups.append([m['name'] for m in materials])
+        return [{'name': m['name'], 'qty': m['qty'], 'cost_price': 10.0 if m['name'] == 'Deck Board' else 4.0,
+                 'supplier': 'Timber Co' if m['name'] == 'Deck Board' else 'Generic', 'supplier_email': None,
+                 'matched': m['name'] == 'Deck Board'} for m in materials]
+
+    monkeypatch.setattr(batch_quote, 'get_calculator', lambda trade: calc if trade == 'decking' else None)
+    monkeypatch.setattr(batch_quote, 'price_materials', fake_price_materials)
+    return calc, lookups
+
+def test_batch_prices_everything_with_one_lookup(batch):
+    calc, lookups = batch
+    jobs = [{'trade': 'decking', 'inputs': {'area': '5'}, 'ref': 'Plot 1'},
+            {'trade': 'decking', 'inputs': {'area': 5}, 'ref': 'Plot 2'},
+            {'trade': 'decking', 'inputs': {'area': 10}}]
+    result = quote_batch(None, 7, jobs, 1.5)
+
+    assert len(lookups) == 1 and sorted(lookups[0]) == ['Deck Board', 'Screws']
+    assert calc.calls == 2   # Plots 1 and 2 are the same job
+    assert [j['ref'] for j in result['jobs']] == ['Plot 1', 'Plot 2', 2]
+    assert result['jobs'][0]['material_total'] == 5 * 2 * 15.0 + 6.0
+    assert {l['name']: l['qty'] for l in result['shopping_list']} == {'Deck Board': 40.0, 'Screws': 3}
+    assert [l['supplier'] for l in result['shopping_list']] == ['Generic', 'Timber Co']
+    assert result['totals'] == {'jobs': 3, 'priced': 3, 'errors': 0, 'distinct_inputs': 2,
+                                'material_total': 618.0, 'labor_hours': 10.0, 'waste_load': 3}
+
+@pytest.mark.parametrize('job, error', [
+    ({'trade': 'plumbing', 'inputs': {}}, 'Trade type "plumbing" not supported'),
+    ({'inputs': {'area': 5}}, 'Trade type "None" not supported'),
+    ({'trade': ['decking']}, 'not supported'),
+    ('decking', 'not supported'),
+    (None, 'not supported'),
+    ({'trade': 'decking', 'inputs': {'area': 'lots'}}, 'must be a number'),
+    ({'trade': 'decking', 'inputs': {'area': 'inf'}}, 'must be a number'),
+    ({'trade': 'decking', 'inputs': {'area': 'NaN'}}, 'must be a number'),
+    ({'trade': 'decking', 'inputs': {'area': -2}}, "can't be negative"),
+])
+def test_bad_jobs_are_reported_without_failing_the_batch(batch, job, error):
+    result = quote_batch(None, 7, [{'trade': 'decking', 'inputs': {'area': 1}}, job], 1.0)
+    good, bad = result['jobs']
+    assert good['status'] == 'success' and bad['status'] == 'error'
+    assert error in bad['error'] and bad['ref'] == 1
+    assert (result['totals']['priced'], result['totals']['errors']) == (1, 1)
+
+def test_infinite_fence_is_a_bad_job_not_a_500(monkeypatch):
+    monkeypatch.setattr(batch_quote, 'price_materials', lambda cur, company_id, materials: [])
+    result = quote_batch(None, 7, [{'trade': 'fencing', 'inputs': {'length': 'inf'}}], 1.0)
+    assert result['jobs'][0]['status'] == 'error' and result['totals']['errors'] == 1
+
+def test_batch_of_only_bad_jobs(batch):
+    _, lookups = batch
+    result = quote_batch(None, 7, [{'trade': 'nope'}], 1.0)
+    assert result['shopping_list'] == [] and result['totals']['material_total'] == 0
+    assert lookups == [[]]
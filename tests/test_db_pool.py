@@ -0,0 +1,41 @@
+# tests/test_db_pool.py
+import gc
+
+import db
+from psycopg2 import extensions
+
+class FakeConn:
+    closed, autocommit = 0, False
+
+    def get_transaction_status(self):
+        return extensions.TRANSACTION_STATUS_INTRANS
+
+    def rollback(self):
+        self.rolled_back = True
+
+    def close(self):
+        self.closed = 1
+
+def test_dropped_connection_is_released_by_the_next_checkout(monkeypatch):
+    monkeypatch.setattr(db, '_pool_stats', dict(db._pool_stats, in_use=1))
+    monkeypatch.setattr(db, '_orphaned', db.deque())
+    raw = FakeConn()
+    conn = db.PooledConnection(raw, object())   # Not the live pool: released by closing it
+
+    with db._stats_lock:   # GC inside a locked section used to deadlock the finaliser
+        del conn
+        gc.collect()
+    assert len(db._orphaned) == 1 and not raw.closed
+
+    db._release_orphans()
+    assert raw.closed and raw.rolled_back and not db._orphaned
+    assert db._pool_stats['in_use'] == 0
+
+def test_closed_connection_is_not_queued(monkeypatch):
+    monkeypatch.setattr(db, '_pool_stats', dict(db._pool_stats, in_use=1))
+    monkeypatch.setattr(db, '_orphaned', db.deque())
+    conn = db.PooledConnection(FakeConn(), object())
+    conn.close()
+    del conn
+    gc.collect()
+    assert not db._orphaned and db._pool_stats['in_use'] == 0
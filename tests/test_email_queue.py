@@ -0,0 +1,269 @@
+# tests/test_email_queue.py
+# Send throttle, delivery over a local SMTP stub, and outcome bookkeeping.
+import os
+import threading
+import socketserver
+from datetime import date
+
+import pytest
+import email_service
+from services import email_queue
+from services.email_queue import _throttle
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(email_queue.time, 'monotonic', lambda: now[0])
+    monkeypatch.setattr(email_queue, 'EMAIL_HOST_RATE', 60.0)   # 1 a second
+    monkeypatch.setattr(email_queue, 'EMAIL_HOST_BURST', 3.0)
+    monkeypatch.setattr(email_queue, '_buckets', {})
+    return now
+
+def test_burst_then_wait(clock):
+    assert [_throttle('smtp.a') for _ in range(3)] == [0, 0, 0]
+    assert _throttle('smtp.a') == pytest.approx(1.0)
+
+def test_tokens_refill_at_the_rate(clock):
+    for _ in range(3): _throttle('smtp.a')
+    clock[0] += 0.5
+    assert _throttle('smtp.a') == pytest.approx(0.5)
+    clock[0] += 0.5
+    assert _throttle('smtp.a') == 0
+    assert _throttle('smtp.a') == pytest.approx(1.0)
+
+def test_refill_is_capped_at_the_burst(clock):
+    _throttle('smtp.a')
+    clock[0] += 3600
+    assert [_throttle('smtp.a') for _ in range(4)] == [0, 0, 0, pytest.approx(1.0)]
+
+def test_hosts_have_separate_buckets(clock):
+    for _ in range(3): _throttle('smtp.a')
+    assert _throttle('smtp.b') == 0
+    assert _throttle('smtp.a') > 0
+
+def test_deferred_calls_do_not_use_tokens(clock):
+    for _ in range(3): _throttle('smtp.a')
+    for _ in range(5): _throttle('smtp.a')   # Refused, so nothing is owed
+    clock[0] += 1
+    assert _throttle('smtp.a') == 0
+
+def test_zero_rate_is_unlimited(clock, monkeypatch):
+    monkeypatch.setattr(email_queue, 'EMAIL_HOST_RATE', 0)
+    assert all(_throttle('smtp.a') == 0 for _ in range(100))
+    assert email_queue._buckets == {}
+
+# =========================================================
+# DELIVERY (local SMTP stub)
+# =========================================================
+class StubSMTP(socketserver.StreamRequestHandler):
+    mode = 'ok'   # set by the tests: 'ok' | 'busy' (451 on MAIL) | 'reject' (550 on RCPT) | 'hangup' (after one message)
+    connections = 0
+    messages = []   # (connection no, recipient)
+
+    def handle(self):
+        StubSMTP.connections += 1
+        conn_no, rcpt = StubSMTP.connections, None
+        self._reply('220 stub ESMTP')
+        while True:
+            line = self.rfile.readline().decode().strip()
+            if not line:
+                return
+            verb = line.split(' ', 1)[0].upper()
+            if verb in ('EHLO', 'HELO'):
+                self._reply('250 stub')   # No STARTTLS / AUTH offered
+            elif verb == 'MAIL':
+                self._reply('451 Try again later' if self.mode == 'busy' else '250 OK')
+            elif verb == 'RCPT':
+                rcpt = line.split(':', 1)[1].strip('<> ')
+                self._reply('550 No such user' if self.mode == 'reject' else '250 OK')
+            elif verb == 'DATA':
+                self._reply('354 End with .')
+                while self.rfile.readline().rstrip(b'\r\n') != b'.':
+                    pass
+                StubSMTP.messages.append((conn_no, rcpt))
+                self._reply('250 Queued')
+                if self.mode == 'hangup':
+                    return
+            elif verb == 'QUIT':
+                self._reply('221 Bye')
+                return
+            else:   # RSET, NOOP
+                self._reply('250 OK')
+
+    def _reply(self, text):
+        self.wfile.write(f"{text}\r\n".encode())
+
+@pytest.fixture
+def smtp(monkeypatch):
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), StubSMTP)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True).start()
+    StubSMTP.mode, StubSMTP.connections, StubSMTP.messages = 'ok', 0, []
+
+    port = server.server_address[1]
+    settings = {'smtp_host': '127.0.0.1', 'smtp_port': str(port), 'smtp_email': 'office@example.com', 'smtp_password': 'x'}
+    monkeypatch.setattr(email_queue, 'get_settings', lambda company_id: dict(settings))
+    monkeypatch.setattr(email_service, 'SMTP_REQUIRE_TLS', False)
+    monkeypatch.setattr(email_queue, 'EMAIL_HOST_RATE', 0)
+    monkeypatch.setattr(email_queue, 'EMAIL_QUEUE_WORKER', False)
+    monkeypatch.setattr(email_queue, '_sessions', {})
+    yield StubSMTP
+    for company_id in list(email_queue._sessions):
+        email_queue._drop_session(company_id)
+    server.shutdown()
+    server.server_close()
+
+def _email(email_id, company_id, attempts=1, ref=(None, None)):
+    return {'id': email_id, 'company_id': company_id, 'to': f"client{email_id}@example.com", 'subject': 'Invoice',
+            'body': '<p>Hi</p>', 'body_type': 'html', 'attempts': attempts, 'ref_type': ref[0], 'ref_id': ref[1],
+            'attachments': [('INV-1.pdf', b'%PDF-1.4')]}
+
+def test_one_session_per_tenant_batch(smtp):
+    batch = [_email(1, 1), _email(2, 2), _email(3, 1), _email(4, 2), _email(5, 1)]
+    results = email_queue._send_batch(batch)
+    assert [outcome for _, outcome, _ in results] == ['sent'] * 5
+    assert smtp.connections == 2
+    by_conn = {}
+    for conn_no, rcpt in smtp.messages:
+        by_conn.setdefault(conn_no, []).append(rcpt)
+    assert sorted(map(len, by_conn.values())) == [2, 3]
+
+    # The next batch reuses the open sessions
+    email_queue._send_batch([_email(6, 1), _email(7, 2)])
+    assert smtp.connections == 2 and len(smtp.messages) == 7
+
+def test_session_is_recycled_after_max_messages(smtp, monkeypatch):
+    monkeypatch.setattr(email_queue, 'EMAIL_SMTP_MAX_PER_SESSION', 2)
+    email_queue._send_batch([_email(i, 1) for i in range(5)])
+    assert smtp.connections == 3
+
+def test_transient_error_retries_and_stops_the_tenant_batch(smtp):
+    smtp.mode = 'busy'
+    results = email_queue._send_batch([_email(1, 1), _email(2, 1)])
+    assert [outcome for _, outcome, _ in results] == ['retry', 'retry']
+    assert '451' in results[0][2] and results[1][2] == results[0][2]
+    assert smtp.connections == 1   # Second message not tried on a server that just refused
+    assert 1 not in email_queue._sessions   # Next attempt starts a fresh session
+
+def test_rejected_recipient_fails_permanently(smtp):
+    smtp.mode = 'reject'
+    results = email_queue._send_batch([_email(1, 1), _email(2, 1)])
+    assert [outcome for _, outcome, _ in results] == ['failed', 'failed']
+    assert smtp.connections == 1   # Session kept: the server is fine, the address isn't
+
+def test_server_hangup_reconnects_once(smtp):
+    smtp.mode = 'hangup'
+    email_queue._send_batch([_email(1, 1)])
+    smtp.mode = 'ok'
+    results = email_queue._send_batch([_email(2, 1)])
+    assert results[0][1] == 'sent' and smtp.connections == 2
+
+# =========================================================
+# RECORDING OUTCOMES
+# =========================================================
+def _record(recording_cursor, result, rows=None):
+    cur = recording_cursor(rows or {})
+    email_queue._record(cur, [result])
+    return cur.statements
+
+@pytest.mark.parametrize('attempts, low, high', [(1, 24, 36), (3, 96, 144), (20, 2880, 4320)])
+def test_retry_backs_off_exponentially(recording_cursor, monkeypatch, attempts, low, high):
+    monkeypatch.setattr(email_queue, 'EMAIL_MAX_ATTEMPTS', 50)
+    statements = _record(recording_cursor, (_email(1, 1, attempts, ('invoice', 9)), 'retry', '451'))
+    (sql, params), (ref_sql, ref_params) = statements
+    assert "status = 'queued'" in sql and low <= params[1] <= high
+    assert "email_status = 'Retrying'" in ref_sql and ref_params == (9, 1)
+
+def test_retry_gives_up_after_max_attempts(recording_cursor):
+    email = _email(1, 1, email_queue.EMAIL_MAX_ATTEMPTS, ('quote', 4))
+    statements = _record(recording_cursor, (email, 'retry', '451'))
+    assert "status = 'failed'" in statements[0][0]
+    assert "UPDATE quotes SET email_status = 'Failed'" in statements[1][0]
+
+def test_deferred_gives_the_attempt_back(recording_cursor):
+    (sql, params), = _record(recording_cursor, (_email(1, 1, 2, ('invoice', 9)), 'deferred', 1.5))
+    assert 'attempts = attempts - 1' in sql and params == (1.5, 1)
+
+def test_delivery_marks_the_invoice_sent(recording_cursor, monkeypatch):
+    refreshed = []
+    monkeypatch.setattr(email_queue, 'refresh_rollups', lambda cur, *args: refreshed.append(args))
+    statements = _record(recording_cursor, (_email(1, 3, 1, ('invoice', 9)), 'sent', None),
+                         {'UPDATE invoices': [(date(2026, 10, 1),)]})
+    assert "status = 'sent'" in statements[0][0]
+    assert "email_status = 'Sent'" in statements[1][0] and "THEN status ELSE 'Sent'" in statements[1][0]
+    assert statements[1][1] == (9, 3)
+    assert refreshed == [(3, 'invoices', email_queue.month_of(date(2026, 10, 1)))]
+
+# =========================================================
+# END TO END (needs TEST_DATABASE_URL)
+# =========================================================
+@pytest.fixture
+def outbox_db(monkeypatch):
+    dsn = os.environ.get("TEST_DATABASE_URL")
+    if not dsn:
+        pytest.skip("TEST_DATABASE_URL not set")
+    import psycopg2
+    admin = psycopg2.connect(dsn)
+    admin.autocommit = True
+    admin.cursor().execute("DROP SCHEMA IF EXISTS test_email_queue CASCADE; CREATE SCHEMA test_email_queue")
+    connect = lambda: psycopg2.connect(dsn, options="-c search_path=test_email_queue")
+
+    conn = connect()
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE TABLE invoices (id SERIAL PRIMARY KEY, company_id INTEGER, status VARCHAR(20), date DATE);
+        CREATE TABLE quotes (id SERIAL PRIMARY KEY, company_id INTEGER, status VARCHAR(20));
+    """)
+    email_queue.ensure_email_tables(cur)
+    conn.commit()
+    conn.close()
+
+    monkeypatch.setattr(email_queue, '_connect', connect)
+    monkeypatch.setattr(email_queue, '_schema_ready', False)
+    monkeypatch.setattr(email_queue, 'refresh_rollups', lambda *args: True)
+    yield connect
+    admin.cursor().execute("DROP SCHEMA test_email_queue CASCADE")
+    admin.close()
+
+def _queue_invoice_email(connect, status='Draft'):
+    conn = connect()
+    cur = conn.cursor()
+    cur.execute("INSERT INTO invoices (company_id, status, date) VALUES (1, %s, CURRENT_DATE) RETURNING id", (status,))
+    invoice_id = cur.fetchone()[0]
+    email_queue.enqueue_email(cur, 1, 'client@example.com', 'Invoice', '<p>Hi</p>',
+                              attachments=[('INV-1.pdf', b'%PDF-1.4')], ref=('invoice', invoice_id))
+    conn.commit()
+    conn.close()
+    return invoice_id
+
+def _fetch(connect, sql, params=()):
+    conn = connect()
+    cur = conn.cursor()
+    cur.execute(sql, params)
+    row = cur.fetchone()
+    conn.close()
+    return row
+
+def test_queued_invoice_is_marked_sent_after_delivery(smtp, outbox_db):
+    invoice_id = _queue_invoice_email(outbox_db)
+    assert _fetch(outbox_db, "SELECT email_status FROM invoices WHERE id = %s", (invoice_id,)) == ('Queued',)
+
+    assert email_queue.process_queue() == 1
+    assert smtp.messages == [(1, 'client@example.com')]
+    assert _fetch(outbox_db, "SELECT status, email_status FROM invoices WHERE id = %s", (invoice_id,)) == ('Sent', 'Sent')
+    assert _fetch(outbox_db, "SELECT status, attempts FROM email_outbox") == ('sent', 1)
+
+def test_paid_invoice_stays_paid(smtp, outbox_db):
+    invoice_id = _queue_invoice_email(outbox_db, status='Paid')
+    email_queue.process_queue()
+    assert _fetch(outbox_db, "SELECT status, email_status FROM invoices WHERE id = %s", (invoice_id,)) == ('Paid', 'Sent')
+
+def test_busy_server_requeues_with_backoff(smtp, outbox_db):
+    smtp.mode = 'busy'
+    invoice_id = _queue_invoice_email(outbox_db)
+    assert email_queue.process_queue() == 1   # Not due again yet, so the loop ends
+    status, attempts, wait, error = _fetch(outbox_db, """
+        SELECT status, attempts, EXTRACT(EPOCH FROM next_attempt_at - NOW()), last_error FROM email_outbox
+    """)
+    assert (status, attempts) == ('queued', 1) and 20 < wait <= 36 and '451' in error
+    assert _fetch(outbox_db, "SELECT status, email_status FROM invoices WHERE id = %s", (invoice_id,)) == ('Draft', 'Retrying')
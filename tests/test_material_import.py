@@ -0,0 +1,75 @@
+# tests/test_material_import.py
+import io
+from decimal import Decimal
+
+import pytest
+from services import material_import
+from services.material_import import parse_money, parse_material_row, import_materials_csv
+
+@pytest.mark.parametrize('raw, expected', [
+    ('12.50', '12.50'),
+    ('12,50', '12.50'),       # Decimal comma
+    ('12,5', '12.5'),
+    ('1,250', '1250'),        # Thousands comma
+    ('1,234.50', '1234.50'),
+    ('1.234,50', '1234.50'),
+    ('£ 3.99', '3.99'),
+    ('€1 000', '1000'),
+    ('', '0.00'),
+])
+def test_parse_money(raw, expected):
+    assert parse_money(raw) == Decimal(expected)
+
+@pytest.mark.parametrize('raw', ['12,5000', '1,23,4', '1.234.567', 'abc', '12.5.0', 'NaN', 'Infinity'])
+def test_parse_money_rejects_bad_or_ambiguous(raw):
+    with pytest.raises(ValueError):
+        parse_money(raw)
+
+def test_row_defaults_and_cleanup():
+    assert parse_material_row([' SKU1 ', ' Copper Pipe\x00 ']) == ('SKU1', 'Copper Pipe', 'General', 'Each', Decimal('0.00'))
+    assert parse_material_row(['SKU2', 'Sand', 'Aggregates', 'Bag', '£4,50']) == ('SKU2', 'Sand', 'Aggregates', 'Bag', Decimal('4.50'))
+
+@pytest.mark.parametrize('row, message', [
+    (['SKU1'], 'at least SKU and Name'),
+    (['', 'Name'], 'Missing SKU'),
+    (['SKU1', '  '], 'Missing name'),
+    (['SKU1', 'Name', '', '', '-3'], 'Invalid cost price'),
+    (['SKU1', 'Name', '', '', 'twelve'], 'Invalid cost price'),
+    (['SKU1', 'Name', '', '', '12,5000'], 'Ambiguous cost price'),
+])
+def test_row_errors(row, message):
+    with pytest.raises(ValueError, match=message):
+        parse_material_row(row)
+
+def test_import_counts_duplicates_and_reports_bad_lines(recording_cursor):
+    cur = recording_cursor()
+    csv_text = (
+        "SKU,Name,Category,Unit,Cost\n"
+        "A1,Post,Timber,Each,15.00\n"
+        "\n"
+        "B2,Rail,Timber,Each,oops\n"
+        "A1,Post 2.4m,Timber,Each,\"16,50\"\n"
+        ",No SKU,,,1\n"
+        "C3,Cement,,,6.50\n"
+    )
+    report = import_materials_csv(cur, 7, None, io.StringIO(csv_text))
+
+    assert (report['rows'], report['duplicates'], report['rejected']) == (5, 1, 2)
+    assert [e['line'] for e in report['errors']] == [4, 6]
+    # Both A1 lines are staged; the merge keeps the later one (highest line_no)
+    assert [(r[0], r[1]) for r in cur.copied] == [('2', 'A1'), ('5', 'A1'), ('7', 'C3')]
+    assert cur.copied[1][5] == '16.50'
+
+def test_import_copies_in_chunks(recording_cursor, monkeypatch):
+    monkeypatch.setattr(material_import, 'MATERIAL_IMPORT_CHUNK', 2)
+    cur = recording_cursor()
+    rows = "".join(f"S{i},Item {i},,,1\n" for i in range(5))
+    import_materials_csv(cur, 7, None, io.StringIO("SKU,Name\n" + rows))
+    copies = [sql for sql, _ in cur.statements if sql.startswith('COPY')]
+    assert len(copies) == 3 and len(cur.copied) == 5
+
+def test_empty_file_does_no_merge(recording_cursor):
+    cur = recording_cursor()
+    report = import_materials_csv(cur, 7, None, io.StringIO("SKU,Name\n"))
+    assert report['rows'] == 0
+    assert not any('UPDATE materials' in sql or 'INSERT INTO materials' in sql for sql, _ in cur.statements)
@@ -0,0 +1,59 @@
+# tests/test_pdf_jobs.py
+import os
+
+import pytest
+from services import pdf_jobs
+from services.pdf_jobs import get_pdf_job
+
+@pytest.fixture
+def jobs_db(monkeypatch):
+    dsn = os.environ.get("TEST_DATABASE_URL")
+    if not dsn:
+        pytest.skip("TEST_DATABASE_URL not set")
+    import psycopg2
+    admin = psycopg2.connect(dsn)
+    admin.autocommit = True
+    admin.cursor().execute("DROP SCHEMA IF EXISTS test_pdf_jobs CASCADE; CREATE SCHEMA test_pdf_jobs")
+    connect = lambda: psycopg2.connect(dsn, options="-c search_path=test_pdf_jobs")
+    conn = connect()
+    pdf_jobs.ensure_pdf_job_table(conn.cursor())
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(pdf_jobs, 'get_pooled_db', connect)
+    monkeypatch.setattr(pdf_jobs, '_schema_ready', True)
+    yield connect
+    admin.cursor().execute("DROP SCHEMA test_pdf_jobs CASCADE")
+    admin.close()
+
+def _job(connect, job_id, status, queued_for, running_for=None):
+    conn = connect()
+    conn.cursor().execute("""
+        INSERT INTO pdf_jobs (id, company_id, kind, status, file_name, created_at, started_at)
+        VALUES (%s, 1, 'invoice', %s, 'x.pdf', NOW() - make_interval(secs => %s),
+                NOW() - make_interval(secs => %s))
+    """, (job_id, status, queued_for, running_for))
+    conn.commit()
+    conn.close()
+
+def _status(connect, job_id):
+    conn = connect()
+    try:
+        return get_pdf_job(conn.cursor(), job_id, 1)['status']
+    finally:
+        conn.close()
+
+def test_render_marks_the_job_running(jobs_db, monkeypatch):
+    _job(jobs_db, 'a', 'queued', 5)
+    monkeypatch.setattr('services.pdf_generator.generate_pdf', lambda *args, **kwargs: '/tmp/x.pdf')
+    assert pdf_jobs.render_pdf('t.html', {}, 'x.pdf', '', '', False, 'a') == '/tmp/x.pdf'
+    assert _status(jobs_db, 'a') == 'running'
+
+def test_long_queue_is_not_stale_but_a_long_render_is(jobs_db, monkeypatch):
+    monkeypatch.setattr(pdf_jobs, 'PDF_JOB_STALE_AFTER', 60)
+    monkeypatch.setattr(pdf_jobs, 'PDF_JOB_QUEUE_TIMEOUT', 600)
+    _job(jobs_db, 'waiting', 'queued', 300)             # Behind a bulk export
+    _job(jobs_db, 'rendering', 'running', 300, 30)
+    _job(jobs_db, 'dead', 'running', 300, 120)
+    _job(jobs_db, 'never', 'queued', 900)
+    assert [_status(jobs_db, j) for j in ('waiting', 'rendering', 'dead', 'never')] == \
+           ['queued', 'running', 'failed', 'failed']
@@ -0,0 +1,54 @@
+# tests/test_statement_mailer.py
+import os
+import threading
+
+import pytest
+from services import statement_mailer
+from services.statement_mailer import get_active_run
+
+@pytest.fixture
+def runs_db(monkeypatch):
+    dsn = os.environ.get("TEST_DATABASE_URL")
+    if not dsn:
+        pytest.skip("TEST_DATABASE_URL not set")
+    import psycopg2
+    admin = psycopg2.connect(dsn)
+    admin.autocommit = True
+    admin.cursor().execute("DROP SCHEMA IF EXISTS test_statements CASCADE; CREATE SCHEMA test_statements")
+    connect = lambda: psycopg2.connect(dsn, options="-c search_path=test_statements")
+    conn = connect()
+    statement_mailer.ensure_statement_tables(conn.cursor())
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(statement_mailer, '_schema_ready', True)
+    yield connect
+    admin.cursor().execute("DROP SCHEMA test_statements CASCADE")
+    admin.close()
+
+def test_second_request_waits_for_the_first_run(runs_db):
+    first, second = runs_db(), runs_db()
+    try:
+        cur = first.cursor()
+        assert get_active_run(cur, 7) is None
+        cur.execute("INSERT INTO statement_runs (company_id) VALUES (7) RETURNING id")
+        run_id = cur.fetchone()[0]
+
+        seen = []
+        waiter = threading.Thread(target=lambda: seen.append(get_active_run(second.cursor(), 7)), daemon=True)
+        waiter.start()
+        waiter.join(0.3)
+        assert waiter.is_alive()   # Blocked on the lock, not racing past the check
+
+        first.commit()
+        waiter.join(5)
+        assert seen == [run_id]
+    finally:
+        first.close(); second.close()
+
+def test_other_companies_are_not_blocked(runs_db):
+    first, second = runs_db(), runs_db()
+    try:
+        assert get_active_run(first.cursor(), 7) is None
+        assert get_active_run(second.cursor(), 8) is None
+    finally:
+        first.close(); second.close()
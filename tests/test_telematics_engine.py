@@ -0,0 +1,142 @@
+# tests/test_telematics_engine.py
+# Samsara adapter + circuit breaker against a local stub HTTP server.
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import telematics_engine
+
+TRACKER = "https://api.samsara.com/fleet/vehicles/12345"
+API_KEY = "test-key"
+
+class StubSamsara(BaseHTTPRequestHandler):
+    mode = 'ok'   # set by the tests
+    hits = 0
+
+    def do_GET(self):
+        StubSamsara.hits += 1
+        if self.mode == 'slow':
+            time.sleep(0.5)
+        if self.mode == '500':
+            self._reply(500, b'{}')
+        elif self.mode == 'not_json':
+            self._reply(200, b'<html>maintenance</html>')
+        elif self.mode == 'null_gps':
+            self._reply(200, json.dumps({'gps': None, 'fuelLevel': None}).encode())
+        elif self.mode == 'unauthorized':
+            self._reply(401, b'{}')
+        else:
+            body = {'gps': {'latitude': 53.1, 'longitude': -1.2, 'speedMilesPerHour': 30}, 'fuelLevel': {'percent': 64}}
+            self._reply(200, json.dumps(body).encode())
+
+    def _reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def stub(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubSamsara)
+    server.handle_error = lambda *args: None   # Clients that timed out hang up mid-reply
+    threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True).start()
+    StubSamsara.mode, StubSamsara.hits = 'ok', 0
+
+    monkeypatch.setattr(telematics_engine, 'SAMSARA_LIVE', True)
+    monkeypatch.setattr(telematics_engine, 'SAMSARA_API_BASE', f"http://127.0.0.1:{server.server_address[1]}")
+    monkeypatch.setattr(telematics_engine, 'TELEMATICS_TIMEOUT', 0.2)
+    monkeypatch.setenv('TELEMATICS_BREAKER_THRESHOLD', '2')
+    monkeypatch.setenv('TELEMATICS_BREAKER_RESET', '0.1')
+    telematics_engine._breakers.clear()
+    telematics_engine._positions.clear()
+    yield StubSamsara
+    server.shutdown()
+    server.server_close()
+
+def test_live_position_is_parsed_and_cached(stub):
+    data, error = telematics_engine.fetch_live(TRACKER, API_KEY)
+    assert error is None
+    assert (data['lat'], data['lon'], data['speed'], data['fuel_level']) == (53.1, -1.2, 30, 64)
+
+    assert telematics_engine.get_tracker_data(TRACKER, API_KEY) == data
+    assert stub.hits == 1   # Second read came from the cache
+
+def test_cache_is_per_api_key(stub):
+    telematics_engine.get_tracker_data(TRACKER, API_KEY)
+    telematics_engine.get_tracker_data(TRACKER, 'other-tenant')
+    assert stub.hits == 2
+
+@pytest.mark.parametrize('mode', ['500', 'slow', 'not_json'])
+def test_provider_faults_open_the_breaker(stub, mode):
+    stub.mode = mode
+    for _ in range(2):
+        _, error = telematics_engine.fetch_live(TRACKER, API_KEY)
+        assert error == 'provider_error'
+    assert telematics_engine.get_breaker('samsara').state == 'open'
+
+    hits = stub.hits
+    _, error = telematics_engine.fetch_live(TRACKER, API_KEY)
+    assert error == 'breaker_open'
+    assert stub.hits == hits   # Provider not called while open
+
+def test_4xx_does_not_trip_the_breaker(stub):
+    stub.mode = 'unauthorized'
+    for _ in range(3):
+        assert telematics_engine.fetch_live(TRACKER, API_KEY) == (None, 'no_data')
+    assert telematics_engine.get_breaker('samsara').state == 'closed'
+
+def _half_open(stub):
+    stub.mode = '500'
+    for _ in range(2):
+        telematics_engine.fetch_live(TRACKER, API_KEY)
+    breaker = telematics_engine.get_breaker('samsara')
+    time.sleep(0.15)
+    assert breaker.state == 'half-open'
+    return breaker
+
+def test_half_open_trial_with_bad_body_reopens_then_recovers(stub):
+    breaker = _half_open(stub)
+
+    # The trial gets a 200 with a body we can't read: must re-open, not hang half-open
+    stub.mode = 'not_json'
+    _, error = telematics_engine.fetch_live(TRACKER, API_KEY)
+    assert error == 'provider_error'
+    assert breaker.state == 'open'
+
+    time.sleep(0.15)
+    stub.mode = 'ok'
+    data, error = telematics_engine.fetch_live(TRACKER, API_KEY)
+    assert error is None and data['lat'] == 53.1
+    assert breaker.state == 'closed'
+
+def test_half_open_trial_without_gps_closes_the_breaker(stub):
+    # "gps": null is a healthy provider with no fix for this van
+    breaker = _half_open(stub)
+    stub.mode = 'null_gps'
+    data, error = telematics_engine.fetch_live(TRACKER, API_KEY)
+    assert error is None and data['lat'] is None
+    assert breaker.state == 'closed'
+
+def test_unexpected_error_still_settles_the_trial(stub, monkeypatch):
+    breaker = telematics_engine.get_breaker('samsara')
+    breaker.opened_at = time.monotonic() - 1   # Half-open
+
+    def boom(self, tracker):
+        raise KeyError('surprise')
+    monkeypatch.setattr(telematics_engine.SamsaraAdapter, 'get_stats', boom)
+    assert telematics_engine.fetch_live(TRACKER, API_KEY) == (None, 'error')
+    assert not breaker._trial_running
+
+def test_fleet_fetch_returns_within_budget(stub):
+    stub.mode = 'slow'
+    trackers = [f"{TRACKER}{i}" for i in range(4)]
+    started = time.monotonic()
+    results = telematics_engine.get_fleet_positions(trackers, API_KEY, budget=0.1)
+    assert time.monotonic() - started < 0.4
+    assert set(results) == set(trackers)
@@ -0,0 +1,88 @@
+# --- utils/static_assets.py ---
+import os
+import hashlib
+import threading
+from werkzeug.security import safe_join
+
+# --- STATIC ASSET FINGERPRINTING ---
+# url_for('static', ...) and tenant logo URLs get a '?v=<content hash>' suffix.
+# A fingerprinted URL can never point at different bytes, so the browser may
+# cache it forever (Cache-Control: immutable) instead of revalidating it.
+# Hashes are cached per file and only recomputed when mtime/size change.
+ASSET_HASH_MAX_BYTES = int(os.environ.get("ASSET_HASH_MAX_BYTES", 5 * 1024 * 1024))
+IMMUTABLE_MAX_AGE = 31536000  # 1 year
+
+# Requests that never need tenant lookup, alerts or branding
+ASSET_PREFIXES = ('/static/', '/uploads/')
+ASSET_PATHS = ('/favicon.ico',)
+
+_hashes = {}
+_lock = threading.Lock()
+
+def is_asset_path(path):
+    return path in ASSET_PATHS or path.startswith(ASSET_PREFIXES)
+
+def file_hash(abs_path):
+    """
+    Short content hash of a file on disk, or None if missing / too big to hash.
+    """
+    try:
+        stat = os.stat(abs_path)
+    except (OSError, TypeError, ValueError):
+        return None
+    if stat.st_size > ASSET_HASH_MAX_BYTES:
+        return None
+
+    entry = _hashes.get(abs_path)
+    if entry and entry[0] == stat.st_mtime and entry[1] == stat.st_size:
+        return entry[2]
+
+    try:
+        with open(abs_path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()[:16]
+    except OSError:
+        return None
+
+    with _lock:
+        _hashes[abs_path] = (stat.st_mtime, stat.st_size, digest)
+    return digest
+
+def static_file_hash(static_folder, filename):
+    # safe_join returns None for paths escaping the folder (../)
+    return file_hash(safe_join(static_folder, filename)) if filename else None
+
+def fingerprint_url(url, static_folder):
+    """
+    Adds '?v=<hash>' to a '/static/...' or '/uploads/...' URL (e.g. a tenant logo).
+    Anything else (external URLs, missing files) is returned unchanged.
+    """
+    if not url or '?' in url:
+        return url
+    for prefix, sub_dir in (('/static/', ''), ('/uploads/', 'uploads')):
+        if url.startswith(prefix):
+            rel_path = url[len(prefix):]
+            if sub_dir: rel_path = f"{sub_dir}/{rel_path}"
+            digest = static_file_hash(static_folder, rel_path)
+            return f"{url}?v={digest}" if digest else url
+    return url
+
+def apply_asset_cache_headers(response, abs_path, requested_version, public=True):
+    """
+    Strong content ETag on every asset response; 'immutable' only when the
+    URL carries the current fingerprint.
+    """
+    digest = file_hash(abs_path)
+    if not digest or response.status_code not in (200, 304):
+        return response
+
+    response.set_etag(digest)
+    if requested_version == digest:
+        response.cache_control.no_cache = False
+        response.cache_control.public = public
+        response.cache_control.private = not public
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    elif not public:
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response